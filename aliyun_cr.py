@@ -1,22 +1,22 @@
 #!/usr/bin/env python
 # coding=utf-8
-import json
 import logging
-from asyncio import get_event_loop
-from dataclasses import dataclass
+import time
+from asyncio import ensure_future
+from dataclasses import asdict, dataclass
 from enum import Enum, auto
-from typing import Any
+from typing import Dict, Optional
 
-from aliyunsdkcore.client import AcsClient
-from aliyunsdkcore.request import RoaRequest
-from aliyunsdkcr.request.v20160607 import (CreateRepoBuildRuleRequest, CreateRepoRequest,
-                                           DeleteRepoRequest, GetRepoBuildListRequest,
-                                           GetRepoBuildRuleListRequest, GetRepoListRequest,
-                                           GetRepoTagsRequest,
-                                           StartRepoBuildByRuleRequest, UpdateRepoBuildRuleRequest)
+from cr_transport import TRANSPORTS, Transport
+from state_cache import StateCache
+from throttle import RateLimiter, RetryPolicy, call_with_retry
 
 logger = logging.getLogger(__file__)
 
+# actions that can't be repeated safely: a retry of one the server applied already creates a
+# second build rule, starts a second build or fails as the repo exists.
+NON_IDEMPOTENT_ACTIONS = {"CreateRepo", "CreateRepoBuildRule", "StartRepoBuildByRule"}
+
 
 class BuildStatus(Enum):
     PENDING = auto()
@@ -37,6 +37,31 @@ class Repository:
     name: str
     namespace: str
     id: int = 0
+    # unix time in seconds, None if unknown.
+    created: Optional[float] = None
+    modified: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class CRTarget:
+    """
+    a namespace in a region, one AliyunCR client each.
+    """
+    region: str
+    namespace: str
+
+    def __str__(self):
+        return f"{self.region}/{self.namespace}"
+
+    @classmethod
+    def parse(cls, s: str, namespace: str = None) -> 'CRTarget':
+        """
+        parse "<region>/<namespace>", or "<region>" with the given default namespace.
+        """
+        region, _, ns = s.partition("/")
+        if not region or not (ns or namespace):
+            raise ValueError(f"invalid target: {s}, expect <region>/<namespace>")
+        return cls(region=region, namespace=ns or namespace)
 
 
 @dataclass()
@@ -49,29 +74,30 @@ class BuildRule:
 
 class Request:
 
-    def __init__(self, request_class, region: str, api: AcsClient):
-        self.request: RoaRequest = request_class()
-        # self.request.set_protocol_type('https')
-        self.request.set_content_type("application/json")
-        self.request.set_endpoint(f"cr.{region}.aliyuncs.com")
-        self.api: AcsClient = api
+    def __init__(self,
+                 action: str,
+                 transport: Transport,
+                 limiter: RateLimiter = None,
+                 retry: RetryPolicy = None,
+                 ):
+        self.action = action
+        self.transport = transport
+        self.limiter = limiter
+        self.retry = retry
 
         self.data = {}
         self.path_param = {}
+        self.query_param = {}
 
     async def invoke(self) -> dict:
-        for k, v in self.path_param.items():
-            self.request.add_path_param(k, v)
-        self.request.set_content(json.dumps(self.data))
-
-        res = await get_event_loop().run_in_executor(
-            None,
-            self.api.do_action_with_exception,
-            self.request,
+        return await call_with_retry(
+            self.action,
+            lambda: self.transport.invoke(self),
+            limiter=self.limiter,
+            retry=self.retry,
+            idempotent=self.action not in NON_IDEMPOTENT_ACTIONS,
         )
 
-        return json.loads(res, encoding="GBK")
-
 
 class AliyunCR:
 
@@ -81,30 +107,117 @@ class AliyunCR:
         access_secret: str,
         namespace: str = None,
         region: str = "cn-shanghai",
+        cache: Optional[StateCache] = None,
+        transport: str = "http",
+        endpoint: str = None,
+        qps: float = 20,
+        action_qps: Dict[str, float] = None,
+        max_attempts: int = 5,
+        page_size: int = 100,
     ):
+        """
+        :param transport: "http" for the builtin asyncio client, "executor" for the blocking AcsClient.
+        :param endpoint: API endpoint, "host[:port]" or "scheme://host[:port]",
+                         defaults to cr.<region>.aliyuncs.com
+        :param qps: requests per second of all actions together, lowered automatically on throttling.
+        :param action_qps: additional limit of some actions, {action: qps}.
+        :param max_attempts: throttled, timed out and 5xx calls are tried up to this many times,
+                             the actions of NON_IDEMPOTENT_ACTIONS only if throttled or never sent.
+        :param page_size: items per request of the list calls.
+        """
         self.region = region
         self.namespace = namespace
-        self.api = AcsClient(access_key, access_secret, region)
-
-    def _request(self, module: Any):
-        request_name = module.__name__.split(".")[-1]
-        request_class = getattr(module, request_name)
-        return Request(request_class, region=self.region, api=self.api)
-
-    async def create_build_rule(self,
-                                repo_name: str,
-                                dockerfile_dir: str,
-                                tag: str,
-                                force: bool = True,
-                                ):
+        self.transport: Transport = TRANSPORTS[transport](
+            access_key=access_key,
+            access_secret=access_secret,
+            region=region,
+            endpoint=endpoint,
+        )
+        self.cache = cache
+        self.limiter = RateLimiter(qps=qps, action_qps=action_qps)
+        self.retry = RetryPolicy(max_attempts=max_attempts)
+        self.page_size = page_size
+
+    async def close(self):
+        await self.transport.close()
+
+    def _cache_key(self, repo_name: str, namespace: str = None):
+        return f"{self.region}/{namespace or self.namespace}/{repo_name}"
+
+    def _cache_get(self, kind: str, key: str):
+        if self.cache is None:
+            return None
+        return self.cache.get(kind, key)
+
+    def _cache_put(self, kind: str, key: str, value):
+        if self.cache is not None:
+            self.cache.put(kind, key, value)
+
+    def _cache_rule(self, repo_name: str, rule: BuildRule):
         """
-        :param repo_name:
-        :param dockerfile_dir:
-        :param tag:
-        :param force: if this is true and number of rules achieve the limit, delete one(first one).
-        :return:
+        write through a created or edited rule.
         """
-        request = self._request(CreateRepoBuildRuleRequest)
+        def replace(rules: list):
+            return [r for r in rules if str(r["id"]) != str(rule.id)] + [asdict(rule)]
+
+        if self.cache is not None:
+            self.cache.modify("rule", self._cache_key(repo_name), replace)
+
+    def _cache_repos(self, namespace: str, fn):
+        """
+        write through a change of the repos of `namespace`.
+        """
+        if self.cache is not None:
+            self.cache.modify("repo", f"{self.region}/{namespace}", fn)
+            self.cache.modify("repo", f"{self.region}/*", fn)
+
+    def _request(self, action: str):
+        return Request(action, transport=self.transport, limiter=self.limiter, retry=self.retry)
+
+    async def _paginate(self, action: str, path_param: dict, items_key: str, limit: int = None):
+        """
+        yield the items of every page until exhausted, or until `limit` items are yielded.
+        page k+1 is requested while the caller consumes the items of page k.
+        """
+
+        async def fetch(page: int):
+            request = self._request(action)
+            request.path_param = path_param
+            request.query_param = {
+                "Page": str(page),
+                "PageSize": str(self.page_size),
+            }
+            res = await request.invoke()
+            return res['data']
+
+        page = 1
+        next_page = ensure_future(fetch(page))
+        count = 0
+        try:
+            while next_page is not None:
+                data = await next_page
+                next_page = None
+                items = data[items_key]
+                page_full = len(items) >= self.page_size
+                if limit is not None:
+                    items = items[:limit - count]
+                count += len(items)
+                total = data.get('total')
+                if page_full and (total is None or count < total) and (limit is None or count < limit):
+                    page += 1
+                    next_page = ensure_future(fetch(page))
+                for item in items:
+                    yield item
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def create_build_rule(self, repo_name: str, dockerfile_dir: str, tag: str):
+        """
+        a repo has a limited number of build rules, see rule_slots.RuleSlots for reusing them.
+        :return: id of the created rule.
+        """
+        request = self._request("CreateRepoBuildRule")
         request.path_param = {
             "RepoNamespace": self.namespace,
             "RepoName": repo_name,
@@ -119,27 +232,13 @@ class AliyunCR:
                 "Tag": tag,
             }
         }
-        try:
-            res = await request.invoke()
-            return res['data']['buildRuleId']
-        except Exception as e:
-            limit = 5
-            rules = [i async for i in self.list_build_rule(repo_name=repo_name)]
-            if len(rules) >= limit:
-                rule = rules[0]
-                logger.warning(f"Rule limit exceed, editing a existing one:{rule.id}.")
-                await self.edit_build_rule(repo_name=repo_name,
-                                           rule_id=str(rule.id),
-                                           dockerfile_dir=dockerfile_dir,
-                                           tag=tag,
-                                           )
-                return rule.id
-            else:
-                raise e
-            pass
+        res = await request.invoke()
+        rule_id = res['data']['buildRuleId']
+        self._cache_rule(repo_name, BuildRule(id=rule_id, tag=tag, dockerfile_dir=dockerfile_dir))
+        return rule_id
 
     async def edit_build_rule(self, repo_name: str, rule_id: str, dockerfile_dir: str, tag: str):
-        request = self._request(UpdateRepoBuildRuleRequest)
+        request = self._request("UpdateRepoBuildRule")
         request.path_param = {
             "RepoNamespace": self.namespace,
             "RepoName": repo_name,
@@ -155,10 +254,12 @@ class AliyunCR:
                 "Tag": tag,
             }
         }
-        return await request.invoke()
+        res = await request.invoke()
+        self._cache_rule(repo_name, BuildRule(id=rule_id, tag=tag, dockerfile_dir=dockerfile_dir))
+        return res
 
     async def build_by_rule(self, repo_name: str, rule_id: str):
-        request = self._request(StartRepoBuildByRuleRequest)
+        request = self._request("StartRepoBuildByRule")
         request.path_param = {
             "BuildRuleId": str(rule_id),
             "RepoNamespace": self.namespace,
@@ -167,45 +268,54 @@ class AliyunCR:
         return await request.invoke()
 
     async def list_build_rule(self, repo_name: str):
-        request = self._request(GetRepoBuildRuleListRequest)
-        request.path_param = {
-            "RepoNamespace": self.namespace,
-            "RepoName": repo_name,
-        }
-        body = await request.invoke()
-        data = body['data']
-        rules = data['buildRules']
-        for r in rules:
-            yield BuildRule(
+        key = self._cache_key(repo_name)
+        rules = self._cache_get("rule", key)
+        if rules is None:
+            request = self._request("GetRepoBuildRuleList")
+            request.path_param = {
+                "RepoNamespace": self.namespace,
+                "RepoName": repo_name,
+            }
+            body = await request.invoke()
+            data = body['data']
+            rules = [asdict(BuildRule(
                 id=r['buildRuleId'],
                 tag=r['imageTag'],
                 dockerfile_dir=r['dockerfileLocation'],
-            )
+            )) for r in data['buildRules']]
+            self._cache_put("rule", key, rules)
+        for r in rules:
+            yield BuildRule(**r)
 
-    async def list_tags(self, repo_name: str):
-        request = self._request(GetRepoTagsRequest)
-        request.path_param = {
+    async def list_tags(self, repo_name: str, use_cache: bool = True):
+        """
+        :param use_cache: set this to False to always ask the server, the result is still cached.
+        """
+        key = self._cache_key(repo_name)
+        tags = self._cache_get("tag", key) if use_cache else None
+        if tags is not None:
+            for t in tags:
+                yield t
+            return
+        tags = []
+        async for t in self._paginate("GetRepoTags", {
             "RepoNamespace": self.namespace,
             "RepoName": repo_name,
-        }
-        body = await request.invoke()
-        data = body['data']
-        tags = data['tags']
-        for t in tags:
+        }, 'tags'):
+            tags.append(t['tag'])
             yield t['tag']
+        self._cache_put("tag", key, tags)
 
-    async def list_builds(self, repo_name: str, namespace: str = None):
+    async def list_builds(self, repo_name: str, namespace: str = None, limit: int = None):
+        """
+        :param limit: stop after this many builds, the most recent builds come first.
+        """
         if namespace is None:
             namespace = self.namespace
-        request = self._request(GetRepoBuildListRequest)
-        request.path_param = {
+        async for b in self._paginate("GetRepoBuildList", {
             "RepoNamespace": namespace,
             "RepoName": repo_name,
-        }
-        body = await request.invoke()
-        data = body['data']
-        builds = data['builds']
-        for b in builds:
+        }, 'builds', limit=limit):
             yield BuildInfo(
                 id=b['buildId'],
                 status=BuildStatus[b['buildStatus']],
@@ -222,54 +332,78 @@ class AliyunCR:
                 if b.status == BuildStatus.PENDING or b.status == BuildStatus.BUILDING:
                     yield b
 
-    async def list_repo(self, page: int = 0, page_size: int = 5000):
-        request = self._request(GetRepoListRequest)
-        request.path_param = {
-            "Page": str(page),
-            "PageSize": str(page_size),
-        }
-        res = await request.invoke()
-
-        data: dict = res['data']
-        repos: list = data['repos']
-        for r in repos:
-            yield Repository(
+    async def list_repo(self):
+        """
+        list the repos of `self.namespace`, or of all namespaces if it is None.
+        """
+        key = f"{self.region}/{self.namespace or '*'}"
+        repos = self._cache_get("repo", key)
+        if repos is not None:
+            for r in repos:
+                yield Repository(**r)
+            return
+        if self.namespace is None:
+            pages = self._paginate("GetRepoList", {}, 'repos')
+        else:
+            pages = self._paginate("GetRepoListByNamespace", {
+                "RepoNamespace": self.namespace,
+            }, 'repos')
+        repos = []
+        async for r in pages:
+            repo = Repository(
                 id=r["repoId"],
                 name=r["repoName"],
                 namespace=r["repoNamespace"],
+                created=r["gmtCreate"] / 1000 if r.get("gmtCreate") else None,
+                modified=r["gmtModified"] / 1000 if r.get("gmtModified") else None,
             )
+            repos.append(asdict(repo))
+            yield repo
+        self._cache_put("repo", key, repos)
 
     async def delete_repo(self, repo_name: str, namespace: str = None):
         if namespace is None:
             namespace = self.namespace
-        request = self._request(DeleteRepoRequest)
+        request = self._request("DeleteRepo")
         request.path_param = {
             "RepoNamespace": namespace,
             "RepoName": repo_name,
         }
-        return await request.invoke()
+        res = await request.invoke()
+        self._cache_repos(namespace, lambda repos: [
+            r for r in repos if (r["namespace"], r["name"]) != (namespace, repo_name)
+        ])
+        if self.cache is not None:
+            self.cache.delete("rule", self._cache_key(repo_name, namespace))
+            self.cache.delete("tag", self._cache_key(repo_name, namespace))
+        return res
 
     async def create_repo(self,
                           name: str,
-                          github_namespace: str,
-                          github_repo: str,
+                          github_namespace: Optional[str],
+                          github_repo: Optional[str],
                           namespace: str = None,
                           public: bool = True,
                           ):
+        """
+        :param github_namespace: None for a repo without build source, images are pushed to it.
+        """
         if namespace is None:
             namespace = self.namespace
-        request = self._request(CreateRepoRequest)
+        request = self._request("CreateRepo")
         request.data = {
             "Repo": {
-                "Region": "cn-shanghai",
+                "Region": self.region,
                 "RepoName": name,
                 "RepoType": "PUBLIC" if public else "PRIVATE",
                 "Summary": "automatically created by docker-mirror-creator.",
                 "RepoNamespaceName": namespace,
                 "RepoNamespace": namespace,
-                "RepoBuildType": "AUTO_BUILD",
+                "RepoBuildType": "AUTO_BUILD" if github_namespace else "MANUAL",
             },
-            "RepoSource": {
+        }
+        if github_namespace:
+            request.data["RepoSource"] = {
                 "Source": {
                     "SourceRepoType": "GITHUB",
                     "SourceRepoNamespace": github_namespace,
@@ -281,5 +415,11 @@ class AliyunCR:
                     "IsDisableCache": False
                 }
             }
-        }
-        return await request.invoke()
+        res = await request.invoke()
+        now = time.time()
+        repo = Repository(name=name, namespace=namespace, created=now, modified=now)
+        self._cache_repos(namespace, lambda repos: repos + [asdict(repo)])
+        if self.cache is not None:
+            self.cache.put("rule", self._cache_key(name, namespace), [])
+            self.cache.put("tag", self._cache_key(name, namespace), [])
+        return res
@@ -0,0 +1,175 @@
+"""
+git on asyncio subprocesses, for the async commands. a module of its own, `copy` and the other
+commands on Git start without asyncio.
+"""
+import asyncio
+import logging
+import subprocess
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Dict, List, Mapping, Optional
+
+from git import _batch_check_input, _branch, _changed_files, _fast_import_stream
+from metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+
+@dataclass()
+class GitResult:
+    args: List[str]
+    returncode: int
+    stdout: str
+    stderr: str
+    # wall time of the command, without the time spent waiting for the index queue.
+    seconds: float
+
+
+class AsyncGit:
+    """
+    Git on asyncio subprocesses, for the async commands and `serve`: a git command no longer
+    blocks the event loop and the API calls in flight.
+
+    commands that write the index, objects or refs go through one FIFO queue, so concurrent
+    callers never race on index.lock. a push asked for while another one runs waits for it and
+    is shared by everyone asking meanwhile, a burst of commits is pushed once.
+    every command returns a GitResult with its output and timing.
+    """
+
+    def __init__(self,
+                 git_bin: str = 'git',
+                 cwd: str = '.',
+                 env: Mapping[str, str] = None,
+                 ):
+        self.git_bin = git_bin
+        self.cwd = cwd
+        self.env = env
+        self._queue = asyncio.Lock()
+        # {push args: push waiting for the running one}
+        self._next_push: Dict[tuple, asyncio.Future] = {}
+        self._running_push: Dict[tuple, asyncio.Future] = {}
+
+    async def run(self, *args: str, input: str = None, check: bool = True,
+                  mutates: bool = False) -> GitResult:
+        """
+        :param mutates: the command writes the index, objects or refs, run it through the queue.
+        """
+        if mutates:
+            async with self._queue:
+                return await self._execute(args, input, check)
+        return await self._execute(args, input, check)
+
+    async def _execute(self, args, input: Optional[str], check: bool) -> GitResult:
+        with metrics.track("git", args[0]):
+            start = perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                self.git_bin, *args,
+                cwd=self.cwd,
+                env=self.env,
+                stdin=None if input is None else asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, stderr = await proc.communicate(None if input is None else input.encode())
+            res = GitResult(args=[self.git_bin, *args],
+                            returncode=proc.returncode,
+                            stdout=stdout.decode(errors="replace"),
+                            stderr=stderr.decode(errors="replace"),
+                            seconds=perf_counter() - start)
+        logger.debug(f"git {args[0]} exited {res.returncode} in {res.seconds:.3f}s"
+                     + (f": {res.stderr.strip()}" if res.stderr.strip() else ""))
+        if check and res.returncode:
+            raise subprocess.CalledProcessError(res.returncode, res.args, res.stdout, res.stderr)
+        return res
+
+    async def add(self, *filepaths: str, check: bool = True) -> GitResult:
+        return await self.run("add", "--pathspec-from-file=-", "--pathspec-file-nul",
+                              input="\0".join(filepaths), check=check, mutates=True)
+
+    async def commit(self, message: str, check: bool = True) -> GitResult:
+        return await self.run("commit", "-m", message, check=check, mutates=True)
+
+    async def add_commit(self, filepaths: List[str], message: str) -> GitResult:
+        """
+        stage and commit `filepaths` with no other command of the queue in between.
+        :raise CalledProcessError: the commit failed, unless there was nothing to commit.
+        """
+        async with self._queue:
+            await self._execute(("add", "--pathspec-from-file=-", "--pathspec-file-nul"),
+                                "\0".join(filepaths), True)
+            res = await self._execute(("commit", "-m", message), None, False)
+        if res.returncode and "nothing to commit" not in res.stdout:
+            raise subprocess.CalledProcessError(res.returncode, res.args, res.stdout, res.stderr)
+        return res
+
+    async def rev_parse(self, rev: str = 'HEAD') -> str:
+        return (await self.run("rev-parse", "--verify", f"{rev}^{{commit}}")).stdout.strip()
+
+    async def symbolic_ref(self, name: str = 'HEAD') -> str:
+        return (await self.run("symbolic-ref", "-q", name)).stdout.strip()
+
+    async def changed_files(self, files: Mapping[str, str], rev: str = 'HEAD') -> Dict[str, str]:
+        """
+        see Git.changed_files
+        """
+        res = await self.run("cat-file", "--batch-check", input=_batch_check_input(files, rev),
+                             check=False)
+        return _changed_files(files, res.returncode, res.stdout)
+
+    async def commit_files(self, files: Mapping[str, str], message: str, ref: str = None) -> str:
+        """
+        see Git.commit_files, the parent is read in the queue, right before the commit.
+        """
+        if ref is None:
+            ref = await self.symbolic_ref()
+        author = (await self.run("var", "GIT_AUTHOR_IDENT")).stdout.strip()
+        committer = (await self.run("var", "GIT_COMMITTER_IDENT")).stdout.strip()
+        async with self._queue:
+            try:
+                parent = await self.rev_parse(ref)
+            except subprocess.CalledProcessError:
+                parent = None
+            await self._execute(("fast-import", "--quiet", "--done"),
+                                _fast_import_stream(ref, parent, author, committer, message, files),
+                                True)
+            return await self.rev_parse(ref)
+
+    async def is_bare(self) -> bool:
+        return (await self.run("rev-parse", "--is-bare-repository")).stdout.strip() == "true"
+
+    async def update_worktree(self, old: Optional[str], new: str) -> GitResult:
+        """
+        see Git.update_worktree
+        """
+        return await self.run("read-tree", "-m", "-u", *([new] if old is None else [old, new]),
+                              mutates=True)
+
+    async def push(self, *args: str) -> GitResult:
+        """
+        `git push <args>`, coalesced with the other pushes of the same args: it starts once the
+        running push is done and then pushes every commit made until then.
+        """
+        pending = self._next_push.get(args)
+        if pending is None:
+            pending = asyncio.ensure_future(self._push(args, self._running_push.get(args)))
+            self._next_push[args] = pending
+        return await asyncio.shield(pending)
+
+    async def push_ref(self, ref: str) -> GitResult:
+        """
+        see Git.push_ref
+        """
+        res = await self.run("config", f"branch.{_branch(ref)}.remote", check=False)
+        return await self.push(res.stdout.strip() or "origin", f"{ref}:{ref}")
+
+    async def _push(self, args: tuple, running: Optional[asyncio.Future]) -> GitResult:
+        if running is not None:
+            await asyncio.wait([running])
+        # pushes asked for from now on may miss commits this one already started with.
+        me = self._next_push.pop(args)
+        self._running_push[args] = me
+        try:
+            return await self.run("push", *args)
+        finally:
+            if self._running_push.get(args) is me:
+                del self._running_push[args]
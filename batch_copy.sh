@@ -4,6 +4,4 @@
 
 # input : image:tag
 my_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
-while read image; do
-    python $my_dir/mirror-op.py copy --no-commit --no-push --debug $image $@
-done
+python $my_dir/mirror-op.py copy --no-commit --no-push --debug --from-file - $@
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+offline benchmark of mirror-op.py commands against the fake Container Registry API (fake_cr.py).
+
+for every size a synthetic mirror repo is generated, then build, check and clear are run
+in that order, each in its own process. reports wall time, API calls and peak memory.
+
+    python benchmark.py --sizes 100,1000,10000 --latency 0.02
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import click
+
+from fake_cr import FakeCR
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+mirror_op = os.path.join(my_dir, "mirror-op.py")
+
+NAMESPACE = "bench"
+# bytes of ru_maxrss: KiB on linux, bytes on macOS.
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def generate_repo(path: str, size: int, tags_per_repo: int = 3):
+    """
+    write `size` Dockerfiles, `tags_per_repo` tags for every repo.
+    """
+    for i in range(size):
+        repo, tag = divmod(i, tags_per_repo)
+        dir_name = os.path.join(path, f"lib{repo % 10}", f"image{repo}", f"1.{tag}")
+        os.makedirs(dir_name, exist_ok=True)
+        with open(os.path.join(dir_name, "Dockerfile"), "wt") as f:
+            f.write(f"FROM lib{repo % 10}/image{repo}:1.{tag}")
+
+
+def run_command(fake: FakeCR, endpoint: str, command: str, args) -> dict:
+    """
+    run one mirror-op.py command in a child process.
+    """
+    fake.reset_stats()
+    start = time.perf_counter()
+    # spawned and reaped with wait4, for the resource usage of this child alone.
+    pid = os.posix_spawn(
+        sys.executable,
+        [sys.executable, mirror_op, "--log-level", "ERROR", command,
+         "key", "secret", NAMESPACE, "--api-endpoint", endpoint, *args],
+        os.environ,
+        file_actions=[(os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0)],
+    )
+    _, status, rusage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    return {
+        "command": command,
+        "exit_code": os.waitstatus_to_exitcode(status),
+        "wall_time": round(wall, 3),
+        "peak_memory_mb": round(rusage.ru_maxrss * MAXRSS_UNIT / (1 << 20), 1),
+        **fake.stats(),
+    }
+
+
+@click.command()
+@click.option("--sizes", default="100,1000,10000", show_default=True,
+              help="comma separated numbers of Dockerfiles.")
+@click.option("--tags-per-repo", type=int, default=3, show_default=True)
+@click.option("--latency", type=float, default=0.02, show_default=True,
+              help="seconds the fake API spends on every call.")
+@click.option("--error-rate", type=float, default=0.0)
+@click.option("--server-qps", type=float, default=0, help="fake API throttling, 0 for none.")
+@click.option("--concurrency", type=int, default=16, show_default=True)
+@click.option("--qps", type=float, default=1000, show_default=True, help="client side rate limit.")
+@click.option("--commands", default="build,check,clear", show_default=True)
+@click.option("--json-out", type=click.File("wt"), default=None, help="write results as json here.")
+def main(sizes: str,
+         tags_per_repo: int,
+         latency: float,
+         error_rate: float,
+         server_qps: float,
+         concurrency: int,
+         qps: float,
+         commands: str,
+         json_out=None,
+         ):
+    results = []
+    for size in [int(i) for i in sizes.split(",")]:
+        fake = FakeCR(latency=latency, error_rate=error_rate, qps=server_qps, build_time=0)
+        server = fake.serve()
+        endpoint = f"127.0.0.1:{server.server_port}"
+        with tempfile.TemporaryDirectory() as local_git_repo:
+            generate_repo(local_git_repo, size, tags_per_repo)
+            for command in commands.split(","):
+                args = ["--qps", str(qps)]
+                if command in ("build", "check"):
+                    args += ["--concurrency", str(concurrency)]
+                if command in ("build", "check", "clear"):
+                    args += ["--local-git-repo", local_git_repo]
+                result = {"size": size, **run_command(fake, endpoint, command, args)}
+                results.append(result)
+                print(f"{size:>6} {command:<6} {result['wall_time']:>9.2f}s "
+                      f"{result['total_calls']:>7} calls {result['peak_memory_mb']:>7.1f}MB "
+                      f"max in flight: {result['max_in_flight']:>3} exit: {result['exit_code']}")
+        server.shutdown()
+        server.server_close()
+    if json_out is not None:
+        json.dump(results, json_out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
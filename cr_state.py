@@ -0,0 +1,142 @@
+import logging
+from asyncio import Future, Lock, ensure_future, shield
+from collections import defaultdict
+from enum import Enum
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from aliyun_cr import AliyunCR, BuildInfo, BuildRule, BuildStatus, Repository
+from rule_slots import DEFAULT_RULE_LIMIT, RuleSlots
+
+logger = logging.getLogger(__file__)
+
+
+class ImageStatus(Enum):
+    READY = "ready"
+    PENDING = "pending"
+    BUILDING = "building"
+    NO_BUILD = "no-build"
+    NO_RULE = "no-rule"
+    NO_REPO = "no-repo"
+    FAILED = "failed"
+    ERROR = "error"
+
+
+class CRState:
+    """
+    memoized view of the repos of one AliyunCR namespace.
+
+    repos, build rules, tags and builds are fetched at most once per repo, concurrent callers
+    share the same in-flight request, so API calls scale with the number of repos instead of
+    the number of tags.
+    """
+
+    def __init__(self, cr: AliyunCR, rule_limit: int = DEFAULT_RULE_LIMIT):
+        self.cr = cr
+        self.rule_limit = rule_limit
+        self.slots: Dict[str, RuleSlots] = {}
+        self._futures: Dict[tuple, Future] = {}
+        self._repo_locks: Dict[str, Lock] = defaultdict(Lock)
+
+    async def _single_flight(self, key: tuple, factory: Callable[[], Awaitable]):
+        future = self._futures.get(key)
+        if future is None:
+            future = ensure_future(factory())
+            self._futures[key] = future
+        try:
+            return await shield(future)
+        except Exception:
+            # don't memoize failures, the next caller retries.
+            if self._futures.get(key) is future:
+                del self._futures[key]
+            raise
+
+    async def repos(self) -> Dict[str, Repository]:
+        async def fetch():
+            repos = {i.name: i async for i in self.cr.list_repo()}
+            logger.debug(f'# of repos : {len(repos)}')
+            return repos
+
+        return await self._single_flight(("repos",), fetch)
+
+    async def rules(self, repo_name: str) -> List[BuildRule]:
+        async def fetch():
+            return [i async for i in self.cr.list_build_rule(repo_name=repo_name)]
+
+        return await self._single_flight(("rules", repo_name), fetch)
+
+    async def tags(self, repo_name: str, use_cache: bool = True) -> Set[str]:
+        async def fetch():
+            return {i async for i in self.cr.list_tags(repo_name=repo_name, use_cache=use_cache)}
+
+        return await self._single_flight(("tags", repo_name, use_cache), fetch)
+
+    async def has_tag(self, repo_name: str, tag: str) -> bool:
+        if tag in await self.tags(repo_name):
+            return True
+        if self.cr.cache is None:
+            return False
+        # a cached tag list doesn't know about builds finished after it was written.
+        return tag in await self.tags(repo_name, use_cache=False)
+
+    async def builds(self, repo_name: str) -> List[BuildInfo]:
+        async def fetch():
+            return [i async for i in self.cr.list_builds(repo_name=repo_name)]
+
+        return await self._single_flight(("builds", repo_name), fetch)
+
+    async def not_finished_builds(self, repo_name: str, tag: str) -> List[BuildInfo]:
+        return [b for b in await self.builds(repo_name)
+                if b.tag == tag and b.status in (BuildStatus.PENDING, BuildStatus.BUILDING)]
+
+    async def image_status(self, repo_name: str, tag: str) -> Tuple[ImageStatus, str]:
+        """
+        :return: status of a tag and the reason if it is not ready.
+        """
+        if repo_name not in await self.repos():
+            return ImageStatus.NO_REPO, "Repo not exist!"
+        # the rule of a built tag may have been recycled for another tag.
+        if await self.has_tag(repo_name, tag):
+            return ImageStatus.READY, ""
+        rules = await self.rules(repo_name)
+        if not [i for i in rules if i.tag == tag]:
+            return ImageStatus.NO_RULE, f"Rule for {tag} not exist!"
+        builds = await self.not_finished_builds(repo_name, tag)
+        if not builds:
+            return ImageStatus.NO_BUILD, "Tag not exist, no pending build!"
+        if [b for b in builds if b.status == BuildStatus.BUILDING]:
+            return ImageStatus.BUILDING, "Tag not exist, building!"
+        return ImageStatus.PENDING, "Tag not exist, build pending!"
+
+    async def ensure_repo(self, repo_name: str, github_namespace: Optional[str],
+                          github_repo: Optional[str]) -> bool:
+        """
+        create the repo if it doesn't exist yet, without build source if github_namespace is None.
+        :return: True if the repo was created by this call.
+        """
+        async with self._repo_locks[repo_name]:
+            repos = await self.repos()
+            if repo_name in repos:
+                return False
+            await self.cr.create_repo(
+                name=repo_name,
+                github_namespace=github_namespace,
+                github_repo=github_repo,
+            )
+            repos[repo_name] = Repository(name=repo_name, namespace=self.cr.namespace)
+            return True
+
+    async def rule_slots(self, repo_name: str) -> RuleSlots:
+        """
+        the build rule slots of a repo, sharing its memoized rule list.
+        """
+        slots = self.slots.get(repo_name)
+        if slots is None:
+            rules = await self.rules(repo_name)
+            slots = self.slots.setdefault(repo_name, RuleSlots(
+                self.cr,
+                repo_name=repo_name,
+                rules=rules,
+                builds=lambda: self.builds(repo_name),
+                limit=self.rule_limit,
+            ))
+        return slots
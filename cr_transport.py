@@ -0,0 +1,219 @@
+import base64
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+from asyncio import get_event_loop
+from email.utils import formatdate
+from time import perf_counter
+from typing import Dict, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+from http_client import HttpClient, HttpError
+from metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+API_VERSION = "2016-06-07"
+
+# action: (method, uri pattern), the same as the aliyunsdkcr.request.v20160607 request classes.
+ROUTES: Dict[str, Tuple[str, str]] = {
+    "CreateRepo": ("PUT", "/repos"),
+    "DeleteRepo": ("DELETE", "/repos/[RepoNamespace]/[RepoName]"),
+    "GetRepoList": ("GET", "/repos"),
+    "GetRepoListByNamespace": ("GET", "/repos/[RepoNamespace]"),
+    "CreateRepoBuildRule": ("PUT", "/repos/[RepoNamespace]/[RepoName]/rules"),
+    "UpdateRepoBuildRule": ("POST", "/repos/[RepoNamespace]/[RepoName]/rules/[BuildRuleId]"),
+    "GetRepoBuildRuleList": ("GET", "/repos/[RepoNamespace]/[RepoName]/rules"),
+    "StartRepoBuildByRule": ("PUT", "/repos/[RepoNamespace]/[RepoName]/rules/[BuildRuleId]/build"),
+    "GetRepoTags": ("GET", "/repos/[RepoNamespace]/[RepoName]/tags"),
+    "GetRepoBuildList": ("GET", "/repos/[RepoNamespace]/[RepoName]/build"),
+}
+
+
+class CRServerError(Exception):
+    """
+    the Container Registry API answered with an error.
+    """
+
+    def __init__(self, http_status: int, code: str, message: str, request_id: str = None,
+                 action: str = None):
+        super().__init__(f"{action}: HTTP {http_status} {code}: {message} (RequestId: {request_id})")
+        self.http_status = http_status
+        self.code = code
+        self.message = message
+        self.request_id = request_id
+        self.action = action
+
+
+def parse_endpoint(endpoint: str) -> Tuple[str, str, int]:
+    """
+    :param endpoint: "host", "host:port" or "scheme://host:port"
+    :return: scheme, host, port
+    """
+    if "://" not in endpoint:
+        endpoint = f"http://{endpoint}"
+    parts = urlsplit(endpoint)
+    return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+def sign_headers(method: str,
+                 path: str,
+                 queries: Dict[str, str],
+                 headers: Dict[str, str],
+                 access_key: str,
+                 access_secret: str,
+                 ) -> Dict[str, str]:
+    """
+    ROA signature (HMAC-SHA1), as aliyunsdkcore's roa_signature_composer computes it.
+    :return: headers with Authorization added.
+    """
+    canonical_headers = "".join(
+        f"{k}:{v}\n" for k, v in sorted((k.lower(), v) for k, v in headers.items()
+                                        if k.lower().startswith("x-acs-"))
+    )
+    resource = path
+    if queries:
+        resource += "?" + "&".join(f"{k}={v}" for k, v in sorted(queries.items()))
+    string_to_sign = "\n".join([
+        method,
+        headers.get("Accept", ""),
+        headers.get("Content-MD5", ""),
+        headers.get("Content-Type", ""),
+        headers.get("Date", ""),
+    ]) + "\n" + canonical_headers + resource
+    digest = hmac.new(access_secret.encode(), string_to_sign.encode(), hashlib.sha1).digest()
+    signature = base64.b64encode(digest).decode()
+    return {**headers, "Authorization": f"acs {access_key}:{signature}"}
+
+
+class Transport:
+    """
+    sends a Request to the Container Registry API and returns the decoded json body.
+    """
+
+    def __init__(self, access_key: str, access_secret: str, region: str, endpoint: str = None):
+        self.access_key = access_key
+        self.access_secret = access_secret
+        self.region = region
+        self.endpoint = endpoint or f"cr.{region}.aliyuncs.com"
+
+    async def invoke(self, request) -> dict:
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class HttpTransport(Transport):
+    """
+    signs requests itself and sends them through a pooled asyncio HTTP client.
+    """
+
+    def __init__(self, access_key: str, access_secret: str, region: str, endpoint: str = None,
+                 max_connections: int = 32, timeout: float = 30):
+        super().__init__(access_key, access_secret, region, endpoint)
+        scheme, host, port = parse_endpoint(self.endpoint)
+        self.base_url = self.endpoint if "://" in self.endpoint else f"{scheme}://{self.endpoint}"
+        self.client = HttpClient(max_connections=max_connections, timeout=timeout)
+
+    async def invoke(self, request) -> dict:
+        method, uri_pattern = ROUTES[request.action]
+        path = url_path = uri_pattern
+        for k, v in request.path_param.items():
+            path = path.replace(f"[{k}]", str(v))
+            url_path = url_path.replace(f"[{k}]", quote(str(v), safe=""))
+        queries = {k: str(v) for k, v in request.query_param.items()}
+        queries.setdefault("RegionId", self.region)
+        body = json.dumps(request.data).encode()
+        headers = sign_headers(
+            method=method,
+            path=path,
+            queries=queries,
+            headers={
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+                "Content-MD5": base64.b64encode(hashlib.md5(body).digest()).decode(),
+                "Date": formatdate(usegmt=True),
+                "x-acs-action": request.action,
+                "x-acs-version": API_VERSION,
+                "x-acs-region-id": self.region,
+                "x-acs-signature-method": "HMAC-SHA1",
+                "x-acs-signature-version": "1.0",
+            },
+            access_key=self.access_key,
+            access_secret=self.access_secret,
+        )
+        url = f"{self.base_url}{url_path}?{urlencode(queries)}"
+        res = await self.client.request(method, url, headers=headers, body=body)
+        if res.status >= 400:
+            try:
+                error = json.loads(res.body)
+            except ValueError:
+                error = {}
+            raise CRServerError(
+                http_status=res.status,
+                code=error.get("code") or error.get("Code") or res.reason,
+                message=error.get("message") or error.get("Message")
+                or res.body[:200].decode(errors="replace"),
+                request_id=error.get("requestId") or error.get("RequestId"),
+                action=request.action,
+            )
+        return json.loads(res.body)
+
+    async def close(self):
+        await self.client.close()
+
+
+class ExecutorTransport(Transport):
+    """
+    the blocking aliyunsdkcore AcsClient, run on the default executor.
+    """
+
+    def __init__(self, access_key: str, access_secret: str, region: str, endpoint: str = None):
+        super().__init__(access_key, access_secret, region, endpoint)
+        from aliyunsdkcore.client import AcsClient
+        self.scheme, self.host, self.port = parse_endpoint(self.endpoint)
+        self.api = AcsClient(access_key, access_secret, region, port=self.port)
+
+    async def invoke(self, request) -> dict:
+        from aliyunsdkcore.acs_exception.exceptions import ClientException, ServerException
+        request_name = f"{request.action}Request"
+        module = importlib.import_module(f"aliyunsdkcr.request.v20160607.{request_name}")
+        sdk_request = getattr(module, request_name)()
+        sdk_request.set_protocol_type(self.scheme)
+        sdk_request.set_content_type("application/json")
+        sdk_request.set_endpoint(self.host)
+        for k, v in request.path_param.items():
+            sdk_request.add_path_param(k, v)
+        for k, v in request.query_param.items():
+            sdk_request.add_query_param(k, v)
+        sdk_request.set_content(json.dumps(request.data))
+        submitted = perf_counter()
+
+        def do_action():
+            metrics.observe("executor_queue", request.action, perf_counter() - submitted)
+            return self.api.do_action_with_exception(sdk_request)
+
+        try:
+            res = await get_event_loop().run_in_executor(None, do_action)
+        except ServerException as e:
+            raise CRServerError(
+                http_status=e.get_http_status(),
+                code=e.get_error_code(),
+                message=e.get_error_msg(),
+                request_id=e.get_request_id(),
+                action=request.action,
+            ) from e
+        except ClientException as e:
+            if e.get_error_code() == "SDK.HttpError":
+                raise HttpError(f"{request.action}: {e.get_error_msg()}") from e
+            raise
+        return json.loads(res)
+
+
+TRANSPORTS = {
+    "http": HttpTransport,
+    "executor": ExecutorTransport,
+}
@@ -0,0 +1,240 @@
+"""
+building blocks of `mirror-op.py serve`: a request batcher, a small HTTP/JSON endpoint and a
+JSONL file follower, all feeding image requests into the batcher.
+"""
+import asyncio
+import json
+import logging
+import os
+from http import HTTPStatus
+from time import monotonic
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+
+class Batcher:
+    """
+    coalesces image requests into batches, a batch is flushed `interval` seconds after its first
+    request or as soon as it holds `max_size` images, whichever comes first.
+    flushes run one at a time, requests arriving meanwhile go to the next batch.
+    """
+
+    def __init__(self,
+                 flush: Callable[[List[str]], Awaitable[Dict[str, str]]],
+                 interval: float = 5,
+                 max_size: int = 100,
+                 ):
+        """
+        :param flush: handles a batch, returns {image: status}.
+        """
+        self.flush = flush
+        self.interval = interval
+        self.max_size = max_size
+        # {image: [(future, requested at), ...]}
+        self.pending: Dict[str, List[Tuple[asyncio.Future, float]]] = {}
+        self.first: Optional[float] = None
+        self.flushing = 0
+        self.batches = 0
+        self._wakeup = asyncio.Event()
+        self._closed = False
+
+    def add(self, images: List[str]) -> asyncio.Future:
+        """
+        :return: future of {image: status}, set once the batch holding the images is flushed.
+        """
+        loop = asyncio.get_event_loop()
+        futures = []
+        now = monotonic()
+        for image in images:
+            future = loop.create_future()
+            self.pending.setdefault(image, []).append((future, now))
+            futures.append(future)
+        if self.first is None and self.pending:
+            self.first = now
+        self._wakeup.set()
+
+        async def results():
+            return dict(zip(images, await asyncio.gather(*futures)))
+
+        return asyncio.ensure_future(results())
+
+    def close(self):
+        """
+        flush what is pending and stop `run`.
+        """
+        self._closed = True
+        self._wakeup.set()
+
+    def _due(self) -> Optional[float]:
+        """
+        :return: seconds until the pending batch is due, None if nothing is pending.
+        """
+        if not self.pending:
+            return None
+        if self._closed or len(self.pending) >= self.max_size:
+            return 0
+        return max(0.0, self.first + self.interval - monotonic())
+
+    async def run(self):
+        while True:
+            due = self._due()
+            if due is None and self._closed:
+                return
+            if due != 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=due)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch, self.pending, self.first = self.pending, {}, None
+            await self._flush(batch)
+
+    async def _flush(self, batch: Dict[str, List[Tuple[asyncio.Future, float]]]):
+        images = list(batch)
+        self.flushing = len(images)
+        try:
+            results = await self.flush(images)
+        except Exception as e:
+            logger.exception(f"Failed to flush {len(images)} image(s)")
+            results = {image: f"error: {e}" for image in images}
+        finally:
+            self.flushing = 0
+        self.batches += 1
+        now = monotonic()
+        for image, waiters in batch.items():
+            for future, requested in waiters:
+                metrics.observe("serve", "request", now - requested)
+                if not future.done():
+                    future.set_result(results.get(image, "unknown"))
+
+    def status(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "flushing": self.flushing,
+            "batches": self.batches,
+            "next_flush_in": self._due(),
+        }
+
+
+class JsonServer:
+    """
+    minimal HTTP/1.1 server for a JSON API, one request per connection.
+    """
+
+    def __init__(self, route: Callable[[str, str, dict, object], Awaitable[Tuple[int, object]]]):
+        """
+        :param route: (method, path, query, json body) -> (http status, json response)
+        """
+        self.route = route
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        :return: the port listened on.
+        """
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                request_line = (await reader.readline()).decode("latin-1")
+                method, target, _ = request_line.split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                raw = await reader.readexactly(length) if length else b""
+                body = json.loads(raw) if raw else None
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                status, res = 400, {"error": f"bad request: {e}"}
+            else:
+                parts = urlsplit(target)
+                try:
+                    status, res = await self.route(method, parts.path, dict(parse_qsl(parts.query)), body)
+                except Exception as e:
+                    logger.exception(f"Failed to handle {method} {target}")
+                    status, res = 500, {"error": str(e)}
+            out = json.dumps(res).encode()
+            writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(out)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + out)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def parse_request_line(line: str) -> List[str]:
+    """
+    images of one line of a request stream: {"image": ...}, {"images": [...]}, a json string,
+    or a bare image reference.
+    """
+    line = line.strip()
+    if not line:
+        return []
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return [line]
+    if isinstance(data, str):
+        return [data]
+    if isinstance(data, dict):
+        images = data.get("images") or []
+        if data.get("image"):
+            images = [data["image"], *images]
+        return [i for i in images if isinstance(i, str)]
+    return []
+
+
+async def follow(path: str,
+                 on_images: Callable[[List[str]], None],
+                 from_start: bool = False,
+                 poll_interval: float = 1.0,
+                 ):
+    """
+    tail a JSONL file of image requests, see `parse_request_line`, forever.
+    a truncated or replaced file is read again from its start.
+    """
+    offset = None
+    inode = None
+    partial = ""
+    while True:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            await asyncio.sleep(poll_interval)
+            continue
+        if offset is None:
+            offset = 0 if from_start else st.st_size
+        elif st.st_ino != inode or st.st_size < offset:
+            logger.info(f"{path} was replaced or truncated, reading from start.")
+            offset, partial = 0, ""
+        inode = st.st_ino
+        if st.st_size > offset:
+            with open(path, "rt") as f:
+                f.seek(offset)
+                data = f.read()
+                offset = f.tell()
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+            images = [i for line in lines for i in parse_request_line(line)]
+            if images:
+                on_images(images)
+        await asyncio.sleep(poll_interval)
@@ -0,0 +1,10 @@
+"""
+defaults shared by the modules of the registry API and the options of mirror-op.py, kept free of
+imports so the offline commands can show them without loading the API modules.
+"""
+
+# build rules per repository of the Container Registry API, see RuleSlots.
+DEFAULT_RULE_LIMIT = 5
+
+# seconds `build` and `refresh` wait for idle build rules before giving up on the queued tags.
+DEFAULT_RULE_WAIT_TIMEOUT = 3600
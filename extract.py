@@ -0,0 +1,136 @@
+"""
+images referenced by yaml: helm output, k8s manifests, compose files, chart values.
+
+documents are parsed one at a time as the input is read, chunks that are not yaml (e.g. the
+notes of `helm install --dry-run --debug`) are scanned for `image:` lines instead.
+"""
+import logging
+import re
+import subprocess
+from typing import Iterable, Iterator, List, Sequence
+
+from image_ref import ImageRef, parse_image
+
+logger = logging.getLogger(__file__)
+
+_IMAGE_LINE = re.compile(r"""^\s*(?:-\s+)?["']?image["']?\s*:\s*["']?([^"'\s#]+)""")
+
+_loader = None
+
+
+def _yaml_loader():
+    """
+    a safe loader that keeps numbers as strings: `tag: 1.20` is "1.20", not 1.2.
+    pyyaml is imported on first use.
+    """
+    global _loader
+    if _loader is None:
+        import yaml
+        base = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+        class Loader(base):
+            pass
+
+        Loader.yaml_implicit_resolvers = {
+            first: [(tag, regexp) for tag, regexp in resolvers
+                    if tag not in ("tag:yaml.org,2002:int", "tag:yaml.org,2002:float")]
+            for first, resolvers in base.yaml_implicit_resolvers.items()
+        }
+        _loader = Loader
+    return _loader
+
+
+def split_documents(lines: Iterable[str]) -> Iterator[str]:
+    """
+    split a multi-document yaml stream at its `---` lines.
+    """
+    doc = []
+    for line in lines:
+        if line.startswith("---") and line[3:4] in ("", " ", "\t", "\r", "\n"):
+            if doc:
+                yield "".join(doc)
+            rest = line[3:].strip()
+            doc = [rest + "\n"] if rest and not rest.startswith("#") else []
+        else:
+            doc.append(line)
+    if doc:
+        yield "".join(doc)
+
+
+def _from_fields(node: dict):
+    """
+    helm values style: {registry: docker.io, repository: bitnami/nginx, tag: 1.25, digest: sha256:...}
+    """
+    repository = node.get("repository")
+    tag = node.get("tag")
+    digest = node.get("digest")
+    if not isinstance(repository, str) or not (tag or digest):
+        return None
+    registry = node.get("registry")
+    if isinstance(registry, str) and registry:
+        repository = f"{registry.rstrip('/')}/{repository}"
+    image = repository
+    if tag:
+        image += f":{tag}"
+    if digest:
+        image += f"@{digest}"
+    return image
+
+
+def images_in_node(node) -> Iterator[str]:
+    if isinstance(node, dict):
+        image = node.get("image")
+        if isinstance(image, str):
+            yield image
+        image = _from_fields(node)
+        if image is not None:
+            yield image
+        for value in node.values():
+            yield from images_in_node(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from images_in_node(value)
+
+
+def _images_in_document(doc: str) -> Iterator[str]:
+    import yaml
+    try:
+        nodes = list(yaml.load_all(doc, Loader=_yaml_loader()))
+    except yaml.YAMLError:
+        for line in doc.splitlines():
+            match = _IMAGE_LINE.match(line)
+            if match:
+                yield match.group(1)
+        return
+    for node in nodes:
+        yield from images_in_node(node)
+
+
+def images_in_text(lines: Iterable[str]) -> Iterator[ImageRef]:
+    """
+    yield the valid image references of a yaml stream, a document at a time.
+    """
+    for doc in split_documents(lines):
+        for image in _images_in_document(doc):
+            ref = parse_image(image)
+            if ref is None:
+                logger.debug(f"skipping invalid image reference: {image}")
+                continue
+            yield ref
+
+
+def extract_file(path: str) -> List[str]:
+    with open(path, "rt") as f:
+        return [str(ref) for ref in images_in_text(f)]
+
+
+def extract_chart(chart: str, helm_bin: str = "helm", helm_args: Sequence[str] = ()) -> List[str]:
+    """
+    render a chart with `helm template` and extract the images of its manifests.
+    """
+    args = [helm_bin, "template", chart, *helm_args]
+    with subprocess.Popen(args, stdout=subprocess.PIPE, text=True) as proc:
+        images = [str(ref) for ref in images_in_text(proc.stdout)]
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    return images
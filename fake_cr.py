@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+in-memory stand-in of the Container Registry API, for benchmarks and offline runs.
+
+serves the ROA routes used by AliyunCR (cr_transport.ROUTES), builds finish by themselves
+after `build_time` seconds.
+
+    python fake_cr.py --port 8080 --latency 0.02
+    python mirror-op.py check --api-endpoint 127.0.0.1:8080 ...
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Dict, List
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import click
+
+from cr_transport import ROUTES
+
+
+@dataclass()
+class FakeBuild:
+    id: str
+    tag: str
+    started: float
+
+
+@dataclass()
+class FakeRepo:
+    id: int
+    name: str
+    namespace: str
+    created: float
+    rules: Dict[int, dict] = field(default_factory=dict)
+    tags: Dict[str, float] = field(default_factory=dict)
+    builds: List[FakeBuild] = field(default_factory=list)
+
+
+class FakeError(Exception):
+
+    def __init__(self, status: int, code: str, message: str):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def _compile_routes():
+    routes = []
+    for action, (method, pattern) in ROUTES.items():
+        regex = re.sub(r"\\\[(\w+)\\]", r"(?P<\1>[^/]+)", re.escape(pattern))
+        routes.append((method, re.compile(f"^{regex}$"), action))
+    return routes
+
+
+class FakeCR:
+    """
+    :param latency: seconds added to every call.
+    :param error_rate: probability of a call failing with HTTP 500.
+    :param qps: server side rate limit, calls above it fail with 503 Throttling.User. 0 for no limit.
+    :param rule_limit: build rules per repo.
+    :param build_time: seconds from a triggered build to its tag, a quarter of it is spent pending.
+    :param build_fail_rate: probability of a build failing.
+    """
+
+    def __init__(self,
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 qps: float = 0,
+                 rule_limit: int = 5,
+                 build_time: float = 5.0,
+                 build_fail_rate: float = 0.0,
+                 ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.qps = qps
+        self.rule_limit = rule_limit
+        self.build_time = build_time
+        self.build_fail_rate = build_fail_rate
+
+        self.repos: Dict[tuple, FakeRepo] = {}
+        self.calls = Counter()
+        self.errors = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._failed_builds = set()
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        self._tokens = qps
+        self._updated = time.monotonic()
+        self._routes = _compile_routes()
+
+    # state
+
+    def add_repo(self, namespace: str, name: str, tags=(), created: float = None) -> FakeRepo:
+        repo = FakeRepo(id=next(self._ids), name=name, namespace=namespace,
+                        created=time.time() if created is None else created)
+        for tag in tags:
+            repo.tags[tag] = repo.created
+        self.repos[(namespace, name)] = repo
+        return repo
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.max_in_flight = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "total_calls": sum(self.calls.values()),
+                "max_in_flight": self.max_in_flight,
+                "repos": len(self.repos),
+            }
+
+    def _build_status(self, repo: FakeRepo, build: FakeBuild) -> str:
+        elapsed = time.time() - build.started
+        if elapsed < self.build_time / 4:
+            return "PENDING"
+        if elapsed < self.build_time:
+            return "BUILDING"
+        if build.id in self._failed_builds:
+            return "FAILED"
+        repo.tags.setdefault(build.tag, build.started + self.build_time)
+        return "SUCCESS"
+
+    def _repo(self, params: dict) -> FakeRepo:
+        repo = self.repos.get((params["RepoNamespace"], params["RepoName"]))
+        if repo is None:
+            raise FakeError(404, "REPO_NOT_EXIST", "repo not exist.")
+        return repo
+
+    def _rule(self, repo: FakeRepo, params: dict) -> dict:
+        rule = repo.rules.get(int(params["BuildRuleId"]))
+        if rule is None:
+            raise FakeError(404, "BUILD_RULE_NOT_EXIST", "build rule not exist.")
+        return rule
+
+    @staticmethod
+    def _page(items: list, query: dict, key: str) -> dict:
+        page = int(query.get("Page", 1))
+        page_size = int(query.get("PageSize", 30))
+        return {
+            key: items[(page - 1) * page_size:page * page_size],
+            "total": len(items),
+            "page": page,
+            "pageSize": page_size,
+        }
+
+    @staticmethod
+    def _repo_json(repo: FakeRepo) -> dict:
+        return {
+            "repoId": repo.id,
+            "repoName": repo.name,
+            "repoNamespace": repo.namespace,
+            "gmtCreate": int(repo.created * 1000),
+            "gmtModified": int(max([repo.created, *repo.tags.values()]) * 1000),
+        }
+
+    # actions, called with self._lock held
+
+    def GetRepoList(self, params, query, body):
+        repos = sorted(self.repos.values(), key=lambda r: r.id)
+        return self._page([self._repo_json(r) for r in repos], query, "repos")
+
+    def GetRepoListByNamespace(self, params, query, body):
+        repos = sorted((r for r in self.repos.values() if r.namespace == params["RepoNamespace"]),
+                       key=lambda r: r.id)
+        return self._page([self._repo_json(r) for r in repos], query, "repos")
+
+    def CreateRepo(self, params, query, body):
+        namespace = body["Repo"]["RepoNamespace"]
+        name = body["Repo"]["RepoName"]
+        if (namespace, name) in self.repos:
+            raise FakeError(400, "REPO_IS_EXIST", "repo already exist.")
+        return {"repoId": self.add_repo(namespace, name).id}
+
+    def DeleteRepo(self, params, query, body):
+        repo = self._repo(params)
+        del self.repos[(repo.namespace, repo.name)]
+        return {}
+
+    def GetRepoBuildRuleList(self, params, query, body):
+        repo = self._repo(params)
+        return {"buildRules": list(repo.rules.values())}
+
+    def CreateRepoBuildRule(self, params, query, body):
+        repo = self._repo(params)
+        if len(repo.rules) >= self.rule_limit:
+            raise FakeError(400, "BUILD_RULE_LIMIT_EXCEEDED", "build rule count exceeds the limit.")
+        rule_id = next(self._ids)
+        rule = body["BuildRule"]
+        repo.rules[rule_id] = {
+            "buildRuleId": rule_id,
+            "imageTag": rule["ImageTag"],
+            "dockerfileLocation": rule["DockerfileLocation"],
+        }
+        return {"buildRuleId": rule_id}
+
+    def UpdateRepoBuildRule(self, params, query, body):
+        rule = self._rule(self._repo(params), params)
+        rule["imageTag"] = body["BuildRule"]["ImageTag"]
+        rule["dockerfileLocation"] = body["BuildRule"]["DockerfileLocation"]
+        return {}
+
+    def StartRepoBuildByRule(self, params, query, body):
+        repo = self._repo(params)
+        rule = self._rule(repo, params)
+        build = FakeBuild(id=str(next(self._ids)), tag=rule["imageTag"], started=time.time())
+        if random.random() < self.build_fail_rate:
+            self._failed_builds.add(build.id)
+        repo.builds.insert(0, build)
+        return {"buildId": build.id}
+
+    def GetRepoTags(self, params, query, body):
+        repo = self._repo(params)
+        for build in repo.builds:
+            self._build_status(repo, build)
+        return self._page([{"tag": t} for t in repo.tags], query, "tags")
+
+    def GetRepoBuildList(self, params, query, body):
+        repo = self._repo(params)
+        builds = [{
+            "buildId": b.id,
+            "buildStatus": self._build_status(repo, b),
+            "image": {"tag": b.tag},
+        } for b in repo.builds]
+        return self._page(builds, query, "builds")
+
+    # transport
+
+    def _throttled(self) -> bool:
+        if not self.qps:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.qps, self._tokens + (now - self._updated) * self.qps)
+        self._updated = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def handle(self, method: str, path: str, query: dict, body: dict):
+        """
+        :return: http status, json body
+        """
+        for route_method, regex, action in self._routes:
+            match = regex.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {"code": "NOT_FOUND", "message": f"no route for {method} {path}"}
+        params = {k: unquote(v) for k, v in match.groupdict().items()}
+
+        with self._lock:
+            self.calls[action] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            throttled = self._throttled()
+        try:
+            if self.latency:
+                time.sleep(self.latency * random.uniform(0.5, 1.5))
+            with self._lock:
+                if throttled:
+                    raise FakeError(503, "Throttling.User", "Request was denied due to user flow control.")
+                if random.random() < self.error_rate:
+                    raise FakeError(500, "InternalError", "injected error.")
+                data = getattr(self, action)(params, query, body)
+            return 200, {"data": data}
+        except FakeError as e:
+            with self._lock:
+                self.errors[e.code] += 1
+            return e.status, {"code": e.code, "message": e.message, "requestId": "fake"}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        """
+        start serving in a daemon thread.
+        :return: the server, its port is server.server_port.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length) if length else b""
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+                parts = urlsplit(self.path)
+                status, res = fake.handle(self.command, parts.path, dict(parse_qsl(parts.query)), body)
+                out = json.dumps(res).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=8080)
+@click.option("--latency", type=float, default=0.0)
+@click.option("--error-rate", type=float, default=0.0)
+@click.option("--qps", type=float, default=0)
+@click.option("--rule-limit", type=int, default=5)
+@click.option("--build-time", type=float, default=5.0)
+@click.option("--build-fail-rate", type=float, default=0.0)
+def main(host: str, port: int, **kwargs):
+    server = FakeCR(**kwargs).serve(host, port)
+    print(f"fake Container Registry API on http://{host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+in-memory stand-in of a docker registry (HTTP API v2), for tests and offline runs of refresh and
+build --backend copy.
+
+serves and accepts manifests and blobs, blobs are linked to the repositories they were pushed
+or mounted to. optional bearer token auth like docker hub's, optional redirects of blob
+downloads to a storage url.
+
+    python fake_registry.py --port 5000 --image library/nginx:latest
+    python mirror-op.py refresh --registry-endpoint docker.io=http://127.0.0.1:5000 ...
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import click
+
+MANIFEST_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+
+_ROUTE = re.compile(r"^/v2/(?P<name>.+)/(?P<kind>manifests|blobs)/(?P<reference>[^/]+)$")
+_UPLOAD = re.compile(r"^/v2/(?P<name>.+)/blobs/uploads/(?P<upload>[^/]*)$")
+_STORAGE = re.compile(r"^/storage/(?P<digest>[^/]+)$")
+
+
+def digest_of(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+class FakeRegistry:
+    """
+    :param token_auth: ask for a bearer token of the repository scope, from <server>/token.
+    :param latency: seconds added to every request.
+    :param redirect_blobs: answer blob downloads with a redirect to <server>/storage/<digest>.
+    :param broken_uploads: the next blob uploads that lose their connection half-way through.
+    """
+
+    def __init__(self, token_auth: bool = False, latency: float = 0.0, redirect_blobs: bool = False,
+                 broken_uploads: int = 0):
+        self.token_auth = token_auth
+        self.latency = latency
+        self.redirect_blobs = redirect_blobs
+        self.broken_uploads = broken_uploads
+        self.blobs: Dict[str, bytes] = {}
+        # {repository: digests of the blobs linked to it}
+        self.links: Dict[str, Set[str]] = {}
+        # {repository: {tag or digest: manifest digest}}
+        self.refs: Dict[str, Dict[str, str]] = {}
+        self.manifests: Dict[str, bytes] = {}
+        # {manifest digest: media type}
+        self.media_types: Dict[str, str] = {}
+        # {upload id: repository}
+        self.uploads: Dict[str, str] = {}
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+        self.url = None
+        self._lock = threading.Lock()
+
+    # state
+
+    def push(self, name: str, tag: str, layers: List[bytes] = (), config: bytes = b"{}") -> str:
+        """
+        store an image of the given layers under `name:tag`.
+        :return: digest of its manifest.
+        """
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MANIFEST_TYPE,
+            "config": {"mediaType": "application/vnd.docker.container.image.v1+json",
+                       "size": len(config), "digest": digest_of(config)},
+            "layers": [{"mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                        "size": len(layer), "digest": digest_of(layer)} for layer in layers],
+        }
+        with self._lock:
+            for blob in (config, *layers):
+                self.blobs[digest_of(blob)] = blob
+                self.links.setdefault(name, set()).add(digest_of(blob))
+        return self.put_manifest(name, tag, json.dumps(manifest).encode(), MANIFEST_TYPE)
+
+    def put_manifest(self, name: str, reference: str, data: bytes, media_type: str) -> str:
+        digest = digest_of(data)
+        with self._lock:
+            self.manifests[digest] = data
+            self.media_types[digest] = media_type
+            refs = self.refs.setdefault(name, {})
+            refs[reference] = digest
+            refs[digest] = digest
+        return digest
+
+    def _break_upload(self) -> bool:
+        with self._lock:
+            if self.broken_uploads <= 0:
+                return False
+            self.broken_uploads -= 1
+            self.calls["broken uploads"] += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.calls), "total_calls": sum(self.calls.values()),
+                    "uploaded_bytes": self.uploaded_bytes}
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.uploaded_bytes = 0
+
+    # api
+
+    def _authorized(self, headers, names: List[str]) -> bool:
+        if not self.token_auth:
+            return True
+        auth = headers.get("Authorization") or ""
+        if not auth.startswith("Bearer token:"):
+            return False
+        granted = auth[len("Bearer token:"):].split(",")
+        return all(name in granted for name in names)
+
+    def _unauthorized(self, names: List[str]) -> Tuple[int, Dict[str, str], bytes]:
+        scope = " ".join(f"repository:{name}:pull,push" for name in names)
+        return 401, {
+            "WWW-Authenticate": f'Bearer realm="{self.url}/token",service="fake-registry",'
+                                f'scope="{scope}"',
+        }, b'{"errors": [{"code": "UNAUTHORIZED", "message": "authentication required"}]}'
+
+    @staticmethod
+    def _error(status: int, code: str, message: str) -> Tuple[int, Dict[str, str], bytes]:
+        return status, {}, json.dumps({"errors": [{"code": code, "message": message}]}).encode()
+
+    def handle(self, method: str, path: str, query: dict, headers,
+               body: bytes = b"") -> Tuple[int, Dict[str, str], bytes]:
+        if self.latency:
+            time.sleep(self.latency)
+        if path == "/token":
+            with self._lock:
+                self.calls["token"] += 1
+            names = [scope.split(":")[1] for scope in query.get("scope", [])]
+            return 200, {"Content-Type": "application/json"}, \
+                json.dumps({"token": "token:" + ",".join(names), "expires_in": 300}).encode()
+        if path == "/v2/":
+            return 200, {}, b"{}"
+        match = _STORAGE.match(path)
+        if match is not None:
+            with self._lock:
+                self.calls[f"{method} storage"] += 1
+                data = self.blobs.get(match.group("digest"))
+            if data is None:
+                return self._error(404, "BLOB_UNKNOWN", match.group("digest"))
+            return 200, {"Content-Type": "application/octet-stream"}, data
+        match = _UPLOAD.match(path)
+        if match is not None:
+            return self._upload(method, match.group("name"), match.group("upload"), query, headers, body)
+        match = _ROUTE.match(path)
+        if match is None:
+            return self._error(404, "NOT_FOUND", "no such route")
+        name, kind, reference = match.group("name", "kind", "reference")
+        with self._lock:
+            self.calls[f"{method} {kind}"] += 1
+        if not self._authorized(headers, [name]):
+            return self._unauthorized([name])
+        if kind == "manifests" and method == "PUT":
+            content_type = headers.get("Content-Type") or MANIFEST_TYPE
+            digest = self.put_manifest(name, reference, body, content_type)
+            return 201, {"Docker-Content-Digest": digest, "Location": f"/v2/{name}/manifests/{digest}"}, b""
+        with self._lock:
+            if kind == "manifests":
+                digest = self.refs.get(name, {}).get(reference)
+                data = self.manifests.get(digest)
+                content_type = self.media_types.get(digest, MANIFEST_TYPE)
+            else:
+                digest = reference
+                data = self.blobs.get(digest) if digest in self.links.get(name, ()) else None
+                content_type = "application/octet-stream"
+        if data is None:
+            code = "MANIFEST_UNKNOWN" if kind == "manifests" else "BLOB_UNKNOWN"
+            return self._error(404, code, reference)
+        if kind == "blobs" and method == "GET" and self.redirect_blobs:
+            return 307, {"Location": f"{self.url}/storage/{digest}"}, b""
+        return 200, {"Content-Type": content_type, "Docker-Content-Digest": digest}, data
+
+    def _upload(self, method: str, name: str, upload: str, query: dict, headers, body: bytes):
+        with self._lock:
+            self.calls[f"{method} uploads"] += 1
+        mount_from = query.get("from", [None])[0] if method == "POST" else None
+        if not self._authorized(headers, [name] + ([mount_from] if mount_from else [])):
+            return self._unauthorized([name] + ([mount_from] if mount_from else []))
+        if method == "POST":
+            digest = query.get("mount", [None])[0]
+            with self._lock:
+                if digest and digest in self.links.get(mount_from, ()):
+                    self.calls["mounted"] += 1
+                    self.links.setdefault(name, set()).add(digest)
+                    return 201, {"Location": f"/v2/{name}/blobs/{digest}",
+                                 "Docker-Content-Digest": digest}, b""
+                upload = uuid.uuid4().hex
+                self.uploads[upload] = name
+            return 202, {"Location": f"/v2/{name}/blobs/uploads/{upload}?_state=x",
+                         "Docker-Upload-UUID": upload}, b""
+        if method == "PUT":
+            digest = query.get("digest", [None])[0]
+            with self._lock:
+                if self.uploads.pop(upload, None) != name:
+                    return self._error(404, "BLOB_UPLOAD_UNKNOWN", upload)
+            if digest != digest_of(body):
+                return self._error(400, "DIGEST_INVALID", f"{digest} != {digest_of(body)}")
+            with self._lock:
+                self.blobs[digest] = body
+                self.links.setdefault(name, set()).add(digest)
+                self.uploaded_bytes += len(body)
+            return 201, {"Location": f"/v2/{name}/blobs/{digest}", "Docker-Content-Digest": digest}, b""
+        return self._error(405, "UNSUPPORTED", method)
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+        """
+        start serving in a daemon thread.
+        :return: the server, its port is server.server_port.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0))
+                parts = urlsplit(self.path)
+                if self.command == "PUT" and _UPLOAD.match(parts.path) and fake._break_upload():
+                    self.rfile.read(length // 2)
+                    self.close_connection = True
+                    return
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    raw = self._read_chunked()
+                else:
+                    raw = self.rfile.read(length) if length else b""
+                status, headers, body = fake.handle(self.command, parts.path,
+                                                    parse_qs(parts.query), self.headers, raw)
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _read_chunked(self) -> bytes:
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    if size == 0:
+                        while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                            pass
+                        return b"".join(chunks)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+            do_GET = do_HEAD = do_POST = do_PUT = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        self.url = f"http://{host}:{server.server_port}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", type=int, default=5000)
+@click.option("--latency", type=float, default=0.0)
+@click.option("--token-auth/--no-auth", "token_auth", default=False)
+@click.option("--image", "images", multiple=True, help="<repository>:<tag> to serve, repeatable.")
+def main(host: str, port: int, images=(), **kwargs):
+    fake = FakeRegistry(**kwargs)
+    for image in images:
+        name, _, tag = image.rpartition(":")
+        fake.push(name, tag, layers=[image.encode()])
+    server = fake.serve(host, port)
+    print(f"fake registry on {fake.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 
-# input : helm install ... --debug --dry-run
-# output: image:tag
-grep -P "image: .*:.*"|cut -d ':' -f2,3|tr -d '" '
+# input : helm install ... --debug --dry-run, helm template ..., or k8s manifests
+# output: image:tag, images already in the local mirror repo are skipped
+my_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+python $my_dir/mirror-op.py --log-level WARNING extract - $@
@@ -1,5 +1,11 @@
+import hashlib
+import logging
 import subprocess
-from typing import Mapping
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from metrics import metrics
+
+logger = logging.getLogger(__file__)
 
 
 class Git:
@@ -13,8 +19,10 @@ class Git:
         self.cwd = cwd
         self.env = env
 
-    def add(self, filepath: str, check: bool = True):
-        return self._execute("add", filepath, check=check)
+    def add(self, *filepaths: str, check: bool = True):
+        # paths go through stdin, a large batch would overflow the command line.
+        return self._execute("add", "--pathspec-from-file=-", "--pathspec-file-nul",
+                             input="\0".join(filepaths), check=check)
 
     def commit(self, message: str, check: bool = True):
         return self._execute("commit", "-m", message, check=check)
@@ -22,13 +30,147 @@ class Git:
     def push(self, check: bool = True):
         return self._execute("push", check=check)
 
+    def push_ref(self, ref: str, check: bool = True):
+        """
+        push a branch to its remote, origin if it has none, e.g. from a bare clone without upstreams.
+        """
+        remote = self._execute("config", f"branch.{_branch(ref)}.remote", capture_output=True,
+                               check=False).stdout.strip() or "origin"
+        return self._execute("push", remote, f"{ref}:{ref}", check=check)
+
     def tag(self, check: bool = True):
         return self._execute("tag", check=check)
 
-    def _execute(self, *args, check: bool = True):
-        subprocess.run(
-            [self.git_bin, *args],
-            cwd=self.cwd,
-            env=self.env,
-            check=check,
-        )
+    def rev_parse(self, rev: str = 'HEAD') -> str:
+        return self._execute("rev-parse", "--verify", f"{rev}^{{commit}}",
+                             capture_output=True).stdout.strip()
+
+    def symbolic_ref(self, name: str = 'HEAD') -> str:
+        return self._execute("symbolic-ref", "-q", name, capture_output=True).stdout.strip()
+
+    def is_bare(self) -> bool:
+        return self._execute("rev-parse", "--is-bare-repository",
+                             capture_output=True).stdout.strip() == "true"
+
+    def changed_files(self, files: Mapping[str, str], rev: str = 'HEAD') -> Dict[str, str]:
+        """
+        :param files: {path: content}
+        :return: the files whose content differs from, or is missing in, the tree of `rev`.
+        """
+        res = self._execute("cat-file", "--batch-check", capture_output=True, check=False,
+                            input=_batch_check_input(files, rev))
+        return _changed_files(files, res.returncode, res.stdout)
+
+    def commit_files(self, files: Mapping[str, str], message: str, ref: str = None) -> str:
+        """
+        commit `files` ({path: content}) on top of `ref` with fast-import: blobs, trees and the
+        commit are written straight to the object store, the working tree and index are not
+        touched, so it works in a bare clone. other files of the parent commit are kept.
+        the ref is only moved forward, a concurrent update of it fails the commit.
+        :param ref: the branch to commit to, defaults to the one HEAD points at.
+        :return: id of the new commit.
+        """
+        if ref is None:
+            ref = self.symbolic_ref()
+        try:
+            parent = self.rev_parse(ref)
+        except subprocess.CalledProcessError:
+            parent = None
+        author = self._execute("var", "GIT_AUTHOR_IDENT", capture_output=True).stdout.strip()
+        committer = self._execute("var", "GIT_COMMITTER_IDENT", capture_output=True).stdout.strip()
+        self._execute("fast-import", "--quiet", "--done",
+                      input=_fast_import_stream(ref, parent, author, committer, message, files))
+        return self.rev_parse(ref)
+
+    def update_worktree(self, old: Optional[str], new: str):
+        """
+        bring the index and working tree from commit `old` to `new` after `commit_files` moved
+        the checked out branch, only the paths changed between them are written.
+        """
+        if old is None:
+            return self._execute("read-tree", "-m", "-u", new)
+        return self._execute("read-tree", "-m", "-u", old, new)
+
+    def diff_name_status(self, since: str, until: str = 'HEAD') -> List[Tuple[str, str]]:
+        """
+        :return: [(status, path), ...], status is one of A(added), M(modified), D(deleted), ...
+        """
+        res = self._execute("diff", "--name-status", "--no-renames", "-z", since, until,
+                            capture_output=True)
+        fields = res.stdout.split("\0")[:-1]
+        return list(zip(fields[0::2], fields[1::2]))
+
+    def _execute(self, *args, check: bool = True, capture_output: bool = False, input: str = None):
+        with metrics.track("git", args[0]):
+            return subprocess.run(
+                [self.git_bin, *args],
+                cwd=self.cwd,
+                env=self.env,
+                check=check,
+                capture_output=capture_output,
+                input=input,
+                text=capture_output or input is not None,
+            )
+
+
+def _branch(ref: str) -> str:
+    return ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref
+
+
+def _batch_check_input(files: Mapping[str, str], rev: str) -> str:
+    # "<rev>:<path>" -> "<oid> blob <size>" or "<rev>:<path> missing".
+    return "".join(f"{rev}:{path}\n" for path in files)
+
+
+def _changed_files(files: Mapping[str, str], returncode: int, stdout: str) -> Dict[str, str]:
+    lines = stdout.splitlines()
+    if returncode or len(lines) != len(files):
+        return dict(files)
+    changed = {}
+    for (path, content), line in zip(files.items(), lines):
+        oid, _, kind = line.partition(" ")
+        if not kind.startswith("blob ") or oid != _blob_id(content, len(oid)):
+            changed[path] = content
+    return changed
+
+
+def _fast_import_stream(ref: str, parent: Optional[str], author: str, committer: str,
+                        message: str, files: Mapping[str, str]) -> str:
+    stream = [
+        f"commit {ref}\n",
+        f"author {author}\n",
+        f"committer {committer}\n",
+        _data(message),
+    ]
+    if parent is not None:
+        stream.append(f"from {parent}\n")
+    for path, content in files.items():
+        stream.append(f"M 100644 inline {_quote_path(path)}\n")
+        stream.append(_data(content))
+    stream.append("\ndone\n")
+    return "".join(stream)
+
+
+def _data(content: str) -> str:
+    """
+    a fast-import data command, its length counts bytes.
+    """
+    return f"data {len(content.encode())}\n{content}\n"
+
+
+def _quote_path(path: str) -> str:
+    if not any(c in path for c in '"\\\n') and not path.startswith(" "):
+        return path
+    escaped = path.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _blob_id(content: str, length: int) -> str:
+    """
+    the object id git gives `content` as a blob, sha256 for repos with 64 hex digit ids.
+    """
+    data = content.encode()
+    h = hashlib.sha256() if length == 64 else hashlib.sha1()
+    h.update(f"blob {len(data)}\0".encode())
+    h.update(data)
+    return h.hexdigest()
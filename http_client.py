@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import ssl
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterable, AsyncIterator, Dict, List, Mapping, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__file__)
+
+
+class HttpError(Exception):
+    """
+    the connection failed or the server sent something that is not HTTP/1.1.
+    """
+
+
+class ConnectError(HttpError):
+    """
+    no connection to the server could be made, the request was never sent.
+    """
+
+
+@dataclass()
+class HttpResponse:
+    status: int
+    reason: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    body: bytes = b''
+    # the body of a `stream` response, read as it arrives.
+    chunks: Optional[AsyncIterator[bytes]] = field(default=None, repr=False)
+
+
+Body = Union[bytes, AsyncIterable[bytes], None]
+
+
+@dataclass()
+class _Connection:
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    reused: bool = False
+    # the last response was read to its end, the connection can take another request.
+    done: bool = False
+
+    def close(self):
+        self.writer.close()
+
+
+class HttpClient:
+    """
+    minimal asyncio HTTP/1.1 client with keep-alive connection pooling.
+
+    at most `max_connections` connections are opened to every host, idle connections are kept
+    for the next request to the same host.
+    """
+
+    def __init__(self,
+                 max_connections: int = 32,
+                 timeout: float = 30,
+                 ssl_context: ssl.SSLContext = None,
+                 ):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._idle: Dict[Tuple[str, str, int], List[_Connection]] = defaultdict(list)
+        self._slots: Dict[Tuple[str, str, int], asyncio.Semaphore] = {}
+
+    async def request(self,
+                      method: str,
+                      url: str,
+                      headers: Mapping[str, str] = None,
+                      body: Body = None,
+                      ) -> HttpResponse:
+        """
+        :param body: bytes, or an async iterable of chunks that is sent as it is produced, with
+                     the Content-Length of `headers` if there is one, chunked otherwise.
+                     a streamed request has no overall timeout and isn't resent on a stale connection.
+        """
+        async with self._exchange(method, url, headers, body) as (_, res):
+            return res
+
+    @asynccontextmanager
+    async def stream(self,
+                     method: str,
+                     url: str,
+                     headers: Mapping[str, str] = None,
+                     chunk_size: int = 1 << 20,
+                     ) -> AsyncIterator[HttpResponse]:
+        """
+        send a request and read the response head only, the body is read from `res.chunks`.
+        the connection goes back to the pool if the body is read to its end, else it is closed.
+        """
+        async with self._exchange(method, url, headers, None, stream=True) as (conn, res):
+            res.chunks = self._iter_body(conn, method, res, chunk_size)
+            yield res
+
+    @asynccontextmanager
+    async def _exchange(self, method: str, url: str, headers: Optional[Mapping[str, str]], body: Body,
+                        stream: bool = False):
+        """
+        send a request and read its response head, then yield (connection, response).
+        the connection is pooled again if the response was read completely.
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        streamed_body = body is not None and not isinstance(body, (bytes, bytearray))
+
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self.max_connections)
+        async with slots:
+            while True:
+                conn = await self._connect(key)
+                try:
+                    send = self._send(conn, method, host, target, headers or {}, body)
+                    res = await (send if streamed_body else asyncio.wait_for(send, self.timeout))
+                except ConnectionError as e:
+                    conn.close()
+                    if conn.reused and not streamed_body:
+                        # the server closed an idle connection, retry on a fresh one.
+                        logger.debug(f"stale connection to {host}: {e!r}, reconnecting")
+                        continue
+                    raise HttpError(f"{method} {url}: {e!r}") from e
+                except (asyncio.IncompleteReadError, HttpError) as e:
+                    conn.close()
+                    raise HttpError(f"{method} {url}: {e!r}") from e
+                except BaseException:
+                    conn.close()
+                    raise
+                break
+            try:
+                if stream:
+                    yield conn, res
+                else:
+                    yield conn, await self._finish(conn, method, url, res)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                raise HttpError(f"{method} {url}: {e!r}") from e
+            except BaseException:
+                conn.close()
+                raise
+            if not conn.done or res.headers.get("connection", "").lower() == "close":
+                conn.close()
+            else:
+                conn.reused = True
+                conn.done = False
+                self._idle[key].append(conn)
+
+    async def _finish(self, conn: _Connection, method: str, url: str, res: HttpResponse):
+        try:
+            res.body = await asyncio.wait_for(self._read_body(conn, method, res), self.timeout)
+        except (asyncio.IncompleteReadError, HttpError) as e:
+            raise HttpError(f"{method} {url}: {e!r}") from e
+        return res
+
+    async def _connect(self, key: Tuple[str, str, int]) -> _Connection:
+        idle = self._idle[key]
+        while idle:
+            conn = idle.pop()
+            if not conn.reader.at_eof() and not conn.writer.is_closing():
+                return conn
+            conn.close()
+        scheme, hostname, port = key
+        context = None
+        if scheme == "https":
+            context = self.ssl_context or ssl.create_default_context()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(hostname, port, ssl=context),
+                self.timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectError(f"can't connect to {hostname}:{port}: {e!r}") from e
+        return _Connection(reader=reader, writer=writer)
+
+    @staticmethod
+    async def _send(conn: _Connection,
+                    method: str,
+                    host: str,
+                    target: str,
+                    headers: Mapping[str, str],
+                    body: Body,
+                    ) -> HttpResponse:
+        """
+        send the request and read the head of the response.
+        """
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        streamed = body is not None and not isinstance(body, (bytes, bytearray))
+        has_length = any(k.lower() == "content-length" for k in headers)
+        chunked = streamed and not has_length
+        if chunked:
+            lines.append("Transfer-Encoding: chunked")
+        elif not has_length and (body is not None or method in ("POST", "PUT", "PATCH")):
+            lines.append(f"Content-Length: {len(body or b'')}")
+        conn.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if streamed:
+            async for chunk in body:
+                if not chunk:
+                    continue
+                conn.writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n" if chunked else chunk)
+                await conn.writer.drain()
+            if chunked:
+                conn.writer.write(b"0\r\n\r\n")
+        elif body:
+            conn.writer.write(body)
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before response")
+        fields = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        try:
+            status = int(fields[1])
+        except (IndexError, ValueError):
+            raise HttpError(f"malformed status line: {status_line!r}")
+        res = HttpResponse(status=status, reason=fields[2] if len(fields) > 2 else "")
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.decode("latin-1").partition(":")
+            res.headers[k.strip().lower()] = v.strip()
+        return res
+
+    @staticmethod
+    def _has_body(method: str, res: HttpResponse) -> bool:
+        return not (method == "HEAD" or res.status in (204, 304) or 100 <= res.status < 200)
+
+    async def _read_body(self, conn: _Connection, method: str, res: HttpResponse) -> bytes:
+        if not self._has_body(method, res):
+            conn.done = True
+            return b""
+        if res.headers.get("transfer-encoding", "").lower() != "chunked" and "content-length" in res.headers:
+            body = await conn.reader.readexactly(int(res.headers["content-length"]))
+            conn.done = True
+            return body
+        return b"".join([chunk async for chunk in self._iter_body(conn, method, res)])
+
+    async def _iter_body(self, conn: _Connection, method: str, res: HttpResponse,
+                         chunk_size: int = 1 << 20) -> AsyncIterator[bytes]:
+        """
+        the body of a response as it arrives, `conn.done` is set once it is read to its end.
+        """
+        if not self._has_body(method, res):
+            conn.done = True
+            return
+        reader = conn.reader
+        if res.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                while size:
+                    chunk = await reader.readexactly(min(size, chunk_size))
+                    size -= len(chunk)
+                    yield chunk
+                await reader.readexactly(2)
+        elif "content-length" in res.headers:
+            left = int(res.headers["content-length"])
+            while left:
+                chunk = await reader.read(min(left, chunk_size))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", left)
+                left -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await reader.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            res.headers["connection"] = "close"
+        conn.done = True
+
+    async def close(self):
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle.clear()
@@ -0,0 +1,80 @@
+import re
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# docker reference grammar, loosely: [registry[:port]/]path[:tag][@digest]
+_REFERENCE = re.compile(
+    r"^(?P<repository>(?:[a-zA-Z0-9.-]+(?::[0-9]+)?/)?"
+    r"[a-z0-9]+(?:[._-]+[a-z0-9]+)*(?:/[a-z0-9]+(?:[._-]+[a-z0-9]+)*)*)"
+    r"(?::(?P<tag>\w[\w.-]{0,127}))?"
+    r"(?:@(?P<digest>sha256:[0-9a-fA-F]{64}))?$"
+)
+
+
+@dataclass(frozen=True)
+class ImageRef:
+    # with the registry, e.g. "quay.io:443/coreos/etcd"
+    repository: str
+    tag: Optional[str] = None
+    # "sha256:<hex>"
+    digest: Optional[str] = None
+
+    def __str__(self):
+        s = self.repository
+        if self.tag:
+            s += f":{self.tag}"
+        if self.digest:
+            s += f"@{self.digest}"
+        return s
+
+    @property
+    def mirror_tag(self) -> str:
+        """
+        tag of the mirror, "sha256-<hex>" for a digest, tags can't contain ':'.
+        """
+        if self.digest:
+            return self.digest.replace(":", "-")
+        return self.tag or "latest"
+
+
+def split_image(image: str) -> ImageRef:
+    """
+    split an image reference without validating it.
+    the tag is after the last ':' that follows the last '/', a registry port is part of the repository.
+    """
+    name, _, digest = image.partition("@")
+    slash = name.rfind("/")
+    colon = name.rfind(":")
+    if colon > slash:
+        return ImageRef(repository=name[:colon], tag=name[colon + 1:], digest=digest or None)
+    return ImageRef(repository=name, digest=digest or None)
+
+
+def parse_image(image: str) -> Optional[ImageRef]:
+    """
+    :return: None if `image` is not a valid reference, e.g. an unrendered template.
+    """
+    match = _REFERENCE.match(image.strip().strip("'\""))
+    if match is None:
+        return None
+    return ImageRef(**match.groupdict())
+
+
+def image_sub_path(image: str) -> str:
+    """
+    directory of the Dockerfile of `image` in the local mirror repo: "<repository>/<mirror tag>",
+    the ':' of a registry port becomes '_'.
+    """
+    ref = split_image(image)
+    return f"{ref.repository.replace(':', '_')}/{ref.mirror_tag}"
+
+
+def mirror_name(image: str) -> Tuple[str, str]:
+    """
+    :return: (repo name, tag) of the mirror of `image` in a CR namespace.
+    """
+    ref = split_image(image)
+    repo_name = ref.repository
+    for c in "/\\:":
+        repo_name = repo_name.replace(c, "_")
+    return repo_name, ref.mirror_tag
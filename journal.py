@@ -0,0 +1,111 @@
+"""
+progress journal of `mirror-op.py build`, so an interrupted run can be resumed and its failures
+retried without going over the whole catalog again.
+"""
+import json
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__file__)
+
+# the repo of the image exists.
+REPO = "repo"
+# a build rule points at the tag of the image.
+RULE = "rule"
+# the build of the image was triggered, or the image was copied, or it exists already.
+BUILD = "build"
+
+
+class Journal:
+    """
+    append-only log of the steps of build runs per image, one json object per line, written
+    as every step completes or fails.
+
+    a run either starts over or continues the runs before it. the state of an image is the last
+    status of each of its steps since the last run that started over.
+
+    a run that starts over truncates the file, a resumed one rewrites it with the state it loaded
+    first, so it holds one record per step of every image at most.
+    """
+
+    def __init__(self, path: str, resume: bool = False, head: str = None):
+        """
+        :param resume: continue the runs recorded in the journal, else start over.
+        :param head: commit of the local repo the run builds.
+        """
+        self.path = path
+        # {git_sub_path: {step: (status, error)}}
+        self.steps: Dict[str, Dict[str, Tuple[str, Optional[str]]]] = {}
+        # head of the run that started over, that the resumed runs continue.
+        self.head: Optional[str] = None
+        if resume:
+            self._load()
+            self._compact()
+        else:
+            self.head = head
+            self.file = open(path, "wt")
+        self._write({"run": "resume" if resume else "start", "head": head})
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rt") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a run that was killed while writing it.
+                    continue
+                if record.get("run") == "start":
+                    self.steps.clear()
+                    self.head = record.get("head")
+                elif "image" in record:
+                    self.steps.setdefault(record["image"], {})[record["step"]] = \
+                        (record["status"], record.get("error"))
+
+    def _compact(self):
+        """
+        replace the history of the runs loaded with their state, then append to it.
+        """
+        tmp = f"{self.path}.tmp"
+        self.file = open(tmp, "wt")
+        self._write({"run": "start", "head": self.head})
+        for git_sub_path, steps in self.steps.items():
+            for step, (status, error) in steps.items():
+                self._write({"image": git_sub_path, "step": step, "status": status,
+                             **({"error": error} if error else {})})
+        os.replace(tmp, self.path)
+
+    def _write(self, record: dict):
+        self.file.write(json.dumps({"time": round(time.time(), 3), **record}) + "\n")
+        self.file.flush()
+
+    def record(self, git_sub_path: str, step: str, error: Exception = None):
+        """
+        record a step of an image as done, or failed with `error`.
+        """
+        status, error = ("done", None) if error is None else ("failed", str(error) or repr(error))
+        if self.steps.get(git_sub_path, {}).get(step) == (status, error):
+            return
+        self.steps.setdefault(git_sub_path, {})[step] = (status, error)
+        self._write({"image": git_sub_path, "step": step, "status": status,
+                     **({"error": error} if error else {})})
+
+    def done(self, git_sub_path: str, step: str) -> bool:
+        return self.steps.get(git_sub_path, {}).get(step, ("",))[0] == "done"
+
+    def failed(self) -> Dict[str, str]:
+        """
+        :return: {git_sub_path: error} of the images with a failed step.
+        """
+        failed = {}
+        for git_sub_path, steps in self.steps.items():
+            for status, error in steps.values():
+                if status == "failed":
+                    failed[git_sub_path] = error
+        return failed
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,190 @@
+import json
+import logging
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__file__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+@dataclass()
+class Histogram:
+    counts: List[int] = field(default_factory=lambda: [0] * len(BUCKETS))
+    sum: float = 0.0
+    count: int = 0
+    max: float = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        """
+        upper bound of the bucket holding the q quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """
+    call counts, errors, retries, latency histograms and in-flight concurrency of the
+    API calls, git commands and other timed operations of a run.
+
+    series are keyed by (kind, name), e.g. ("api", "GetRepoTags") or ("git", "commit").
+    """
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.retries: Counter = Counter()
+        self.latency: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.in_flight: Counter = Counter()
+        self.max_in_flight: Counter = Counter()
+        # {kind: {name: seconds}}, for --profile
+        self.durations: Dict[str, Dict[str, float]] = defaultdict(dict)
+
+    @contextmanager
+    def track(self, kind: str, name: str):
+        key = (kind, name)
+        self.calls[key] += 1
+        self.in_flight[kind] += 1
+        self.max_in_flight[kind] = max(self.max_in_flight[kind], self.in_flight[kind])
+        start = perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.errors[key] += 1
+            raise
+        finally:
+            self.latency[key].observe(perf_counter() - start)
+            self.in_flight[kind] -= 1
+
+    def observe(self, kind: str, name: str, seconds: float):
+        self.latency[(kind, name)].observe(seconds)
+
+    def retry(self, kind: str, name: str):
+        self.retries[(kind, name)] += 1
+
+    @contextmanager
+    def duration(self, kind: str, name: str):
+        """
+        record how long one image or repo took, for the slowest-N report.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[kind][name] = perf_counter() - start
+
+    def slowest(self, kind: str, n: int = 10) -> List[Tuple[str, float]]:
+        return sorted(self.durations[kind].items(), key=lambda i: i[1], reverse=True)[:n]
+
+    def to_json(self) -> dict:
+        series = []
+        for (kind, name), h in sorted(self.latency.items()):
+            series.append({
+                "kind": kind,
+                "name": name,
+                "calls": self.calls[(kind, name)] or h.count,
+                "errors": self.errors[(kind, name)],
+                "retries": self.retries[(kind, name)],
+                "seconds_total": round(h.sum, 6),
+                "seconds_mean": round(h.sum / h.count, 6) if h.count else 0,
+                "seconds_p50": round(h.quantile(0.5), 6),
+                "seconds_p90": round(h.quantile(0.9), 6),
+                "seconds_p99": round(h.quantile(0.99), 6),
+                "seconds_max": round(h.max, 6),
+            })
+        return {
+            "series": series,
+            "max_in_flight": dict(self.max_in_flight),
+            "slowest": {kind: self.slowest(kind) for kind in self.durations},
+        }
+
+    def to_prometheus(self, prefix: str = "mirror_op") -> str:
+        lines = [
+            f"# TYPE {prefix}_calls_total counter",
+            f"# TYPE {prefix}_errors_total counter",
+            f"# TYPE {prefix}_retries_total counter",
+            f"# TYPE {prefix}_duration_seconds histogram",
+            f"# TYPE {prefix}_max_in_flight gauge",
+        ]
+        for (kind, name), h in sorted(self.latency.items()):
+            labels = f'kind="{kind}",name="{name}"'
+            lines.append(f"{prefix}_calls_total{{{labels}}} {self.calls[(kind, name)] or h.count}")
+            lines.append(f"{prefix}_errors_total{{{labels}}} {self.errors[(kind, name)]}")
+            lines.append(f"{prefix}_retries_total{{{labels}}} {self.retries[(kind, name)]}")
+            cumulative = 0
+            for bound, n in zip(BUCKETS, h.counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{prefix}_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{prefix}_duration_seconds_sum{{{labels}}} {h.sum}")
+            lines.append(f"{prefix}_duration_seconds_count{{{labels}}} {h.count}")
+        for kind, n in sorted(self.max_in_flight.items()):
+            lines.append(f'{prefix}_max_in_flight{{kind="{kind}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path_prefix: str):
+        """
+        write <path_prefix>.json and <path_prefix>.prom
+        """
+        with open(f"{path_prefix}.json", "wt") as f:
+            json.dump(self.to_json(), f, indent=2)
+        with open(f"{path_prefix}.prom", "wt") as f:
+            f.write(self.to_prometheus())
+
+
+class Progress:
+    """
+    logs done/total, throughput and the time left of a batch, at most every `interval` seconds.
+    items skipped without doing the action count as done, not in the throughput.
+    """
+
+    def __init__(self, total: int, action: str, interval: float = 1.0):
+        self.total = total
+        self.action = action
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.start = perf_counter()
+        self._logged = self.start
+
+    def rate(self) -> float:
+        elapsed = perf_counter() - self.start
+        return (self.done - self.skipped) / elapsed if elapsed > 0 else 0.0
+
+    def advance(self, failed: bool = False, skipped: bool = False):
+        self.done += 1
+        self.failed += failed
+        self.skipped += skipped
+        now = perf_counter()
+        if now - self._logged >= self.interval and self.done < self.total:
+            self._logged = now
+            elapsed = now - self.start
+            left = (self.total - self.done) * elapsed / self.done
+            logger.info(f"{self.action} {self.done}/{self.total} ({self.rate():.1f}/s, {left:.0f}s left)")
+
+    def finish(self):
+        elapsed = perf_counter() - self.start
+        logger.info(f"{self.action} {self.done - self.failed - self.skipped}/{self.total} in {elapsed:.1f}s "
+                    f"({self.rate():.1f}/s), "
+                    + (f"{self.skipped} skipped, " if self.skipped else "")
+                    + f"{self.failed} failed")
+
+
+metrics = Metrics()
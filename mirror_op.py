@@ -0,0 +1,1947 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import time
+from collections import defaultdict
+from copy import copy
+from fnmatch import fnmatchcase
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+
+import click
+
+from defaults import DEFAULT_RULE_LIMIT, DEFAULT_RULE_WAIT_TIMEOUT
+from git import Git
+from image_ref import image_sub_path, mirror_name, parse_image, split_image
+from journal import BUILD, REPO, RULE, Journal
+from metrics import Progress, metrics
+
+# the modules of the commands that talk to the registries are imported by those commands:
+# `name` and `copy` run once per image from scripts and start without asyncio and the API clients.
+if TYPE_CHECKING:
+    from asyncio import Semaphore
+
+    from aliyun_cr import AliyunCR, CRTarget
+    from cr_state import CRState, ImageStatus
+    from registry_copy import ImageCopier
+    from state_cache import StateCache
+
+logger = logging.getLogger(__file__)
+
+
+@click.group()
+@click.option("--log-level",
+              type=click.Choice(['DEBUG', "INFO", "WARNING", "ERROR"]),
+              default="INFO")
+@click.option("--metrics-out", default=None,
+              help="write API/git call metrics to <metrics-out>.json and <metrics-out>.prom")
+@click.option("--profile/--no-profile", "profile", default=False,
+              help="print the slowest images and repos at exit.")
+@click.option("--scan-index/--no-scan-index", "scan_index", default=False,
+              help="keep the directory mtimes of the local repo in its .git dir, directories "
+                   "unchanged since the last scan aren't listed again.")
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    log_level: str,
+    metrics_out: str = None,
+    profile: bool = False,
+    scan_index: bool = False,
+):
+    logging.basicConfig(level=getattr(logging, log_level))
+    ctx.ensure_object(dict)["scan_index"] = scan_index
+    ctx.call_on_close(lambda: report_metrics(metrics_out, profile))
+
+
+def report_metrics(metrics_out: str = None, profile: bool = False):
+    if metrics_out:
+        metrics.write(metrics_out)
+    if profile:
+        for kind in ("repo", "image"):
+            slowest = metrics.slowest(kind)
+            if slowest:
+                click.echo(f"slowest {kind}s:", err=True)
+                for name, seconds in slowest:
+                    click.echo(f"  {seconds:8.2f}s {name}", err=True)
+
+
+def cache_options(f):
+    f = click.option("--cache-file", default=None,
+                     help="sqlite cache of registry metadata, "
+                          "defaults to .git/mirror-op-cache.sqlite of the local git repo.")(f)
+    f = click.option("--cache-ttl", multiple=True,
+                     help="seconds cached data stays valid, as <repo|rule|tag>=<seconds>.")(f)
+    f = click.option("--refresh/--no-refresh", "refresh", default=False,
+                     help="ignore cached registry metadata.")(f)
+    return f
+
+
+def api_options(f):
+    f = click.option("--api-transport", type=click.Choice(["http", "executor"]), default="http",
+                     help="http: builtin asyncio client with pooled connections, "
+                          "executor: the blocking aliyunsdkcore client on a thread pool.")(f)
+    f = click.option("--api-endpoint", default=None,
+                     help="Container Registry API endpoint, defaults to cr.<region>.aliyuncs.com")(f)
+    f = click.option("--qps", type=click.FloatRange(min=0, min_open=True), default=20, show_default=True,
+                     help="API requests per second, lowered automatically when throttled.")(f)
+    f = click.option("--action-qps", multiple=True,
+                     help="additional limit of one API action, as <Action>=<qps>.")(f)
+    f = click.option("--max-attempts", type=int, default=5, show_default=True,
+                     help="tries of a throttled, timed out or failed(5xx) API call.")(f)
+    f = click.option("--page-size", type=int, default=100, show_default=True,
+                     help="items per request when listing repos, tags and builds.")(f)
+    return f
+
+
+def open_cr(
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    aliyun_cr_region: str,
+    local_git_repo: str = './docker-cr_image',
+    cache_file: str = None,
+    cache_ttl=(),
+    refresh: bool = False,
+    api_transport: str = 'http',
+    api_endpoint: str = None,
+    qps: float = 20,
+    action_qps=(),
+    max_attempts: int = 5,
+    page_size: int = 100,
+    cache: StateCache = None,
+) -> AliyunCR:
+    """
+    create the AliyunCR client of a command from its cache_options and api_options.
+    :param cache: use this cache instead of opening the one of cache_options.
+    """
+    from aliyun_cr import AliyunCR
+    from throttle import parse_qps
+    try:
+        action_qps = parse_qps(action_qps)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--action-qps")
+    if cache is None:
+        cache = open_cache(local_git_repo, cache_file, cache_ttl, refresh)
+    return AliyunCR(
+        access_key=aliyun_cr_access_key,
+        access_secret=aliyun_cr_access_secret,
+        region=aliyun_cr_region,
+        namespace=aliyun_cr_namespace,
+        cache=cache,
+        transport=api_transport,
+        endpoint=api_endpoint,
+        qps=qps,
+        action_qps=action_qps,
+        max_attempts=max_attempts,
+        page_size=page_size,
+    )
+
+
+def open_targets(
+    targets: List[CRTarget],
+    local_git_repo: str = './docker-cr_image',
+    cache_file: str = None,
+    cache_ttl=(),
+    refresh: bool = False,
+    **cr_options,
+) -> List[AliyunCR]:
+    """
+    one AliyunCR client per target, sharing the metadata cache.
+    """
+    cache = open_cache(local_git_repo, cache_file, cache_ttl, refresh)
+    return [open_cr(aliyun_cr_region=target.region,
+                    aliyun_cr_namespace=target.namespace,
+                    local_git_repo=local_git_repo,
+                    cache=cache,
+                    **cr_options)
+            for target in targets]
+
+
+def parse_targets(targets, default_region: str, default_namespace: str) -> List[CRTarget]:
+    """
+    :return: the targets of the --target options, or the default one.
+    """
+    from aliyun_cr import CRTarget
+    if not targets:
+        return [CRTarget(region=default_region, namespace=default_namespace)]
+    try:
+        return list(dict.fromkeys(CRTarget.parse(t, namespace=default_namespace) for t in targets))
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--target")
+
+
+def parse_registry_endpoints(registry_endpoints) -> Dict[str, str]:
+    """
+    :return: the base urls of the --registry-endpoint options, by registry.
+    """
+    from registry import parse_endpoints
+    try:
+        return parse_endpoints(registry_endpoints)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--registry-endpoint")
+
+
+def target_options(f):
+    f = click.option("--target", "targets", multiple=True,
+                     help="<region>/<namespace> to mirror into, repeatable, the local repo is scanned "
+                          "once for all targets. defaults to --aliyun-cr-region and the namespace "
+                          "argument.")(f)
+    f = click.option("--global-concurrency", type=click.IntRange(min=1), default=None,
+                     help="number of repos processed at the same time over all targets, "
+                          "defaults to --concurrency times the number of targets.")(f)
+    return f
+
+
+def format_option(f):
+    return click.option("--format", "output_format", type=click.Choice(["text", "jsonl"]),
+                        default="text", show_default=True,
+                        help="jsonl: one json record per image on stdout as soon as its result "
+                             "is known, in completion order.")(f)
+
+
+def print_record(image: str, target: CRTarget, status: str, reason: str = "", seconds: float = 0.0):
+    """
+    one line of --format jsonl.
+    :param image: the upstream reference, as written in the FROM line of its Dockerfile.
+    """
+    click.echo(json.dumps({
+        "image": image,
+        "mirror": cr_image_name(cr_region=target.region, cr_namespace=target.namespace, image=image),
+        "target": str(target),
+        "status": status,
+        "reason": reason,
+        "seconds": round(seconds, 3),
+    }))
+
+
+# result of an image of build: a status or the exception it failed with, and the seconds it took.
+Report = Callable[[str, Union[str, Exception], float], None]
+
+
+def build_reporter(local_git_repo: str, target: CRTarget) -> Report:
+    """
+    print_record the results of build_target and copy_target for a target.
+    """
+    def report(git_sub_path: str, result: Union[str, Exception], seconds: float):
+        if isinstance(result, Exception):
+            status, reason = "error", str(result) or repr(result)
+        else:
+            status, reason = result, ""
+        print_record(upstream_image(local_git_repo, git_sub_path), target, status, reason, seconds)
+
+    return report
+
+
+def registry_options(f):
+    f = click.option("--registry-concurrency", type=click.IntRange(min=1), default=8, show_default=True,
+                     help="requests in flight per docker registry.")(f)
+    f = click.option("--registry-endpoint", "registry_endpoints", multiple=True,
+                     help="base url of a registry, as <registry>=<url>, "
+                          "e.g. docker.io=http://127.0.0.1:5000")(f)
+    return f
+
+
+def open_cache(local_git_repo: str, cache_file: str = None, cache_ttl=(), refresh: bool = False):
+    from state_cache import StateCache, default_cache_path, parse_ttl
+    try:
+        ttl = parse_ttl(cache_ttl)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--cache-ttl")
+    if cache_file is None:
+        cache_file = default_cache_path(local_git_repo)
+        if cache_file is None:
+            logger.debug(f"{local_git_repo} is not a git repo, registry metadata is not cached.")
+            return None
+    return StateCache(cache_file, ttl=ttl, refresh=refresh)
+
+
+def run_until_complete(coro):
+    from asyncio import get_event_loop
+    return get_event_loop().run_until_complete(coro)
+
+
+@cli.command("name")
+@click.argument("image")
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.argument("aliyun-cr-region", envvar='MIRROR_OP_CR_REGION', default='cn-shanghai')
+def cli_mirror_name(
+    image: str,
+    aliyun_cr_namespace: str = 'zh-mirror',
+    aliyun_cr_region: str = 'cn-shanghai',
+):
+    cr_image = cr_image_name(image=image,
+                         cr_namespace=aliyun_cr_namespace,
+                         cr_region=aliyun_cr_region,
+                         )
+    print(f"{image} -> {cr_image}")
+
+
+@cli.command("copy")
+@click.argument("images", nargs=-1)
+@click.option("--from-file", "from_file", type=click.File("rt"), default=None,
+              help="read images from this file too, one per line, '-' for stdin.")
+@click.option("--local-git-repo", default="./docker-mirror")
+@click.option("--git-bin", default="git")
+@click.option("--push/--no-push", "push", default=True)
+@click.option("--commit/--no-commit", "commit", default=True)
+@click.option("--debug/--no-debug", "debug", default=False)
+@click.option("--bulk/--worktree", "bulk", default=False,
+              help="commit the Dockerfiles straight to the branch without writing the working tree, "
+                   "works in a bare clone.")
+def cli_copy(images,
+             from_file=None,
+             local_git_repo: str = './docker-mirror',
+             git_bin: str = 'git',
+             commit: bool = True,
+             push: bool = True,
+             debug: bool = False,
+             bulk: bool = False,
+             ):
+    images = list(images)
+    if from_file is not None:
+        images.extend(line.strip() for line in from_file)
+    # keep input order, drop blank lines and duplicates.
+    images = list(dict.fromkeys(i for i in images if i))
+
+    git = Git(git_bin=git_bin,
+              cwd=local_git_repo,
+              )
+    if bulk:
+        if not commit:
+            raise click.UsageError("--bulk always commits, use --worktree with --no-commit.")
+        commit_dockerfiles_bulk(git, images, push, debug)
+        return
+
+    dockerfiles = write_dockerfiles(images, local_git_repo, debug)
+    commit_dockerfiles(git, dockerfiles, commit, push)
+
+
+def write_dockerfiles(images, local_git_repo: str, debug: bool = False):
+    """
+    write the Dockerfile of every image that is missing or out of date in the local mirror repo.
+    :return: [(image, git_full_path), ...] of the Dockerfiles of all `images`, up to date ones too:
+             they may be untracked or staged only, by an earlier run with --no-commit.
+    """
+    dockerfiles = []
+    for image in images:
+        code = f'FROM {image}'
+        git_sub_path = image_sub_path(image)
+        git_full_path = os.path.join(git_sub_path, "Dockerfile")
+        dest = os.path.join(local_git_repo, git_full_path)
+        dockerfiles.append((image, git_full_path))
+        if os.path.exists(dest) and read_file(dest) == code:
+            if debug:
+                print(f"{dest} is up to date, not writing it")
+            continue
+        if debug:
+            print(f"writting {code} into {dest}")
+        write_file(dest, code)
+    return dockerfiles
+
+
+def commit_dockerfiles(git: Git, dockerfiles, commit: bool = True, push: bool = True):
+    """
+    stage the Dockerfiles of `write_dockerfiles`, commit the ones that differ from HEAD, then push
+    at once. the push runs even with nothing to commit, to retry the one of an earlier run.
+    """
+    if dockerfiles:
+        git.add(*[path for _, path in dockerfiles])
+    if commit:
+        changed = git.changed_files({path: f'FROM {image}' for image, path in dockerfiles})
+        if changed:
+            git.commit(add_message([image for image, path in dockerfiles if path in changed]), False)
+    if push:
+        git.push()
+
+
+def commit_dockerfiles_bulk(git: Git, images, push: bool = True, debug: bool = False):
+    """
+    commit the missing or out of date Dockerfiles of `images` on top of the branch head, without
+    the working tree, see Git.commit_files. a checked out branch gets its new files written.
+    :return: [(image, git_full_path), ...] of the committed Dockerfiles.
+    """
+    paths = {f"{image_sub_path(image)}/Dockerfile": image for image in images}
+    changed = git.changed_files({path: f'FROM {image}' for path, image in paths.items()})
+    if debug:
+        for path in changed:
+            print(f"committing {changed[path]} as {path}")
+    if not changed:
+        return []
+    added = [(paths[path], path) for path in changed]
+    try:
+        ref = git.symbolic_ref()
+    except subprocess.CalledProcessError:
+        raise click.ClickException(f"HEAD of {git.cwd} is detached, --bulk commits to a branch: "
+                                   f"check one out, or use --worktree.")
+    try:
+        old = git.rev_parse(ref)
+    except subprocess.CalledProcessError:
+        old = None
+    new = git.commit_files(changed, add_message([image for image, _ in added]), ref=ref)
+    if not git.is_bare():
+        git.update_worktree(old, new)
+    if push:
+        git.push_ref(ref)
+    return added
+
+
+def add_message(images) -> str:
+    if len(images) == 1:
+        return f"[Add] {images[0]}"
+    return f"[Add] {len(images)} images\n\n" + "\n".join(images)
+
+
+@cli.command("extract")
+@click.argument("sources", nargs=-1)
+@click.option("--chart", "charts", multiple=True,
+              help="render this helm chart with `helm template` and extract its images, repeatable.")
+@click.option("--helm-bin", default="helm")
+@click.option("--helm-arg", "helm_args", multiple=True,
+              help="extra argument of `helm template`, e.g. --helm-arg=--values=my.yaml")
+@click.option("--local-git-repo", default="./docker-mirror",
+              help="images that already have a Dockerfile in this repo are skipped.")
+@click.option("--all/--new-only", "include_existing", default=False,
+              help="print images already in the local git repo too.")
+@click.option("--jobs", type=int, default=os.cpu_count(), show_default=True,
+              help="files and charts processed at the same time.")
+def cli_extract(sources,
+                charts=(),
+                helm_bin: str = 'helm',
+                helm_args=(),
+                local_git_repo: str = './docker-mirror',
+                include_existing: bool = False,
+                jobs: int = 1,
+                ):
+    """
+    print the images of yaml files (helm output, k8s manifests, compose files), one per line,
+    '-' or no file reads stdin. pipe it into `copy --from-file -`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    from extract import extract_chart, extract_file, images_in_text
+
+    if not sources and not charts:
+        sources = ('-',)
+    tasks = [partial(extract_file, path) for path in sources if path != '-']
+    tasks += [partial(extract_chart, chart, helm_bin=helm_bin, helm_args=helm_args) for chart in charts]
+    seen = set()
+    skipped = 0
+
+    def emit(images):
+        nonlocal skipped
+        for image in images:
+            if image in seen:
+                continue
+            seen.add(image)
+            if not include_existing and \
+                    os.path.exists(os.path.join(local_git_repo, image_sub_path(image), "Dockerfile")):
+                skipped += 1
+                continue
+            click.echo(image)
+
+    if '-' in sources:
+        emit(str(ref) for ref in images_in_text(click.open_file('-')))
+    if len(tasks) > 1 and jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for images in executor.map(_call, tasks):
+                emit(images)
+    else:
+        for task in tasks:
+            emit(task())
+    logger.info(f"{len(seen)} image(s) found, {skipped} already in {local_git_repo}.")
+
+
+def _call(f):
+    return f()
+
+
+@cli.command("build")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.argument("github-namespace", envvar='MIRROR_OP_GITHUB_NAMESPACE',
+                default='nanoric-public-cd')
+@click.argument("github-repo", envvar='MIRROR_OP_GITHUB_REPO', default='docker-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-cr_image")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos processed at the same time per target.")
+@target_options
+@click.option("--full-scan/--incremental", "full_scan", default=False,
+              help="walk the whole local git repo instead of the Dockerfiles changed "
+                   "since the last successful build.")
+@click.option("--git-bin", default="git")
+@click.option("--rule-limit", type=int, default=DEFAULT_RULE_LIMIT, show_default=True,
+              help="build rules per repo, tags beyond it reuse idle rules.")
+@click.option("--rule-wait-timeout", type=click.FloatRange(min=0), default=DEFAULT_RULE_WAIT_TIMEOUT,
+              show_default=True,
+              help="give up on tags still waiting for an idle build rule after this many seconds, "
+                   "0 to not wait.")
+@click.option("--resume/--start-over", "resume", default=False,
+              help="continue the last run from its journal, images it finished are skipped.")
+@click.option("--retry-failed/--all-images", "retry_failed", default=False,
+              help="only build the images that failed in the runs of the journal.")
+@format_option
+@click.option("--backend", type=click.Choice(["autobuild", "copy"]), default="autobuild",
+              show_default=True,
+              help="autobuild: build rules of the repos build the Dockerfiles from github, "
+                   "copy: images are copied from their upstream registry over the registry API.")
+@registry_options
+@click.option("--registry-username", default=None,
+              help="user pushing to the Aliyun registry, for --backend copy.")
+@click.option("--registry-password", default=None,
+              help="its password, for --backend copy.")
+@click.option("--layer-concurrency", type=click.IntRange(min=1), default=8, show_default=True,
+              help="blobs copied at the same time, for --backend copy.")
+@click.option("--platform", "platforms", multiple=True,
+              help="only copy these platforms of multi-platform images, e.g. linux/amd64, "
+                   "repeatable, for --backend copy.")
+@cache_options
+@api_options
+def cli_build(
+    **kwargs,
+):
+    return run_until_complete(async_cli_build(**kwargs))
+
+
+def image_from_git_sub_path(git_sub_path: str):
+    dirs = git_sub_path.split('/')
+    repository = "/".join(dirs[:-1])
+    tag = dirs[-1]
+    return f'{repository}:{tag}'
+
+
+async def list_local_repo(
+    local_git_repo: str,
+):
+    """
+    the git_sub_path of every Dockerfile of the local repo, as they are found.
+    the scan index is used if the command was run with --scan-index.
+    """
+    from scanner import default_index_path, scan_local_repo
+    ctx = click.get_current_context(silent=True)
+    scan_index = ctx is not None and (ctx.obj or {}).get("scan_index", False)
+    index_path = default_index_path(local_git_repo) if scan_index else None
+    async for git_sub_path in scan_local_repo(local_git_repo, index_path=index_path):
+        yield git_sub_path
+
+
+def group_by_repo(git_sub_paths) -> Dict[str, List[str]]:
+    """
+    :return: {cr_repo_name: [git_sub_path, ...]}, tags of the same repo grouped together.
+    """
+    groups = defaultdict(list)
+    for git_sub_path in git_sub_paths:
+        groups[cr_repo_name(image_from_git_sub_path(git_sub_path))].append(git_sub_path)
+    return groups
+
+
+async def group_local_repo(local_git_repo: str) -> Dict[str, List[str]]:
+    with metrics.track("scan", "list_local_repo"):
+        return group_by_repo([i async for i in list_local_repo(local_git_repo)])
+
+
+def list_changed_local_repo(git: Git, since: str, until: str = 'HEAD'):
+    """
+    :return: (changed, deleted), git_sub_path of Dockerfiles changed or deleted between two commits.
+    """
+    changed, deleted = [], []
+    for status, path in git.diff_name_status(since, until):
+        dir_name, file = os.path.split(path)
+        if file != "Dockerfile" or not dir_name:
+            continue
+        if status == 'D':
+            deleted.append(dir_name)
+        else:
+            changed.append(dir_name)
+    return changed, deleted
+
+
+def journal_path(local_git_repo: str, target: CRTarget):
+    return os.path.join(local_git_repo, ".git",
+                        f"mirror-op-journal.{target.region}.{target.namespace}.jsonl")
+
+
+def last_sync_path(local_git_repo: str, target: CRTarget):
+    return os.path.join(local_git_repo, ".git",
+                        f"mirror-op-last-sync.{target.region}.{target.namespace}")
+
+
+def read_last_sync(local_git_repo: str, target: CRTarget):
+    path = last_sync_path(local_git_repo, target)
+    if not os.path.exists(path):
+        return None
+    return read_file(path).strip() or None
+
+
+async def local_changes(git: Git, local_git_repo: str, since: str = None, until: str = 'HEAD'):
+    """
+    :return: Dockerfiles changed since the commit `since` grouped by repo, all of them if it is None.
+    """
+    if since is not None:
+        try:
+            changed, deleted = list_changed_local_repo(git, since, until)
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"can't diff from last synced commit {since}, "
+                           f"falling back to full scan: {e}")
+        else:
+            logger.info(f"{len(changed)} image(s) changed since {since}.")
+            for git_sub_path in deleted:
+                logger.info(f"{image_from_git_sub_path(git_sub_path)} was removed from local repo, "
+                            f"its mirror is kept.")
+            return group_by_repo(changed)
+    return await group_local_repo(local_git_repo)
+
+
+async def run_pool(items, handle, concurrency: int = 16):
+    """
+    call `handle(item)` for every item of the (async) iterable `items`, with at most
+    `concurrency` calls in flight.
+    the producer is suspended while all workers are busy, so `items` is consumed lazily.
+    :return: {item: exception} of every failed item.
+    """
+    from asyncio import Queue, ensure_future, gather
+    queue = Queue(maxsize=concurrency)
+    failures = {}
+    stop = object()
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is stop:
+                return
+            # noinspection PyBroadException
+            try:
+                await handle(item)
+            except Exception as e:
+                failures[item] = e
+
+    workers = [ensure_future(worker()) for _ in range(max(concurrency, 1))]
+    try:
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                await queue.put(item)
+        else:
+            for item in items:
+                await queue.put(item)
+        for _ in workers:
+            await queue.put(stop)
+        await gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+    return failures
+
+
+async def async_cli_build(
+    aliyun_cr_region: str,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    github_namespace: str,
+    github_repo: str,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    targets=(),
+    global_concurrency: int = None,
+    full_scan: bool = False,
+    git_bin: str = 'git',
+    rule_limit: int = DEFAULT_RULE_LIMIT,
+    rule_wait_timeout: float = DEFAULT_RULE_WAIT_TIMEOUT,
+    backend: str = 'autobuild',
+    registry_concurrency: int = 8,
+    registry_endpoints=(),
+    registry_username: str = None,
+    registry_password: str = None,
+    layer_concurrency: int = 8,
+    platforms=(),
+    resume: bool = False,
+    retry_failed: bool = False,
+    output_format: str = 'text',
+    **cr_options,
+):
+    from asyncio import Semaphore, gather
+    from registry import RegistryClient
+    from registry_copy import ImageCopier, parse_platforms
+    targets = parse_targets(targets, aliyun_cr_region, aliyun_cr_namespace)
+    endpoints = parse_registry_endpoints(registry_endpoints)
+    try:
+        platforms = parse_platforms(platforms)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--platform")
+    is_git_repo = os.path.isdir(os.path.join(local_git_repo, ".git"))
+    if (resume or retry_failed) and not is_git_repo:
+        raise click.UsageError(f"{local_git_repo} is not a git repo, it has no journal to resume.")
+    copier = None
+    if backend == "copy":
+        credentials = {}
+        if registry_username is not None:
+            credentials = {cr_registry(target.region): (registry_username, registry_password or "")
+                           for target in targets}
+        copier = ImageCopier(RegistryClient(endpoints=endpoints,
+                                            credentials=credentials,
+                                            concurrency=registry_concurrency),
+                             transfers=layer_concurrency,
+                             platforms=platforms)
+    crs = open_targets(
+        targets,
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    git = Git(git_bin=git_bin, cwd=local_git_repo)
+    head = None
+    if is_git_repo:
+        try:
+            head = git.rev_parse()
+        except subprocess.CalledProcessError:
+            logger.debug(f"{local_git_repo} has no commit yet.")
+    last_syncs = [None if full_scan or head is None else read_last_sync(local_git_repo, target)
+                  for target in targets]
+    # targets synced to the same commit share one diff or scan.
+    scans = {}
+    for last_sync in last_syncs:
+        if last_sync not in scans:
+            scans[last_sync] = await local_changes(git, local_git_repo, last_sync, head)
+    journals = [Journal(journal_path(local_git_repo, target), resume=resume or retry_failed, head=head)
+                if is_git_repo else None
+                for target in targets]
+    todos = [pending_images(local_git_repo, scans[last_sync], journal, head, retry_failed,
+                            where=f" in {target}" if len(targets) > 1 else "")
+             for target, last_sync, journal in zip(targets, last_syncs, journals)]
+
+    semaphore = Semaphore(global_concurrency or concurrency * len(targets))
+    results = await gather(*[
+        copy_target(cr,
+                    todo,
+                    copier=copier,
+                    local_git_repo=local_git_repo,
+                    semaphore=semaphore,
+                    concurrency=concurrency,
+                    label=f"{target}/" if len(targets) > 1 else "",
+                    journal=journal,
+                    report=build_reporter(local_git_repo, target) if output_format == "jsonl" else None,
+                    )
+        if copier is not None else
+        build_target(cr,
+                     todo,
+                     github_namespace=github_namespace,
+                     github_repo=github_repo,
+                     semaphore=semaphore,
+                     concurrency=concurrency,
+                     rule_limit=rule_limit,
+                     rule_wait_timeout=rule_wait_timeout,
+                     label=f"{target}/" if len(targets) > 1 else "",
+                     journal=journal,
+                     report=build_reporter(local_git_repo, target) if output_format == "jsonl" else None,
+                     )
+        for cr, target, todo, journal in zip(crs, targets, todos, journals)
+    ])
+
+    failed_images = set()
+    for target, failures, last_sync, journal in zip(targets, results, last_syncs, journals):
+        for git_sub_path, e in failures.items():
+            where = f" in {target}" if len(targets) > 1 else ""
+            logger.warning(f"Failed to build {image_from_git_sub_path(git_sub_path)}{where}: {e}")
+            failed_images.add(git_sub_path)
+        # the images skipped as done by a resumed run count too.
+        if head is not None and all(journal.done(git_sub_path, BUILD)
+                                    for git_sub_paths in scans[last_sync].values()
+                                    for git_sub_path in git_sub_paths):
+            write_file(last_sync_path(local_git_repo, target), head)
+        if journal is not None:
+            journal.close()
+    if failed_images:
+        logger.warning(f"{len(failed_images)} image(s) failed to build.")
+    if copier is not None:
+        logger.info("copied: " + ", ".join(f"{k}: {v}" for k, v in sorted(copier.stats.items())))
+        await copier.client.close()
+    for cr in crs:
+        await cr.close()
+
+
+def pending_images(local_git_repo: str, groups: Dict[str, List[str]], journal: Optional[Journal],
+                   head: str = None, retry_failed: bool = False, where: str = "") -> Dict[str, List[str]]:
+    """
+    :return: the images of `groups` a resumed run still has to build, the ones that failed
+             according to the journal if `retry_failed`, grouped by repo.
+    """
+    if journal is None:
+        return groups
+    if retry_failed:
+        failed = [git_sub_path for git_sub_path in journal.failed()
+                  if os.path.exists(os.path.join(local_git_repo, git_sub_path, "Dockerfile"))]
+        logger.info(f"retrying {len(failed)} failed image(s){where}.")
+        return group_by_repo(failed)
+    pending = [git_sub_path for git_sub_paths in groups.values() for git_sub_path in git_sub_paths
+               if not journal.done(git_sub_path, BUILD)]
+    total = sum(map(len, groups.values()))
+    if journal.head != head:
+        logger.info(f"the journal{where} was started at {journal.head}, resuming it at {head}.")
+    if len(pending) < total:
+        logger.info(f"resuming{where}: {total - len(pending)} image(s) done already, "
+                    f"{len(pending)} left.")
+    return group_by_repo(pending)
+
+
+async def build_target(
+    cr: AliyunCR,
+    groups: Dict[str, List[str]],
+    github_namespace: str,
+    github_repo: str,
+    semaphore: Semaphore,
+    concurrency: int = 16,
+    rule_limit: int = DEFAULT_RULE_LIMIT,
+    rule_wait_timeout: float = DEFAULT_RULE_WAIT_TIMEOUT,
+    label: str = "",
+    rebuild: bool = False,
+    journal: Journal = None,
+    report: Report = None,
+):
+    """
+    build the images of `groups` in the target of `cr`.
+    :param semaphore: limits the repos processed at the same time over all targets.
+    :param label: prefix of the repo and image names in metrics.
+    :param rebuild: build images that have been built already again.
+    :param journal: record the steps of every image in it.
+    :param report: called with the result of every image once it is known, queued images
+                   when their build is triggered, timed from the start of the target.
+    :return: {git_sub_path: exception} of the images that failed.
+    """
+    from cr_state import CRState
+    from rule_slots import drain
+    start = time.perf_counter()
+    state = CRState(cr, rule_limit=rule_limit)
+    if needs_repos(groups, journal):
+        await state.repos()
+    failures = {}
+    queued = []
+
+    async def build(repo_name: str):
+        async with semaphore:
+            results = await trigger_repo(state, repo_name, groups[repo_name],
+                                         github_namespace=github_namespace,
+                                         github_repo=github_repo,
+                                         label=label,
+                                         rebuild=rebuild,
+                                         journal=journal,
+                                         report=report)
+            failures.update((k, v) for k, v in results.items() if isinstance(v, Exception))
+            queued.extend(k for k, v in results.items() if v == "queued")
+
+    for repo_name, e in (await run_pool(groups, build, concurrency)).items():
+        for git_sub_path in groups[repo_name]:
+            failures.setdefault(git_sub_path, e)
+            if report is not None:
+                report(git_sub_path, e, time.perf_counter() - start)
+    # {(repo_name, tag): git_sub_path} of the images waiting for an idle build rule.
+    waiting_images = {cr_info(image_from_git_sub_path(git_sub_path))[::-1]: git_sub_path
+                      for git_sub_path in queued}
+
+    def triggered(repo_name: str, tag: str):
+        git_sub_path = waiting_images.pop((repo_name, tag), None)
+        if git_sub_path is None:
+            return
+        if journal is not None:
+            journal.record(git_sub_path, RULE)
+            journal.record(git_sub_path, BUILD)
+        if report is not None:
+            report(git_sub_path, "triggered", time.perf_counter() - start)
+
+    waiting = [s for s in state.slots.values() if s.queue]
+    if waiting:
+        logger.info(f"{sum(len(s.queue) for s in waiting)} image(s) of {len(waiting)} repo(s) "
+                    f"wait for an idle build rule{' in ' + label[:-1] if label else ''}.")
+        left = await drain(cr, waiting, concurrency=concurrency, timeout=rule_wait_timeout,
+                           on_triggered=triggered)
+        for repo_name, tags in left.items():
+            for tag, e in tags.items():
+                git_sub_path = waiting_images.pop((repo_name, tag), None)
+                if git_sub_path is None:
+                    continue
+                failures.setdefault(git_sub_path, e)
+                if journal is not None:
+                    journal.record(git_sub_path, BUILD, e)
+                if report is not None:
+                    report(git_sub_path, e, time.perf_counter() - start)
+    return failures
+
+
+def needs_repos(groups: Dict[str, List[str]], journal: Optional[Journal]) -> bool:
+    """
+    :return: False if the journal has the repos of all images created already.
+    """
+    return journal is None or not all(journal.done(git_sub_path, REPO)
+                                      for git_sub_paths in groups.values()
+                                      for git_sub_path in git_sub_paths)
+
+
+async def prepare_repo(
+    state: CRState,
+    repo_name: str,
+    git_sub_paths: List[str],
+    github_namespace: Optional[str],
+    github_repo: Optional[str],
+    label: str = "",
+    journal: Journal = None,
+):
+    """
+    create the repo of `git_sub_paths` if needed, unless the journal has it created already.
+    """
+    if journal is not None and all(journal.done(git_sub_path, REPO) for git_sub_path in git_sub_paths):
+        return
+    try:
+        created = await state.ensure_repo(repo_name,
+                                          github_namespace=github_namespace,
+                                          github_repo=github_repo)
+    except Exception as e:
+        if journal is not None:
+            for git_sub_path in git_sub_paths:
+                journal.record(git_sub_path, REPO, e)
+        raise
+    if created:
+        logger.info(f"repo {label}{repo_name} not exist, created.")
+    else:
+        logger.debug(f"use existing repo: {label}{repo_name}")
+    if journal is not None:
+        for git_sub_path in git_sub_paths:
+            journal.record(git_sub_path, REPO)
+
+
+async def copy_target(
+    cr: AliyunCR,
+    groups: Dict[str, List[str]],
+    copier: ImageCopier,
+    local_git_repo: str,
+    semaphore: Semaphore,
+    concurrency: int = 16,
+    label: str = "",
+    journal: Journal = None,
+    report: Report = None,
+):
+    """
+    the copy backend of build_target: the images of `groups` are copied into repos of the
+    target of `cr` without a build source, no build rule is involved.
+    :return: {git_sub_path: exception} of the images that failed.
+    """
+    from cr_state import CRState
+    state = CRState(cr)
+    if needs_repos(groups, journal):
+        await state.repos()
+    registry = cr_registry(cr.region)
+    failures = {}
+
+    async def copy_repo(repo_name: str):
+        async with semaphore:
+            with metrics.duration("repo", f"{label}{repo_name}"):
+                await prepare_repo(state, repo_name, groups[repo_name], github_namespace=None,
+                                   github_repo=None, label=label, journal=journal)
+                for git_sub_path in groups[repo_name]:
+                    image = upstream_image(local_git_repo, git_sub_path)
+                    start = time.perf_counter()
+                    # noinspection PyBroadException
+                    try:
+                        with metrics.duration("image", f"{label}{image}"):
+                            status = await copier.copy(image, registry, f"{cr.namespace}/{repo_name}",
+                                                       cr_tag_name(image))
+                        logger.getChild(image).info(f"{status} in {label}{repo_name}.")
+                    except Exception as e:
+                        failures[git_sub_path] = status = e
+                    if journal is not None:
+                        journal.record(git_sub_path, BUILD, failures.get(git_sub_path))
+                    if report is not None:
+                        report(git_sub_path, status, time.perf_counter() - start)
+
+    for repo_name, e in (await run_pool(groups, copy_repo, concurrency)).items():
+        for git_sub_path in groups[repo_name]:
+            if git_sub_path not in failures and report is not None:
+                report(git_sub_path, e, 0.0)
+            failures.setdefault(git_sub_path, e)
+    return failures
+
+
+async def trigger_repo(
+    state: CRState,
+    repo_name: str,
+    git_sub_paths: List[str],
+    github_namespace: str,
+    github_repo: str,
+    label: str = "",
+    rebuild: bool = False,
+    journal: Journal = None,
+    report: Report = None,
+) -> Dict[str, object]:
+    """
+    create the repo if needed and trigger the builds of its images, one after another.
+    :param journal: record the steps of every image in it, an image whose rule it has created
+                    already is triggered again even if the rule exists.
+    :return: {git_sub_path: status of trigger_build, or the exception it raised}
+    """
+    results = {}
+    with metrics.duration("repo", f"{label}{repo_name}"):
+        await prepare_repo(state, repo_name, git_sub_paths, github_namespace=github_namespace,
+                           github_repo=github_repo, label=label, journal=journal)
+        for git_sub_path in git_sub_paths:
+            image = image_from_git_sub_path(git_sub_path)
+            # the trigger failed after the rule was created, the rule is there, its build is not.
+            retrigger = journal is not None and journal.done(git_sub_path, RULE)
+            start = time.perf_counter()
+            # noinspection PyBroadException
+            try:
+                with metrics.duration("image", f"{label}{image}"):
+                    results[git_sub_path] = await trigger_build(state, git_sub_path, image,
+                                                                rebuild or retrigger)
+            except Exception as e:
+                results[git_sub_path] = e
+            if journal is not None:
+                record_trigger(journal, state, git_sub_path, image, results[git_sub_path])
+            if report is not None and results[git_sub_path] != "queued":
+                report(git_sub_path, results[git_sub_path], time.perf_counter() - start)
+    return results
+
+
+def record_trigger(journal: Journal, state: CRState, git_sub_path: str, image: str, result):
+    """
+    journal the rule and build steps of a trigger_build result, queued images are recorded once drained.
+    """
+    if result == "queued":
+        return
+    if not isinstance(result, Exception):
+        journal.record(git_sub_path, RULE)
+        journal.record(git_sub_path, BUILD)
+        return
+    tag, repo_name = cr_info(image)
+    slots = state.slots.get(repo_name)
+    if slots is not None and any(rule.tag == tag for rule in slots.rules):
+        journal.record(git_sub_path, RULE)
+    journal.record(git_sub_path, BUILD, result)
+
+
+async def trigger_build(state: CRState, git_sub_path, image, rebuild: bool = False) -> str:
+    """
+    create and trigger the build rule of `image`, its repo must exist already.
+    when all build rules of the repo are busy the image is queued in state.slots.
+    :param rebuild: trigger the build even if the image has been built already.
+    :return: "exists" if the image has a rule or a tag already, "triggered" or "queued".
+    """
+    log = logger.getChild(image)
+    tag, repo_name = cr_info(image)
+    rules = await state.rules(repo_name)
+    correct_rules = [i for i in rules if i.tag == tag]
+    if correct_rules and not rebuild:
+        log.debug(f'rule exist, skip triggering it.')
+        return "exists"
+    slots = await state.rule_slots(repo_name)
+    if not rebuild and len(rules) >= slots.limit and await state.has_tag(repo_name, tag):
+        log.debug(f'tag exist, its rule was recycled for another tag.')
+        return "exists"
+    dockerfile_dir = f'/{git_sub_path}/'
+    if rebuild:
+        log.info(f'rebuilding tag "{tag}".')
+    else:
+        log.info(f'build rule for tag "{tag}" not exist, creating ... \n')
+        log.info(f'creating rule: dockerfile_dir: {dockerfile_dir}, tag: {tag}')
+    if await slots.acquire(tag, dockerfile_dir, rebuild=rebuild) is None:
+        log.info(f'all {slots.limit} build rules of {repo_name} are busy, queued.')
+        return "queued"
+    log.info(f'triggered the rule.')
+    return "triggered"
+
+
+@cli.command("check")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-cr_image")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of images checked at the same time per target.")
+@target_options
+@format_option
+@cache_options
+@api_options
+def cli_check(
+    **kwargs,
+):
+    return run_until_complete(async_cli_check(**kwargs))
+
+
+async def async_cli_check(
+    aliyun_cr_region: str,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    targets=(),
+    global_concurrency: int = None,
+    output_format: str = 'text',
+    **cr_options,
+):
+    """
+    an image passes when it is ready in every target, it is printed once all targets are checked.
+    images are checked as the scan of the local repo finds them, the tags of an image in the
+    same repo share the listing calls of the repo.
+    with output_format jsonl, every image is printed once checked in a target instead.
+    """
+    from asyncio import gather
+    from cr_state import CRState, ImageStatus
+    targets = parse_targets(targets, aliyun_cr_region, aliyun_cr_namespace)
+    crs = open_targets(
+        targets,
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    states = [CRState(cr) for cr in crs]
+    # the repos are listed while the local repo is scanned.
+    listing = gather(*[state.repos() for state in states])
+    # {image: {target: status}}
+    results: Dict[str, Dict[CRTarget, ImageStatus]] = defaultdict(dict)
+
+    def report(image: str, target: CRTarget, status: ImageStatus):
+        """
+        :param image: the upstream reference, from the FROM line of its Dockerfile.
+        """
+        results[image][target] = status
+        if len(results[image]) < len(targets):
+            return
+        statuses = results.pop(image)
+        if all(i == ImageStatus.READY for i in statuses.values()):
+            cr_images = [cr_image_name(cr_region=t.region, cr_namespace=t.namespace, image=image)
+                         for t in targets]
+            print(f"{image} -> {', '.join(cr_images)}")
+        elif len(targets) == 1:
+            print(f"not passed: {image}")
+        else:
+            print(f"not passed: {image} [{', '.join(f'{t}: {statuses[t].value}' for t in targets)}]")
+
+    async def images():
+        async for git_sub_path in list_local_repo(local_git_repo):
+            for target, state in zip(targets, states):
+                yield target, state, git_sub_path
+
+    async def check(item: Tuple[CRTarget, CRState, str]):
+        target, state, git_sub_path = item
+        label = f"{target}/" if len(targets) > 1 else ""
+        image = image_from_git_sub_path(git_sub_path)
+        tag, repo_name = cr_info(image)
+        start = time.perf_counter()
+        try:
+            with metrics.duration("image", f"{label}{image}"):
+                status, reason = await state.image_status(repo_name, tag)
+        except Exception as e:
+            logger.error(f"Exception on {label}{image}: {e}")
+            status, reason = ImageStatus.ERROR, str(e) or repr(e)
+        else:
+            if status != ImageStatus.READY:
+                logger.getChild(f"{label}{repo_name}").warning(reason)
+        upstream = upstream_image(local_git_repo, git_sub_path)
+        if output_format == "jsonl":
+            print_record(upstream, target, status.value, reason, time.perf_counter() - start)
+        else:
+            report(upstream, target, status)
+
+    await gather(run_pool(images(), check, global_concurrency or concurrency * len(targets)), listing)
+    for cr in crs:
+        await cr.close()
+
+
+@cli.command("watch")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-cr_image")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos polled at the same time.")
+@click.option("--min-interval", type=float, default=5, show_default=True,
+              help="minimal seconds between two polls.")
+@click.option("--max-interval", type=float, default=120, show_default=True,
+              help="maximal seconds between two polls.")
+@click.option("--timeout", type=float, default=None,
+              help="give up on images not finished after this many seconds.")
+@cache_options
+@api_options
+def cli_watch(
+    **kwargs,
+):
+    return run_until_complete(async_cli_watch(**kwargs))
+
+
+async def async_cli_watch(
+    aliyun_cr_region: str,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    min_interval: float = 5,
+    max_interval: float = 120,
+    timeout: float = None,
+    **cr_options,
+):
+    """
+    same as check, but wait for pending and building images, printing each one as soon as it is ready.
+    """
+    from asyncio import gather
+    from cr_state import CRState, ImageStatus
+    from watcher import BuildWatcher
+    cr = open_cr(
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        aliyun_cr_region=aliyun_cr_region,
+        aliyun_cr_namespace=aliyun_cr_namespace,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    state = CRState(cr)
+    groups, _ = await gather(group_local_repo(local_git_repo), state.repos())
+
+    def ready(image: str):
+        cr_image = cr_image_name(cr_region=aliyun_cr_region,
+                                 cr_namespace=aliyun_cr_namespace,
+                                 image=image)
+        print(f"{image} -> {cr_image}")
+
+    def failed(image: str, reason: str):
+        logger.warning(f"{image}: {reason}")
+        print(f"not passed: {image}")
+
+    watcher = BuildWatcher(cr,
+                           on_ready=ready,
+                           on_failed=failed,
+                           min_interval=min_interval,
+                           max_interval=max_interval,
+                           concurrency=concurrency,
+                           )
+
+    async def check(repo_name: str):
+        for git_sub_path in groups[repo_name]:
+            image = image_from_git_sub_path(git_sub_path)
+            tag = cr_tag_name(image)
+            try:
+                status, reason = await state.image_status(repo_name, tag)
+            except Exception as e:
+                logger.error(f"Exception on {image}: {e}")
+                continue
+            if status == ImageStatus.READY:
+                ready(image)
+            elif status in (ImageStatus.PENDING, ImageStatus.BUILDING):
+                watcher.add(repo_name, tag, image)
+            else:
+                failed(image, reason)
+
+    await run_pool(groups, check, concurrency)
+    await watcher.run(timeout=timeout)
+    await cr.close()
+
+
+@cli.command("serve")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.argument("github-namespace", envvar='MIRROR_OP_GITHUB_NAMESPACE',
+                default='nanoric-public-cd')
+@click.argument("github-repo", envvar='MIRROR_OP_GITHUB_REPO', default='docker-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-mirror",
+              help="the mirror repo Dockerfiles are written to, committed and pushed, "
+                   "the CR builds from its remote.")
+@click.option("--git-bin", default="git")
+@click.option("--push/--no-push", "push", default=True)
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", type=int, default=8421, show_default=True,
+              help="port of the HTTP endpoint, 0 for any free port, -1 to disable it.")
+@click.option("--follow", "follow_files", multiple=True,
+              help="JSONL file to tail for requests, repeatable. a line is {\"image\": ...}, "
+                   "{\"images\": [...]} or a bare image reference.")
+@click.option("--follow-from-start/--follow-from-end", "follow_from_start", default=False,
+              help="read the lines already in the followed files too.")
+@click.option("--batch-interval", type=float, default=5, show_default=True,
+              help="seconds a request waits for others to share its commit and push.")
+@click.option("--batch-size", type=int, default=100, show_default=True,
+              help="flush a batch as soon as it holds this many images.")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos processed at the same time.")
+@click.option("--rule-limit", type=int, default=DEFAULT_RULE_LIMIT, show_default=True,
+              help="build rules per repo, busy rules are recycled for new tags once reached.")
+@click.option("--state-ttl", type=float, default=3600, show_default=True,
+              help="seconds the repo and build rule state is kept before it is listed again.")
+@cache_options
+@api_options
+def cli_serve(
+    **kwargs,
+):
+    return run_until_complete(async_cli_serve(**kwargs))
+
+
+async def async_cli_serve(
+    aliyun_cr_region: str,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    github_namespace: str,
+    github_repo: str,
+    local_git_repo: str = './docker-mirror',
+    git_bin: str = 'git',
+    push: bool = True,
+    host: str = '127.0.0.1',
+    port: int = 8421,
+    follow_files=(),
+    follow_from_start: bool = False,
+    batch_interval: float = 5,
+    batch_size: int = 100,
+    concurrency: int = 16,
+    rule_limit: int = DEFAULT_RULE_LIMIT,
+    state_ttl: float = 3600,
+    **cr_options,
+):
+    """
+    long running copy and build: image requests arriving over HTTP or in followed files are
+    batched, every batch is one commit and push, then its builds are triggered at once.
+    the repos and build rules of the namespace stay in memory between batches.
+    """
+    from asyncio import Event, ensure_future, get_event_loop
+    from async_git import AsyncGit
+    from cr_state import CRState
+    from daemon import Batcher, JsonServer, follow
+    from rule_slots import drain
+    cr = open_cr(
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        aliyun_cr_region=aliyun_cr_region,
+        aliyun_cr_namespace=aliyun_cr_namespace,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    git = AsyncGit(git_bin=git_bin, cwd=local_git_repo)
+    loop = get_event_loop()
+    state = CRState(cr, rule_limit=rule_limit)
+    state_since = time.monotonic()
+    await state.repos()
+    # {image: Dockerfile path} written but not committed yet, committed with the next batch.
+    uncommitted = {}
+    # images committed but not pushed yet, they are built once a push succeeds.
+    unpushed = set()
+    draining = None
+    started = time.time()
+
+    def drain_queued():
+        nonlocal draining
+        queued = [s for s in state.slots.values() if s.queue]
+        if not queued or (draining is not None and not draining.done()):
+            return
+
+        async def run():
+            left = await drain(cr, queued, concurrency=concurrency)
+            for repo_name, tags in left.items():
+                for tag, e in tags.items():
+                    logger.warning(f"Failed to build {repo_name}:{tag}: {e}")
+            # tags queued meanwhile in repos that weren't drained.
+            drain_queued()
+
+        draining = ensure_future(run())
+
+    async def flush(images: List[str]) -> Dict[str, str]:
+        nonlocal state, state_since
+        with metrics.track("serve", "flush"):
+            if (time.monotonic() - state_since > state_ttl
+                    and (draining is None or draining.done())):
+                logger.info("repo and build rule state expired, listing again.")
+                state = CRState(cr, rule_limit=rule_limit)
+                state_since = time.monotonic()
+
+            dockerfiles = write_dockerfiles(images, local_git_repo)
+            changed = await git.changed_files({path: f'FROM {image}' for image, path in dockerfiles})
+            added = [(image, path) for image, path in dockerfiles if path in changed]
+            uncommitted.update(added)
+            try:
+                if uncommitted:
+                    if push:
+                        unpushed.update(uncommitted)
+                    await git.add_commit(list(uncommitted.values()), add_message(list(uncommitted)))
+                    uncommitted.clear()
+                if unpushed:
+                    await git.push()
+                    unpushed.clear()
+            except subprocess.CalledProcessError as e:
+                logger.warning(f"Failed to commit or push {len(added)} image(s): {e}")
+            logger.info(f"{len(images)} image(s) requested, {len(added)} added.")
+
+            # the CR builds from the remote, images not pushed yet are built with a later batch.
+            results = {image: "error: commit failed, retried with the next batch"
+                       for image in images if image in uncommitted and image not in unpushed}
+            results.update({image: "error: push failed, retried with the next batch"
+                            for image in images if image in unpushed})
+            git_sub_paths = {image_sub_path(image): image for image in images if image not in results}
+            groups = group_by_repo(git_sub_paths)
+
+            async def build(repo_name: str):
+                for git_sub_path, status in (await trigger_repo(
+                        state, repo_name, groups[repo_name],
+                        github_namespace=github_namespace,
+                        github_repo=github_repo)).items():
+                    if isinstance(status, Exception):
+                        logger.warning(f"Failed to build {git_sub_paths[git_sub_path]}: {status}")
+                        status = f"error: {status}"
+                    results[git_sub_paths[git_sub_path]] = status
+
+            for repo_name, e in (await run_pool(groups, build, concurrency)).items():
+                logger.warning(f"Failed to build the images of {repo_name}: {e}")
+                for git_sub_path in groups[repo_name]:
+                    results.setdefault(git_sub_paths[git_sub_path], f"error: {e}")
+            drain_queued()
+            return results
+
+    batcher = Batcher(flush, interval=batch_interval, max_size=batch_size)
+
+    def parse_images(images) -> Tuple[List[str], List[str]]:
+        """
+        :return: (valid, invalid) image references, valid ones normalized.
+        """
+        valid, invalid = [], []
+        for image in images:
+            ref = parse_image(image) if isinstance(image, str) else None
+            if ref is None:
+                invalid.append(image)
+            else:
+                valid.append(str(ref))
+        return list(dict.fromkeys(valid)), invalid
+
+    def submit(images):
+        valid, invalid = parse_images(images)
+        for image in invalid:
+            logger.warning(f"skipping invalid image reference: {image}")
+        if valid:
+            batcher.add(valid)
+
+    async def route(method: str, path: str, query: dict, body):
+        if path == "/healthz":
+            return 200, {"ok": True}
+        if path == "/status":
+            return 200, {
+                **batcher.status(),
+                "uptime": time.time() - started,
+                "queued": sum(len(s.queue) for s in state.slots.values()),
+                "uncommitted": len(uncommitted),
+                "unpushed": len(unpushed),
+            }
+        if path != "/images":
+            return 404, {"error": f"not found: {path}"}
+        if method != "POST":
+            return 405, {"error": f"{method} not allowed"}
+        if not isinstance(body, dict):
+            return 400, {"error": 'expect {"images": [...]}'}
+        images = body.get("images") or []
+        if body.get("image"):
+            images = [body["image"], *images]
+        valid, invalid = parse_images(images if isinstance(images, list) else [images])
+        if not valid:
+            return 400, {"error": "no valid image", "invalid": invalid}
+        results = batcher.add(valid)
+        if query.get("wait", "0") not in ("0", "false", ""):
+            return 200, {"results": await results, "invalid": invalid}
+        return 202, {"accepted": valid, "invalid": invalid}
+
+    server = JsonServer(route)
+    if port >= 0:
+        port = await server.start(host, port)
+        logger.info(f"listening on http://{host}:{port}")
+    followers = [ensure_future(follow(path, submit, from_start=follow_from_start))
+                 for path in follow_files]
+    stop = Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    running = ensure_future(batcher.run())
+    await stop.wait()
+
+    logger.info("stopping, flushing pending requests.")
+    await server.close()
+    for f in followers:
+        f.cancel()
+    batcher.close()
+    await running
+    if draining is not None and not draining.done():
+        logger.info(f"{sum(len(s.queue) for s in state.slots.values())} queued image(s) left "
+                    f"to the next build.")
+        draining.cancel()
+    await cr.close()
+
+
+@cli.command("refresh")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.argument("github-namespace", envvar='MIRROR_OP_GITHUB_NAMESPACE',
+                default='nanoric-public-cd')
+@click.argument("github-repo", envvar='MIRROR_OP_GITHUB_REPO', default='docker-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-cr_image")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos processed at the same time, per target.")
+@target_options
+@registry_options
+@click.option("--match", "patterns", multiple=True,
+              help="only refresh images matching this glob, e.g. '*:latest', repeatable.")
+@click.option("--rebuild-unknown/--record-unknown", "rebuild_unknown", default=False,
+              help="rebuild images refreshed for the first time, instead of only recording "
+                   "their digest.")
+@click.option("--dry-run/--no-dry-run", "dry_run", default=False,
+              help="print the images whose upstream changed without rebuilding them.")
+@click.option("--rule-limit", type=int, default=DEFAULT_RULE_LIMIT, show_default=True,
+              help="build rules per repo, busy rules are recycled for new tags once reached.")
+@click.option("--rule-wait-timeout", type=click.FloatRange(min=0), default=DEFAULT_RULE_WAIT_TIMEOUT,
+              show_default=True,
+              help="give up on images waiting for an idle build rule after this many seconds, "
+                   "0 to not wait.")
+@cache_options
+@api_options
+def cli_refresh(
+    **kwargs,
+):
+    return run_until_complete(async_cli_refresh(**kwargs))
+
+
+def upstream_image(local_git_repo: str, git_sub_path: str) -> str:
+    """
+    the image a Dockerfile of the local repo mirrors, from its FROM line.
+    """
+    for line in read_file(os.path.join(local_git_repo, git_sub_path, "Dockerfile")).splitlines():
+        words = line.split()
+        if len(words) >= 2 and words[0].upper() == "FROM":
+            return words[1]
+    return image_from_git_sub_path(git_sub_path)
+
+
+async def async_cli_refresh(
+    aliyun_cr_region: str,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    github_namespace: str,
+    github_repo: str,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    targets=(),
+    global_concurrency: int = None,
+    registry_concurrency: int = 8,
+    registry_endpoints=(),
+    patterns=(),
+    rebuild_unknown: bool = False,
+    dry_run: bool = False,
+    rule_limit: int = DEFAULT_RULE_LIMIT,
+    rule_wait_timeout: float = DEFAULT_RULE_WAIT_TIMEOUT,
+    **cr_options,
+):
+    """
+    rebuild the mirrors of floating tags that moved upstream: the manifest digest of every tag is
+    looked up in its registry and compared with the one recorded when it was last refreshed.
+    images pinned by digest never move and are skipped.
+    """
+    from asyncio import Semaphore, gather
+    from registry import RegistryClient, locate
+    from state_cache import DigestStore, default_cache_path
+    targets = parse_targets(targets, aliyun_cr_region, aliyun_cr_namespace)
+    endpoints = parse_registry_endpoints(registry_endpoints)
+    digest_file = cr_options.get("cache_file") or default_cache_path(local_git_repo)
+    if digest_file is None:
+        raise click.UsageError(f"{local_git_repo} is not a git repo, "
+                               f"use --cache-file to choose where digests are kept.")
+    store = DigestStore(digest_file)
+
+    images = {}
+    for git_sub_paths in (await group_local_repo(local_git_repo)).values():
+        for git_sub_path in git_sub_paths:
+            image = upstream_image(local_git_repo, git_sub_path)
+            if split_image(image).digest:
+                continue
+            if patterns and not any(fnmatchcase(image, p) for p in patterns):
+                continue
+            images[git_sub_path] = image
+
+    upstream = sorted(set(images.values()))
+    registries = {locate(image)[0] for image in upstream}
+    registry = RegistryClient(endpoints=endpoints,
+                              concurrency=registry_concurrency)
+    digests = {}
+    progress = Progress(len(upstream), "looked up")
+
+    async def look_up(image: str):
+        try:
+            digests[image] = await registry.manifest_digest(image)
+        finally:
+            progress.advance(failed=image not in digests)
+
+    for image, e in (await run_pool(upstream, look_up,
+                                    registry_concurrency * max(len(registries), 1))).items():
+        logger.warning(f"Failed to look up {image}: {e}")
+    progress.finish()
+    await registry.close()
+
+    crs = [] if dry_run else open_targets(
+        targets,
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    semaphore = Semaphore(global_concurrency or concurrency * len(targets))
+
+    async def refresh_target(target: CRTarget, cr: Optional[AliyunCR]):
+        recorded = store.get_all(str(target))
+        where = f" in {target}" if len(targets) > 1 else ""
+        changed, first_seen = {}, {}
+        for git_sub_path, image in images.items():
+            digest = digests.get(image)
+            if digest is None or recorded.get(image) == digest:
+                continue
+            if image not in recorded and not rebuild_unknown:
+                first_seen[image] = digest
+                continue
+            logger.info(f"{image} moved{where}: {recorded.get(image, 'unknown')} -> {digest}")
+            changed[git_sub_path] = digest
+        if dry_run:
+            for git_sub_path in changed:
+                print(f"changed{where}: {images[git_sub_path]}")
+            return
+        store.put_many(str(target), first_seen)
+        failures = await build_target(cr,
+                                      group_by_repo(changed),
+                                      github_namespace=github_namespace,
+                                      github_repo=github_repo,
+                                      semaphore=semaphore,
+                                      concurrency=concurrency,
+                                      rule_limit=rule_limit,
+                                      rule_wait_timeout=rule_wait_timeout,
+                                      label=f"{target}/" if len(targets) > 1 else "",
+                                      rebuild=True)
+        for git_sub_path, e in failures.items():
+            logger.warning(f"Failed to rebuild {images[git_sub_path]}{where}: {e}")
+        # a failed rebuild is tried again by the next refresh.
+        store.put_many(str(target), {images[git_sub_path]: digest
+                                     for git_sub_path, digest in changed.items()
+                                     if git_sub_path not in failures})
+        for git_sub_path in changed:
+            if git_sub_path not in failures:
+                print(f"rebuilt{where}: {images[git_sub_path]}")
+        logger.info(f"{len(changed) - len(failures)} image(s) rebuilt{where}, {len(failures)} failed, "
+                    f"{len(first_seen)} seen for the first time.")
+
+    await gather(*[refresh_target(target, cr)
+                   for target, cr in zip(targets, crs or [None] * len(targets))])
+    for cr in crs:
+        await cr.close()
+    store.close()
+
+
+@cli.command("plan")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.argument("github-namespace", envvar='MIRROR_OP_GITHUB_NAMESPACE',
+                default='nanoric-public-cd')
+@click.argument("github-repo", envvar='MIRROR_OP_GITHUB_REPO', default='docker-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-cr_image")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos queried at the same time.")
+@click.option("--rule-limit", type=int, default=DEFAULT_RULE_LIMIT, show_default=True,
+              help="build rules per repo, tags beyond it reuse idle rules.")
+@click.option("--delete-orphans/--keep-orphans", "delete_orphans", default=False,
+              help="plan to delete repos of the namespace without local Dockerfiles.")
+@click.option("--out", "out", type=click.File("wt"), default="-",
+              help="write the plan here, '-' for stdout.")
+@cache_options
+@api_options
+def cli_plan(
+    **kwargs,
+):
+    """
+    compare the local Dockerfiles with the CR namespace and write the changes as a json plan.
+    """
+    return run_until_complete(async_cli_plan(**kwargs))
+
+
+async def async_cli_plan(
+    aliyun_cr_region: str,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    github_namespace: str,
+    github_repo: str,
+    out,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    rule_limit: int = DEFAULT_RULE_LIMIT,
+    delete_orphans: bool = False,
+    **cr_options,
+):
+    from asyncio import gather
+    from cr_state import CRState
+    from plan import Plan, Target, make_plan
+    cr = open_cr(
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        aliyun_cr_region=aliyun_cr_region,
+        aliyun_cr_namespace=aliyun_cr_namespace,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    head = None
+    if os.path.isdir(os.path.join(local_git_repo, ".git")):
+        try:
+            head = Git(cwd=local_git_repo).rev_parse()
+        except subprocess.CalledProcessError:
+            logger.debug(f"{local_git_repo} has no commit yet.")
+    state = CRState(cr, rule_limit=rule_limit)
+    repos, groups = await gather(state.repos(), group_local_repo(local_git_repo))
+    targets = {
+        repo_name: [Target(repo=repo_name,
+                           tag=cr_tag_name(image_from_git_sub_path(git_sub_path)),
+                           dockerfile_dir=f'/{git_sub_path}/')
+                    for git_sub_path in git_sub_paths]
+        for repo_name, git_sub_paths in groups.items()
+    }
+    plan = Plan(namespace=aliyun_cr_namespace,
+                region=aliyun_cr_region,
+                github_namespace=github_namespace,
+                github_repo=github_repo,
+                head=head,
+                )
+    await make_plan(state, targets, plan,
+                    rule_limit=rule_limit,
+                    delete_orphans=delete_orphans,
+                    concurrency=concurrency,
+                    )
+    await cr.close()
+    plan.dump(out)
+    logger.info(f"plan: {plan.summary()}")
+
+
+@cli.command("apply")
+@click.argument("plan-file", type=click.File("rt"))
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.option("--local-git-repo", default="./docker-cr_image",
+              help="the git repo the plan was made from, for its cache and last synced commit.")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos changed at the same time.")
+@cache_options
+@api_options
+def cli_apply(
+    **kwargs,
+):
+    """
+    execute a plan written by the plan command, '-' reads it from stdin.
+    """
+    return run_until_complete(async_cli_apply(**kwargs))
+
+
+async def async_cli_apply(
+    plan_file,
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    **cr_options,
+):
+    from aliyun_cr import CRTarget
+    from plan import Plan, apply_plan
+    plan = Plan.load(plan_file)
+    if plan.empty():
+        logger.info("nothing to apply.")
+    cr = open_cr(
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        aliyun_cr_region=plan.region,
+        aliyun_cr_namespace=plan.namespace,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    failures = await apply_plan(cr, plan, concurrency=concurrency)
+    await cr.close()
+    for (repo_name, tag), e in sorted(failures.items(), key=lambda i: (i[0][0], i[0][1] or '')):
+        logger.warning(f"Failed to apply {repo_name}{'' if tag is None else ':' + tag}: {e}")
+    if failures:
+        logger.warning(f"{len(failures)} change(s) failed.")
+    if plan.deferred:
+        logger.info(f"{len(plan.deferred)} image(s) wait for an idle build rule, plan again later.")
+    if plan.head is not None and os.path.isdir(os.path.join(local_git_repo, ".git")) \
+            and not failures and not plan.deferred and not plan.failed:
+        write_file(last_sync_path(local_git_repo, CRTarget(region=plan.region, namespace=plan.namespace)),
+                   plan.head)
+
+
+@cli.command("clear")
+@click.argument("aliyun-cr-access_key", envvar='MIRROR_OP_CR_ACCESS_KEY')
+@click.argument("aliyun-cr-access_secret", envvar='MIRROR_OP_CR_ACCESS_SECRET')
+@click.argument("aliyun-cr-namespace", envvar='MIRROR_OP_CR_NAMESPACE', default='zh-mirror')
+@click.option("--aliyun-cr-region", default="cn-shanghai")
+@click.option("--local-git-repo", default="./docker-cr_image")
+@click.option("--concurrency", type=click.IntRange(min=1), default=16, show_default=True,
+              help="number of repos deleted at the same time.")
+@click.option("--match", "patterns", multiple=True,
+              help="only repos whose name matches this glob, repeatable.")
+@click.option("--regex", "regexes", multiple=True,
+              help="only repos whose name matches this regular expression, repeatable.")
+@click.option("--orphans-only/--all-repos", "orphans_only", default=False,
+              help="only repos without Dockerfiles in the local git repo.")
+@click.option("--empty-only/--with-tags", "empty_only", default=False,
+              help="only repos without tags.")
+@click.option("--older-than", type=float, default=None,
+              help="only repos not modified for this many days.")
+@click.option("--dry-run/--no-dry-run", "dry_run", default=False,
+              help="print the repos that would be deleted.")
+@cache_options
+@api_options
+def cli_clear(
+    **kwargs,
+):
+    """
+    delete the repos of the namespace, or the ones matching all given filters.
+    """
+    return run_until_complete(async_cli_clear(**kwargs))
+
+
+def match_repo_name(name: str, patterns=(), regexes=()) -> bool:
+    """
+    True if `name` matches any of the globs or regexes, or if there are none.
+    """
+    if not patterns and not regexes:
+        return True
+    return any(fnmatchcase(name, p) for p in patterns) or any(re.search(r, name) for r in regexes)
+
+
+async def async_cli_clear(
+    aliyun_cr_access_key: str,
+    aliyun_cr_access_secret: str,
+    aliyun_cr_namespace: str,
+    aliyun_cr_region: str,
+    local_git_repo: str = './docker-cr_image',
+    concurrency: int = 16,
+    patterns=(),
+    regexes=(),
+    orphans_only: bool = False,
+    empty_only: bool = False,
+    older_than: float = None,
+    dry_run: bool = False,
+    **cr_options,
+):
+    from aliyun_cr import CRTarget
+    from cr_state import CRState
+    cr = open_cr(
+        aliyun_cr_access_key=aliyun_cr_access_key,
+        aliyun_cr_access_secret=aliyun_cr_access_secret,
+        aliyun_cr_region=aliyun_cr_region,
+        aliyun_cr_namespace=aliyun_cr_namespace,
+        local_git_repo=local_git_repo,
+        **cr_options,
+    )
+    state = CRState(cr)
+    cr_repos = await state.repos()
+    logger.debug(f'# of repos : {len(cr_repos)}')
+    local_repos = set(await group_local_repo(local_git_repo)) if orphans_only else set()
+    deadline = None if older_than is None else time.time() - older_than * 86400
+
+    candidates = []
+    for repo in cr_repos.values():
+        if repo.namespace != aliyun_cr_namespace:
+            continue
+        if not match_repo_name(repo.name, patterns, regexes):
+            continue
+        if orphans_only and repo.name in local_repos:
+            continue
+        if deadline is not None:
+            modified = repo.modified or repo.created
+            if modified is None or modified > deadline:
+                continue
+        candidates.append(repo.name)
+    action = "checking" if dry_run else "deleting"
+    logger.info(f"{action} {len(candidates)} of {len(cr_repos)} repo(s).")
+    progress = Progress(len(candidates), action)
+    kept = 0
+    deleted = 0
+
+    async def clear(repo_name: str):
+        nonlocal kept, deleted
+        repo = cr_repos[repo_name]
+        try:
+            # tags are asked from the server, a stale cache must not delete a repo in use.
+            if empty_only and await state.tags(repo.name, use_cache=False):
+                kept += 1
+                progress.advance(skipped=True)
+                return
+            if dry_run:
+                print(f"{repo.namespace}/{repo.name}")
+            else:
+                logger.debug(f"deleting {repo.namespace}/{repo.name}")
+                await cr.delete_repo(repo_name=repo.name, namespace=repo.namespace)
+                deleted += 1
+        except Exception:
+            progress.advance(failed=True)
+            raise
+        progress.advance()
+
+    failures = await run_pool(candidates, clear, concurrency)
+    progress.finish()
+    if kept:
+        logger.info(f"{kept} repo(s) kept, they have tags.")
+    for repo_name, e in failures.items():
+        logger.warning(f"Failed to delete {aliyun_cr_namespace}/{repo_name}: {e}")
+    if deleted:
+        # the next incremental build would skip the Dockerfiles of the deleted repos.
+        path = last_sync_path(local_git_repo, CRTarget(region=aliyun_cr_region, namespace=aliyun_cr_namespace))
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info(f"{path} removed, the next build scans the whole local repo.")
+    await cr.close()
+
+
+def mkdir(path: str):
+    if os.path.exists(path):
+        return
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        mkdir(os.path.dirname(path))
+    return os.mkdir(path)
+
+
+def write_file(path: str, content: str):
+    mkdir(os.path.dirname(path))
+    with open(path, "wt") as f:
+        f.write(content)
+
+
+def read_file(path: str):
+    with open(path, 'rt') as f:
+        return f.read()
+
+
+def cr_registry(cr_region: str):
+    return f'registry.{cr_region}.aliyuncs.com'
+
+
+def cr_image_name(cr_region: str, cr_namespace: str, image: str):
+    return f'{cr_registry(cr_region)}/{cr_namespace}/{cr_repo_name(image)}:{cr_tag_name(image)}'
+
+
+def cr_tag_name(image: str):
+    return mirror_name(image)[1]
+
+
+def cr_info(image: str):
+    tag = cr_tag_name(image)
+    repo_name = cr_repo_name(image)
+    return tag, repo_name
+
+
+def cr_repo_name(image: str):
+    return mirror_name(image)[0]
+
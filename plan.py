@@ -0,0 +1,266 @@
+import json
+import logging
+import time
+from asyncio import Semaphore, gather
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from aliyun_cr import AliyunCR, BuildStatus
+from cr_state import CRState
+from rule_slots import DEFAULT_RULE_LIMIT, RuleSlots
+
+logger = logging.getLogger(__file__)
+
+PLAN_VERSION = 1
+
+
+@dataclass()
+class Target:
+    repo: str
+    tag: str
+    dockerfile_dir: str
+
+
+@dataclass()
+class RuleChange:
+    repo: str
+    tag: str
+    dockerfile_dir: str
+    # None to create a rule, else the rule to edit.
+    rule_id: Optional[str] = None
+    # tag the edited rule was building.
+    replaces: Optional[str] = None
+
+
+@dataclass()
+class BuildTrigger:
+    repo: str
+    tag: str
+    # None for the rule created for the tag by the same plan.
+    rule_id: Optional[str] = None
+
+
+@dataclass()
+class Plan:
+    """
+    changes that bring a CR namespace to the local Dockerfiles, see `make_plan` and `apply_plan`.
+    """
+    namespace: str
+    region: str
+    github_namespace: str
+    github_repo: str
+    # commit of the local git repo the plan was made from.
+    head: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    create_repos: List[str] = field(default_factory=list)
+    rules: List[RuleChange] = field(default_factory=list)
+    builds: List[BuildTrigger] = field(default_factory=list)
+    delete_repos: List[str] = field(default_factory=list)
+    # tags left for a later plan because every rule of their repo is busy.
+    deferred: List[Target] = field(default_factory=list)
+    # tags whose last build failed, they are not retried.
+    failed: List[Target] = field(default_factory=list)
+    # repos without local Dockerfiles that are kept.
+    orphans: List[str] = field(default_factory=list)
+
+    def to_json(self) -> dict:
+        return {"version": PLAN_VERSION, **asdict(self)}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Plan':
+        data = dict(data)
+        version = data.pop("version", None)
+        if version != PLAN_VERSION:
+            raise ValueError(f"unsupported plan version: {version}, expect {PLAN_VERSION}")
+        return cls(
+            **{k: v for k, v in data.items() if k not in ("rules", "builds", "deferred", "failed")},
+            rules=[RuleChange(**i) for i in data.get("rules", [])],
+            builds=[BuildTrigger(**i) for i in data.get("builds", [])],
+            deferred=[Target(**i) for i in data.get("deferred", [])],
+            failed=[Target(**i) for i in data.get("failed", [])],
+        )
+
+    def dump(self, f):
+        json.dump(self.to_json(), f, indent=2)
+        f.write("\n")
+
+    @classmethod
+    def load(cls, f) -> 'Plan':
+        return cls.from_json(json.load(f))
+
+    def empty(self) -> bool:
+        return not (self.create_repos or self.rules or self.builds or self.delete_repos)
+
+    def summary(self) -> str:
+        return (f"{len(self.create_repos)} repo(s) to create, "
+                f"{len([i for i in self.rules if i.rule_id is None])} rule(s) to create, "
+                f"{len([i for i in self.rules if i.rule_id is not None])} rule(s) to edit, "
+                f"{len(self.builds)} build(s) to trigger, "
+                f"{len(self.delete_repos)} repo(s) to delete, "
+                f"{len(self.deferred)} deferred, {len(self.failed)} failed, "
+                f"{len(self.orphans)} orphan(s) kept")
+
+
+class _Recorder:
+    """
+    stands in for AliyunCR in the RuleSlots of a plan, records the calls instead of making them.
+    """
+    NEW = "new:"
+
+    def __init__(self, plan: Plan, rules: list):
+        self.plan = plan
+        self.rules = rules
+
+    async def create_build_rule(self, repo_name: str, dockerfile_dir: str, tag: str):
+        self.plan.rules.append(RuleChange(repo=repo_name, tag=tag, dockerfile_dir=dockerfile_dir))
+        return f"{self.NEW}{tag}"
+
+    async def edit_build_rule(self, repo_name: str, rule_id: str, dockerfile_dir: str, tag: str):
+        replaces = next((r.tag for r in self.rules if str(r.id) == str(rule_id)), None)
+        self.plan.rules.append(RuleChange(repo=repo_name, tag=tag, dockerfile_dir=dockerfile_dir,
+                                          rule_id=str(rule_id), replaces=replaces))
+
+    async def build_by_rule(self, repo_name: str, rule_id: str):
+        rule_id = str(rule_id)
+        self.plan.builds.append(BuildTrigger(
+            repo=repo_name,
+            tag=rule_id[len(self.NEW):] if rule_id.startswith(self.NEW) else
+            next(r.tag for r in self.rules if str(r.id) == rule_id),
+            rule_id=None if rule_id.startswith(self.NEW) else rule_id,
+        ))
+
+
+async def _no_builds():
+    return []
+
+
+async def make_plan(state: CRState,
+                    targets: Dict[str, List[Target]],
+                    plan: Plan,
+                    rule_limit: int = DEFAULT_RULE_LIMIT,
+                    delete_orphans: bool = False,
+                    concurrency: int = 16,
+                    ) -> Plan:
+    """
+    fill `plan` with the changes that build every target, one concurrent pass over the repos.
+
+    a missing tag with a rule is triggered again only if the rule has never built it, a tag
+    without a rule gets one as `build` would give it, see RuleSlots.
+    :param targets: {repo_name: [target, ...]} of the local Dockerfiles.
+    """
+    repos = await state.repos()
+    semaphore = Semaphore(concurrency)
+
+    async def plan_repo(repo_name: str):
+        async with semaphore:
+            if repo_name in repos:
+                rules = list(await state.rules(repo_name))
+
+                async def builds():
+                    return await state.builds(repo_name)
+
+                missing = [t for t in targets[repo_name] if not await state.has_tag(repo_name, t.tag)]
+            else:
+                plan.create_repos.append(repo_name)
+                rules = []
+                builds = _no_builds
+                missing = targets[repo_name]
+            if not missing:
+                return
+            slots = RuleSlots(_Recorder(plan, rules), repo_name, rules=rules, builds=builds,
+                              limit=rule_limit)
+            by_tag = {r.tag: r for r in rules}
+            latest = {}
+            if [t for t in missing if t.tag in by_tag]:
+                # builds come newest first.
+                for b in await builds():
+                    latest.setdefault(b.tag, b)
+            for t in missing:
+                rule = by_tag.get(t.tag)
+                if rule is None:
+                    continue
+                b = latest.get(t.tag)
+                if b is None:
+                    plan.builds.append(BuildTrigger(repo=repo_name, tag=t.tag, rule_id=str(rule.id)))
+                    slots.busy.add(t.tag)
+                elif b.status == BuildStatus.FAILED:
+                    plan.failed.append(t)
+            for t in missing:
+                if t.tag not in by_tag:
+                    await slots.acquire(t.tag, t.dockerfile_dir)
+            plan.deferred.extend(Target(repo=repo_name, tag=tag, dockerfile_dir=dockerfile_dir)
+                                 for tag, dockerfile_dir in slots.queue.items())
+
+    await gather(*[plan_repo(repo_name) for repo_name in targets])
+    for repo_name, repo in repos.items():
+        if repo_name not in targets and repo.namespace == plan.namespace:
+            (plan.delete_repos if delete_orphans else plan.orphans).append(repo_name)
+
+    plan.create_repos.sort()
+    plan.rules.sort(key=lambda i: (i.repo, i.tag))
+    plan.builds.sort(key=lambda i: (i.repo, i.tag))
+    plan.delete_repos.sort()
+    plan.deferred.sort(key=lambda i: (i.repo, i.tag))
+    plan.failed.sort(key=lambda i: (i.repo, i.tag))
+    plan.orphans.sort()
+    return plan
+
+
+async def apply_plan(cr: AliyunCR, plan: Plan, concurrency: int = 16) -> Dict[Tuple[str, str], Exception]:
+    """
+    execute a plan without querying the CR state again, repos are applied concurrently,
+    the changes of a repo one after another.
+    :return: {(repo_name, tag): exception} of failed changes, tag is None for repo changes.
+    """
+    failures = {}
+    semaphore = Semaphore(concurrency)
+    create_repos = set(plan.create_repos)
+    rules: Dict[str, Dict[str, RuleChange]] = {}
+    for change in plan.rules:
+        rules.setdefault(change.repo, {})[change.tag] = change
+    builds: Dict[str, List[BuildTrigger]] = {}
+    for trigger in plan.builds:
+        builds.setdefault(trigger.repo, []).append(trigger)
+
+    async def apply_repo(repo_name: str):
+        async with semaphore:
+            if repo_name in create_repos:
+                try:
+                    await cr.create_repo(name=repo_name,
+                                         github_namespace=plan.github_namespace,
+                                         github_repo=plan.github_repo)
+                except Exception as e:
+                    failures[(repo_name, None)] = e
+                    return
+                logger.info(f"created repo {repo_name}.")
+            for trigger in builds.get(repo_name, []):
+                rule_id = trigger.rule_id
+                try:
+                    change = rules.get(repo_name, {}).get(trigger.tag)
+                    if change is not None and change.rule_id is None:
+                        rule_id = await cr.create_build_rule(repo_name=repo_name,
+                                                             dockerfile_dir=change.dockerfile_dir,
+                                                             tag=change.tag)
+                    elif change is not None:
+                        await cr.edit_build_rule(repo_name=repo_name,
+                                                 rule_id=change.rule_id,
+                                                 dockerfile_dir=change.dockerfile_dir,
+                                                 tag=change.tag)
+                    await cr.build_by_rule(repo_name=repo_name, rule_id=rule_id)
+                except Exception as e:
+                    failures[(repo_name, trigger.tag)] = e
+                    continue
+                logger.info(f"triggered {repo_name}:{trigger.tag}.")
+
+    async def delete_repo(repo_name: str):
+        async with semaphore:
+            try:
+                await cr.delete_repo(repo_name=repo_name, namespace=plan.namespace)
+            except Exception as e:
+                failures[(repo_name, None)] = e
+                return
+            logger.info(f"deleted repo {repo_name}.")
+
+    await gather(*[apply_repo(repo_name) for repo_name in sorted(create_repos | set(builds))],
+                 *[delete_repo(repo_name) for repo_name in plan.delete_repos])
+    return failures
@@ -0,0 +1,353 @@
+"""
+client of the docker registry HTTP API v2, used to look up upstream images and to copy them,
+see registry_copy.py.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Mapping, Optional, Tuple
+from urllib.parse import quote, urlencode, urljoin
+
+from cr_transport import CRServerError
+from http_client import Body, HttpClient, HttpResponse
+from image_ref import split_image
+from throttle import RetryPolicy, call_with_retry
+
+logger = logging.getLogger(__file__)
+
+DOCKER_HUB = "docker.io"
+DOCKER_HUB_ENDPOINT = "https://registry-1.docker.io"
+
+MANIFEST_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+
+_CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+class RegistryError(CRServerError):
+    """
+    an error response of a registry, retried like the API errors: 429 and 5xx are retryable.
+    """
+
+    def __init__(self, http_status: int, code: str, message: str, action: str = None):
+        super().__init__(http_status=http_status, code=code, message=message, action=action)
+        self.args = (f"{action}: HTTP {http_status} {code}: {message}",)
+
+
+def locate(image: str) -> Tuple[str, str]:
+    """
+    :return: (registry, repository path in it), official docker hub images are under library/.
+    """
+    repository = split_image(image).repository
+    first, _, rest = repository.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        return first, rest
+    if not rest:
+        return DOCKER_HUB, f"library/{repository}"
+    return DOCKER_HUB, repository
+
+
+def parse_endpoints(items) -> Dict[str, str]:
+    """
+    parse ["docker.io=http://127.0.0.1:5000", ...] into {"docker.io": "http://127.0.0.1:5000", ...}.
+    """
+    endpoints = {}
+    for item in items:
+        registry, _, url = item.partition("=")
+        if not registry or not url:
+            raise ValueError(f"invalid registry endpoint: {item}, expect <registry>=<url>")
+        endpoints[registry] = url.rstrip("/")
+    return endpoints
+
+
+class RegistryClient:
+    """
+    pooled keep-alive connections and at most `concurrency` requests in flight per registry.
+
+    anonymous or basic credentials are exchanged for bearer tokens when a registry asks for them,
+    tokens are kept per repository scope until they expire, and requested before the first call
+    to a new repository once the registry's token service is known.
+    """
+
+    def __init__(self,
+                 endpoints: Mapping[str, str] = None,
+                 credentials: Mapping[str, Tuple[str, str]] = None,
+                 concurrency: int = 8,
+                 max_attempts: int = 5,
+                 timeout: float = 30,
+                 ):
+        """
+        :param endpoints: {registry: base url}, defaults to https://<registry>.
+        :param credentials: {registry: (username, password)}
+        """
+        self.endpoints = dict(endpoints or {})
+        self.credentials = dict(credentials or {})
+        self.concurrency = concurrency
+        self.retry = RetryPolicy(max_attempts=max_attempts)
+        # a blob copy within one registry holds a download and an upload connection.
+        self.client = HttpClient(max_connections=2 * concurrency, timeout=timeout)
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+        # {registry: www-authenticate params of its bearer challenge}
+        self._challenges: Dict[str, Dict[str, str]] = {}
+        # {(registry, scope): future of (authorization header, expiry)}
+        self._tokens: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def base_url(self, registry: str) -> str:
+        if registry in self.endpoints:
+            return self.endpoints[registry]
+        if registry == DOCKER_HUB:
+            return DOCKER_HUB_ENDPOINT
+        return f"https://{registry}"
+
+    def _registry_slots(self, registry: str) -> asyncio.Semaphore:
+        slots = self._slots.get(registry)
+        if slots is None:
+            slots = self._slots[registry] = asyncio.Semaphore(self.concurrency)
+        return slots
+
+    async def request(self,
+                      registry: str,
+                      method: str,
+                      path: str,
+                      scope: str,
+                      headers: Mapping[str, str] = None,
+                      body: bytes = None,
+                      ok=(200,),
+                      url: str = None,
+                      ) -> HttpResponse:
+        """
+        a request to `<base url>/v2/<path>`, authenticated for `scope`, with retries.
+        :param scope: token scope, several scopes are separated by spaces.
+        :param ok: statuses that are not errors.
+        :param url: absolute url to call instead, e.g. an upload location; `path` still names the action.
+        """
+        url = url or f"{self.base_url(registry)}/v2/{path}"
+        slots = self._registry_slots(registry)
+
+        async def call():
+            async with slots:
+                return await self._request(registry, method, url, scope, headers, body, ok)
+
+        # e.g. "HEAD manifests", the metrics of a kind of call, whatever the image.
+        action = f"{method} {path.rsplit('/', 2)[-2]}"
+        return await call_with_retry(action, call, retry=self.retry)
+
+    async def _request(self, registry, method, url, scope, headers, body: Body, ok) -> HttpResponse:
+        headers = dict(headers or {})
+        auth = await self._authorization(registry, scope)
+        if auth is not None:
+            headers["Authorization"] = auth
+        res = await self.client.request(method, url, headers=headers, body=body)
+        if res.status == 401 and "www-authenticate" in res.headers and isinstance(body, (bytes, type(None))):
+            # a fresh token for the scope, or the first challenge of the registry.
+            self._tokens.pop((registry, scope), None)
+            self._challenge(registry, res.headers["www-authenticate"])
+            auth = await self._authorization(registry, scope)
+            if auth is not None:
+                headers["Authorization"] = auth
+                res = await self.client.request(method, url, headers=headers, body=body)
+        if res.status not in ok:
+            raise _error(res, f"{method} {url}")
+        return res
+
+    def _challenge(self, registry: str, header: str):
+        scheme, _, params = header.partition(" ")
+        if scheme.lower() == "bearer":
+            self._challenges[registry] = dict(_CHALLENGE_PARAM.findall(params))
+        elif scheme.lower() == "basic" and registry not in self.credentials:
+            raise RegistryError(http_status=401, code="UNAUTHORIZED",
+                                message="basic auth without credentials", action=registry)
+
+    async def _authorization(self, registry: str, scope: str) -> Optional[str]:
+        challenge = self._challenges.get(registry)
+        if challenge is None:
+            if registry in self.credentials:
+                return _basic(*self.credentials[registry])
+            return None
+        key = (registry, scope)
+        future = self._tokens.get(key)
+        if future is not None and future.done() and (
+                future.exception() is not None or future.result()[1] < time.monotonic()):
+            future = None
+        if future is None:
+            future = self._tokens[key] = asyncio.ensure_future(self._fetch_token(registry, challenge, scope))
+        try:
+            return (await asyncio.shield(future))[0]
+        except Exception:
+            if self._tokens.get(key) is future:
+                del self._tokens[key]
+            raise
+
+    async def _fetch_token(self, registry: str, challenge: Dict[str, str], scope: str):
+        query = [("scope", s) for s in scope.split()]
+        if "service" in challenge:
+            query.append(("service", challenge["service"]))
+        headers = {}
+        if registry in self.credentials:
+            headers["Authorization"] = _basic(*self.credentials[registry])
+        res = await self.client.request("GET", f"{challenge['realm']}?{urlencode(query)}", headers=headers)
+        if res.status != 200:
+            raise _error(res, f"token of {registry}")
+        data = json.loads(res.body)
+        token = data.get("token") or data.get("access_token")
+        # renew a little before the expiry, 60s is the default of the token spec.
+        expiry = time.monotonic() + max(float(data.get("expires_in", 60)) - 10, 1)
+        return f"Bearer {token}", expiry
+
+    async def manifest_digest(self, image: str) -> str:
+        """
+        :return: digest of the manifest (or index) `image` refers to now, without downloading it.
+        """
+        ref = split_image(image)
+        if ref.digest:
+            return ref.digest
+        registry, path = locate(image)
+        reference = ref.tag or "latest"
+        scope = f"repository:{path}:pull"
+        headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+        res = await self.request(registry, "HEAD", f"{path}/manifests/{reference}", scope, headers)
+        digest = res.headers.get("docker-content-digest")
+        if digest:
+            return digest
+        # not every registry sends the digest on HEAD.
+        res = await self.request(registry, "GET", f"{path}/manifests/{reference}", scope, headers)
+        return res.headers.get("docker-content-digest") or f"sha256:{hashlib.sha256(res.body).hexdigest()}"
+
+    async def get_manifest(self, registry: str, path: str, reference: str) -> Tuple[bytes, str, str]:
+        """
+        :return: (raw manifest, media type, digest), the raw bytes are what the digest is of.
+        """
+        headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+        res = await self.request(registry, "GET", f"{path}/manifests/{reference}",
+                                 f"repository:{path}:pull", headers)
+        media_type = res.headers.get("content-type", "").split(";")[0].strip()
+        if media_type not in MANIFEST_TYPES:
+            media_type = json.loads(res.body).get("mediaType") or media_type
+        digest = res.headers.get("docker-content-digest") or f"sha256:{hashlib.sha256(res.body).hexdigest()}"
+        return res.body, media_type, digest
+
+    async def put_manifest(self, registry: str, path: str, reference: str, manifest: bytes,
+                           media_type: str) -> str:
+        """
+        :return: digest of the manifest.
+        """
+        res = await self.request(registry, "PUT", f"{path}/manifests/{reference}",
+                                 f"repository:{path}:pull,push", {"Content-Type": media_type},
+                                 manifest, ok=(200, 201))
+        return res.headers.get("docker-content-digest") or f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+
+    async def find_manifest(self, registry: str, path: str, reference: str) -> Optional[str]:
+        """
+        :return: digest of a manifest, None if there is no such manifest.
+        """
+        headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+        res = await self.request(registry, "HEAD", f"{path}/manifests/{reference}",
+                                 f"repository:{path}:pull,push", headers, ok=(200, 404))
+        if res.status == 404:
+            return None
+        return res.headers.get("docker-content-digest") or ""
+
+    async def has_blob(self, registry: str, path: str, digest: str) -> bool:
+        res = await self.request(registry, "HEAD", f"{path}/blobs/{digest}",
+                                 f"repository:{path}:pull,push", ok=(200, 404))
+        return res.status == 200
+
+    async def start_upload(self, registry: str, path: str, digest: str = None,
+                           mount_from: str = None) -> Optional[str]:
+        """
+        start a blob upload, or mount the blob from another repository of the registry.
+        :return: the upload location, None if the blob was mounted.
+        """
+        scope = f"repository:{path}:pull,push"
+        query = ""
+        if mount_from is not None:
+            scope += f" repository:{mount_from}:pull"
+            query = f"?mount={quote(digest)}&from={quote(mount_from)}"
+        res = await self.request(registry, "POST", f"{path}/blobs/uploads/{query}", scope,
+                                 ok=(201, 202))
+        if res.status == 201:
+            return None
+        if "location" not in res.headers:
+            raise RegistryError(http_status=res.status, code="NO_LOCATION",
+                                message="upload without location", action=f"POST {path}/blobs/uploads/")
+        return urljoin(f"{self.base_url(registry)}/v2/{path}/blobs/uploads/", res.headers["location"])
+
+    async def transfer_blob(self, src_registry: str, src_path: str, registry: str, path: str,
+                            location: str, digest: str, size: int) -> int:
+        """
+        finish an upload of `start_upload` with one monolithic PUT that streams the blob from the
+        source as it is downloaded, nothing but the chunk in flight is held in memory.
+        not retried, a failed upload has to start over.
+        it takes a slot of the destination only: the download is bounded by its upload, so the
+        same registry as source and destination needs at most twice its slots of connections.
+        :return: bytes transferred.
+        """
+        url = f"{location}{'&' if '?' in location else '?'}digest={quote(digest)}"
+        headers = {"Content-Type": "application/octet-stream", "Content-Length": str(size)}
+        sent = 0
+
+        async def counted(chunks):
+            nonlocal sent
+            async for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+
+        async with self._registry_slots(registry):
+            async with self._open_blob(src_registry, src_path, digest) as res:
+                await self._request(registry, "PUT", url, f"repository:{path}:pull,push", headers,
+                                    counted(res.chunks), (201, 204))
+        if sent != size:
+            raise RegistryError(http_status=0, code="SIZE_INVALID", action=f"copy {digest}",
+                                message=f"{sent} bytes transferred, expected {size}")
+        return sent
+
+    @asynccontextmanager
+    async def _open_blob(self, registry: str, path: str, digest: str) -> AsyncIterator[HttpResponse]:
+        """
+        a blob download, its body is read from `res.chunks`. a redirect to the storage of the
+        registry, which docker hub and most others answer with, is followed without credentials.
+        """
+        url = f"{self.base_url(registry)}/v2/{path}/blobs/{digest}"
+        headers = {}
+        auth = await self._authorization(registry, f"repository:{path}:pull")
+        if auth is not None:
+            headers["Authorization"] = auth
+        async with self.client.stream("GET", url, headers) as res:
+            location = res.headers.get("location")
+            if res.status == 200:
+                yield res
+                return
+            if res.status not in (301, 302, 303, 307, 308) or not location:
+                raise _error(res, f"GET {url}")
+        async with self.client.stream("GET", urljoin(url, location)) as res:
+            if res.status != 200:
+                raise _error(res, f"GET {location}")
+            yield res
+
+    async def close(self):
+        await self.client.close()
+
+
+def _basic(username: str, password: str) -> str:
+    return "Basic " + base64.b64encode(f"{username}:{password}".encode()).decode()
+
+
+def _error(res: HttpResponse, what: str) -> RegistryError:
+    code, message = res.reason, ""
+    try:
+        errors = json.loads(res.body).get("errors") or []
+    except (ValueError, AttributeError):
+        errors = []
+    if errors:
+        code = errors[0].get("code") or code
+        message = errors[0].get("message") or ""
+    return RegistryError(http_status=res.status, code=code, message=message or what, action=what)
@@ -0,0 +1,199 @@
+"""
+the copy backend of `mirror-op.py build`: images are copied from their upstream registry into
+the Aliyun registry over the registry API v2, instead of being built from a Dockerfile.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from image_ref import split_image
+from metrics import metrics
+from registry import RegistryClient, locate
+from throttle import call_with_retry
+
+logger = logging.getLogger(__file__)
+
+INDEX_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+)
+
+
+class ImageCopier:
+    """
+    copies manifests and the blobs they refer to, blobs are streamed from the source straight
+    into the destination.
+
+    a blob the destination repository has already is skipped after a HEAD. the first copy of a
+    blob into a registry uploads it, later copies into other repositories of that registry wait
+    for it and mount it from there, so a base layer shared by hundreds of images is uploaded once.
+    blobs of an image are transferred concurrently, at most `transfers` at a time overall.
+    """
+
+    def __init__(self,
+                 client: RegistryClient,
+                 transfers: int = 8,
+                 platforms: Iterable[str] = (),
+                 ):
+        """
+        :param platforms: ["linux/amd64", ...], copy only these platforms of multi-platform images,
+                          all of them if empty.
+        """
+        self.client = client
+        self.transfers = asyncio.Semaphore(transfers)
+        self.platforms = set(platforms)
+        # {(registry, path, digest): copy of a blob into a repository}
+        self._blobs: Dict[Tuple[str, str, str], asyncio.Future] = {}
+        # {(registry, digest): future of a repository path the blob exists in, None if its upload failed}
+        self._homes: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.stats = Counter()
+
+    async def copy(self, image: str, registry: str, path: str, tag: str) -> str:
+        """
+        copy `image` to `<registry>/<path>:<tag>`.
+        :return: "exists" if the tag is the image already, else "copied".
+        """
+        src_registry, src_path = locate(image)
+        ref = split_image(image)
+        reference = ref.digest or ref.tag or "latest"
+        manifest, media_type, digest = await self.client.get_manifest(src_registry, src_path, reference)
+        manifest, media_type, digest = await self._select_platforms(src_registry, src_path,
+                                                                    manifest, media_type, digest)
+        if await self.client.find_manifest(registry, path, tag) == digest:
+            self.stats["manifest exists"] += 1
+            return "exists"
+        await self._copy_manifest(src_registry, src_path, registry, path, manifest, media_type)
+        await self.client.put_manifest(registry, path, tag, manifest, media_type)
+        self.stats["manifest"] += 1
+        return "copied"
+
+    async def _select_platforms(self, registry: str, path: str, manifest: bytes, media_type: str,
+                                digest: str) -> Tuple[bytes, str, str]:
+        """
+        filter an index by `platforms`. a single platform left is copied as a plain manifest,
+        so the mirror tag keeps working for clients that can't read indexes.
+        :return: (manifest, media type, digest) to copy.
+        """
+        if not self.platforms or media_type not in INDEX_TYPES:
+            return manifest, media_type, digest
+        index = json.loads(manifest)
+        children = [m for m in index.get("manifests", []) if _platform(m) in self.platforms]
+        if not children:
+            raise ValueError(f"{path}: none of the platforms {sorted(self.platforms)} in "
+                             f"{sorted(filter(None, map(_platform, index.get('manifests', []))))}")
+        if len(children) == 1:
+            return await self.client.get_manifest(registry, path, children[0]["digest"])
+        index["manifests"] = children
+        manifest = json.dumps(index, separators=(",", ":")).encode()
+        return manifest, media_type, f"sha256:{hashlib.sha256(manifest).hexdigest()}"
+
+    async def _copy_manifest(self, src_registry: str, src_path: str, registry: str, path: str,
+                             manifest: bytes, media_type: str):
+        """
+        copy what a manifest refers to: the manifests of an index, or the config and layers of an image.
+        """
+        data = json.loads(manifest)
+        if media_type in INDEX_TYPES:
+            async def child(descriptor: dict):
+                raw, child_type, digest = await self.client.get_manifest(
+                    src_registry, src_path, descriptor["digest"])
+                await self._copy_manifest(src_registry, src_path, registry, path, raw, child_type)
+                await self.client.put_manifest(registry, path, descriptor["digest"], raw, child_type)
+                self.stats["manifest"] += 1
+
+            await asyncio.gather(*[child(d) for d in data.get("manifests", [])])
+            return
+        blobs = [data["config"]] if "config" in data else []
+        # foreign layers (windows base images) are pulled from their own urls, never pushed.
+        blobs += [layer for layer in data.get("layers", []) if not layer.get("urls")]
+        await asyncio.gather(*[self.ensure_blob(src_registry, src_path, registry, path,
+                                                blob["digest"], blob["size"]) for blob in blobs])
+
+    async def ensure_blob(self, src_registry: str, src_path: str, registry: str, path: str,
+                          digest: str, size: int):
+        """
+        make blob `digest` exist in the repository `path` of `registry`, once per repository.
+        """
+        key = (registry, path, digest)
+        future = self._blobs.get(key)
+        if future is None or (future.done() and future.exception() is not None):
+            future = self._blobs[key] = asyncio.ensure_future(
+                self._ensure_blob(src_registry, src_path, registry, path, digest, size))
+        await asyncio.shield(future)
+
+    async def _ensure_blob(self, src_registry, src_path, registry, path, digest, size):
+        if await self.client.has_blob(registry, path, digest):
+            self.stats["blob exists"] += 1
+            self._homes.setdefault((registry, digest), _done(path))
+            return
+        while (registry, digest) in self._homes:
+            mount_from = await asyncio.shield(self._homes[(registry, digest)])
+            if mount_from is None:
+                # its upload failed, the next waiter uploads it.
+                continue
+            if mount_from == path:
+                return
+            location = await self.client.start_upload(registry, path, digest, mount_from)
+            if location is None:
+                self.stats["blob mounted"] += 1
+                return
+            # the registry didn't mount, e.g. no pull access to the other repository.
+            await self._upload(src_registry, src_path, registry, path, digest, size, location)
+            return
+        home = self._homes[(registry, digest)] = asyncio.get_event_loop().create_future()
+        try:
+            await self._upload(src_registry, src_path, registry, path, digest, size)
+        except BaseException:
+            # the next copy of the blob uploads it again.
+            home.set_result(None)
+            if self._homes.get((registry, digest)) is home:
+                del self._homes[(registry, digest)]
+            raise
+        home.set_result(path)
+
+    async def _upload(self, src_registry: str, src_path: str, registry: str, path: str,
+                      digest: str, size: int, location: Optional[str] = None):
+        async def attempt():
+            nonlocal location
+            # an upload location is good for one attempt only.
+            url, location = location or await self.client.start_upload(registry, path), None
+            return await self.client.transfer_blob(src_registry, src_path, registry, path, url, digest, size)
+
+        async with self.transfers:
+            with metrics.duration("copy", "blob"):
+                sent = await call_with_retry("copy blob", attempt, retry=self.client.retry)
+        self.stats["blob uploaded"] += 1
+        self.stats["bytes uploaded"] += sent
+
+
+def _platform(descriptor: dict) -> Optional[str]:
+    platform = descriptor.get("platform")
+    if not platform:
+        return None
+    name = f"{platform.get('os')}/{platform.get('architecture')}"
+    if platform.get("variant"):
+        name += f"/{platform['variant']}"
+    return name
+
+
+def _done(value) -> asyncio.Future:
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(value)
+    return future
+
+
+def parse_platforms(items: Iterable[str]) -> List[str]:
+    """
+    parse ["linux/amd64,linux/arm64", "linux/arm/v7"] into ["linux/amd64", "linux/arm64", "linux/arm/v7"].
+    """
+    platforms = []
+    for item in items:
+        for platform in item.split(","):
+            platform = platform.strip()
+            if platform.count("/") not in (1, 2):
+                raise ValueError(f"invalid platform: {platform}, expect <os>/<arch>[/<variant>]")
+            platforms.append(platform)
+    return platforms
@@ -0,0 +1,219 @@
+import logging
+from asyncio import Lock
+from itertools import count
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from aliyun_cr import AliyunCR, BuildInfo, BuildRule, BuildStatus
+from cr_transport import CRServerError
+from defaults import DEFAULT_RULE_LIMIT
+from watcher import TIMEOUT_REASON, BuildWatcher
+
+logger = logging.getLogger(__file__)
+
+
+class RuleSlots:
+    """
+    the build rules of one repo, used as a fixed number of slots.
+
+    a repo has at most `limit` build rules. once they are all created, a new tag takes over
+    the least recently used idle rule, a rule is busy while a build of its tag is pending or
+    building. tags that find no idle rule are queued, `release` hands the rule of a finished
+    build to the first of them.
+
+    the rule count is tracked locally, the rules are listed once per repo and the builds
+    once, when the first rule has to be recycled.
+    """
+
+    def __init__(self,
+                 cr: AliyunCR,
+                 repo_name: str,
+                 rules: List[BuildRule],
+                 builds: Callable[[], Awaitable[List[BuildInfo]]],
+                 limit: int = DEFAULT_RULE_LIMIT,
+                 ):
+        """
+        :param rules: rules of the repo, updated in place.
+        :param builds: fetches the builds of the repo, most recent first.
+        """
+        self.cr = cr
+        self.repo_name = repo_name
+        self.rules = rules
+        self.limit = limit
+        # {tag: dockerfile_dir}, in arrival order
+        self.queue: Dict[str, str] = {}
+        # tags of busy rules
+        self.busy: Set[str] = set()
+        # {tag: exception} of queued tags whose rule couldn't be set up
+        self.failed: Dict[str, Exception] = {}
+        self._builds = builds
+        # {rule id: recency}, larger is more recent
+        self._used: Dict[str, int] = {}
+        self._clock = count()
+        self._synced = False
+        self._lock = Lock()
+
+    async def _sync(self):
+        """
+        find the busy rules and the order rules were last used in from the builds of the repo.
+        """
+        if self._synced:
+            return
+        builds = await self._builds()
+        self._synced = True
+        position = {}
+        for i, b in enumerate(builds):
+            position.setdefault(b.tag, i)
+            if b.status in (BuildStatus.PENDING, BuildStatus.BUILDING):
+                self.busy.add(b.tag)
+        for rule in self.rules:
+            # never built rules come first, rules used in this run last.
+            self._used.setdefault(str(rule.id), -position.get(rule.tag, len(builds)))
+
+    def _use(self, rule: BuildRule):
+        self.rules[:] = [r for r in self.rules if str(r.id) != str(rule.id)] + [rule]
+        self._used[str(rule.id)] = next(self._clock)
+        self.busy.add(rule.tag)
+
+    async def _idle_rule(self) -> Optional[BuildRule]:
+        await self._sync()
+        idle = [r for r in self.rules if r.tag not in self.busy]
+        if not idle:
+            return None
+        return min(idle, key=lambda r: self._used.get(str(r.id), float('-inf')))
+
+    async def _assign(self, tag: str, dockerfile_dir: str):
+        rule = next((r for r in self.rules if r.tag == tag), None)
+        if rule is not None:
+            # a rebuild of a built tag, or a queued rebuild whose previous build finished.
+            self._use(rule)
+            return rule.id
+        if len(self.rules) < self.limit:
+            try:
+                rule_id = await self.cr.create_build_rule(
+                    repo_name=self.repo_name,
+                    dockerfile_dir=dockerfile_dir,
+                    tag=tag,
+                )
+            except CRServerError as e:
+                if e.http_status >= 500 or not self.rules:
+                    raise
+                # rules created by others, or a lower limit than expected.
+                logger.warning(f"Failed to create a build rule in {self.repo_name} ({e}), "
+                               f"using its {len(self.rules)} rule(s) as the limit.")
+                self.limit = len(self.rules)
+            else:
+                self._use(BuildRule(id=rule_id, tag=tag, dockerfile_dir=dockerfile_dir))
+                return rule_id
+        rule = await self._idle_rule()
+        if rule is None:
+            return None
+        logger.info(f"Rule limit of {self.repo_name} reached, "
+                    f"recycling rule {rule.id} of tag {rule.tag} for {tag}.")
+        await self.cr.edit_build_rule(
+            repo_name=self.repo_name,
+            rule_id=str(rule.id),
+            dockerfile_dir=dockerfile_dir,
+            tag=tag,
+        )
+        self._use(BuildRule(id=rule.id, tag=tag, dockerfile_dir=dockerfile_dir))
+        return rule.id
+
+    async def acquire(self, tag: str, dockerfile_dir: str, rebuild: bool = False):
+        """
+        point a rule at `tag` and trigger its build.
+        :param rebuild: build a tag that has a rule already again, it is queued while its
+                        current build is pending or building.
+        :return: id of the rule, None if every rule is busy and the tag is queued.
+        """
+        async with self._lock:
+            if rebuild:
+                await self._sync()
+            if rebuild and tag in self.busy:
+                rule_id = None
+            else:
+                rule_id = await self._assign(tag, dockerfile_dir)
+            if rule_id is None:
+                self.queue[tag] = dockerfile_dir
+                return None
+        try:
+            await self.cr.build_by_rule(repo_name=self.repo_name, rule_id=rule_id)
+        except Exception:
+            self.busy.discard(tag)
+            raise
+        return rule_id
+
+    async def release(self, tag: str = None) -> Optional[str]:
+        """
+        mark the build of `tag` finished, its rule goes to the first queued tag.
+        :return: the tag whose build was triggered, None if none was.
+        """
+        if tag is not None:
+            self.busy.discard(tag)
+        while self.queue:
+            next_tag = next(iter(self.queue))
+            dockerfile_dir = self.queue.pop(next_tag)
+            try:
+                if await self.acquire(next_tag, dockerfile_dir) is None:
+                    return None
+                return next_tag
+            except Exception as e:
+                logger.warning(f"Failed to build {self.repo_name}:{next_tag}: {e}")
+                self.failed[next_tag] = e
+        return None
+
+
+async def drain(cr: AliyunCR,
+                slots: List[RuleSlots],
+                min_interval: float = 5,
+                max_interval: float = 120,
+                concurrency: int = 16,
+                timeout: float = None,
+                on_triggered: Callable[[str, str], None] = None,
+                ) -> Dict[str, Dict[str, Exception]]:
+    """
+    build the queued tags in waves: the busy rules of repos with queued tags are watched, every
+    finished build hands its rule to the next queued tag, a repo is dropped once its queue is empty.
+    :param on_triggered: called with (repo_name, tag) once the build of a queued tag is triggered.
+    :return: {repo_name: {tag: exception}} of the queued tags that weren't built.
+    """
+    by_repo = {s.repo_name: s for s in slots if s.queue}
+
+    async def release(s: RuleSlots, tag: str = None):
+        next_tag = await s.release(tag)
+        if next_tag is not None:
+            watcher.add(s.repo_name, next_tag, f"{s.repo_name}:{next_tag}")
+            if on_triggered is not None:
+                on_triggered(s.repo_name, next_tag)
+
+    async def finished(label: str, reason: str = None):
+        if reason == TIMEOUT_REASON:
+            return
+        repo_name, _, tag = label.partition(":")
+        s = by_repo[repo_name]
+        await release(s, tag)
+        if not s.queue:
+            watcher.discard(repo_name)
+
+    watcher = BuildWatcher(cr,
+                           on_ready=finished,
+                           on_failed=finished,
+                           min_interval=min_interval,
+                           max_interval=max_interval,
+                           concurrency=concurrency,
+                           )
+    for s in by_repo.values():
+        if not s.busy:
+            # a rule was freed by a failed trigger while the queue was filled.
+            await release(s)
+        for tag in s.busy:
+            watcher.add(s.repo_name, tag, f"{s.repo_name}:{tag}")
+    await watcher.run(timeout=timeout)
+
+    left = {}
+    for s in by_repo.values():
+        failed = dict(s.failed)
+        for tag in s.queue:
+            failed[tag] = TimeoutError(f"no build rule of {s.repo_name} became idle.")
+        if failed:
+            left[s.repo_name] = failed
+    return left
@@ -0,0 +1,180 @@
+"""
+scanner of the Dockerfiles of the local mirror repo, off the event loop.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__file__)
+
+# seconds a directory mtime has to be older than the scan to be trusted by the index, a directory
+# changed within the same mtime tick as its listing would look unchanged on the next scan.
+RACY_SECONDS = 2.0
+
+
+def prune(name: str) -> bool:
+    """
+    directories never holding images: .git, .github, ... no repository or tag starts with a dot.
+    """
+    return name.startswith(".")
+
+
+def default_index_path(local_git_repo: str) -> Optional[str]:
+    """
+    the index lives in the .git dir of the local repo, like the registry cache.
+    :return: None if local_git_repo is not a git repository.
+    """
+    git_dir = os.path.join(local_git_repo, ".git")
+    if not os.path.isdir(git_dir):
+        return None
+    return os.path.join(git_dir, "mirror-op-scan-index.json")
+
+
+class ScanIndex:
+    """
+    the directories of the last scan: {relative path: [mtime_ns, has Dockerfile, [subdirectories]]}.
+
+    the mtime of a directory changes when an entry is added to, removed from or renamed in it,
+    so a directory whose mtime is unchanged isn't listed again, only its subdirectories are
+    checked, with a stat each.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, list] = {}
+        self.reused = 0
+        self.listed = 0
+        try:
+            with open(path, "rt") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f"ignoring the broken scan index {path}: {e}")
+
+    def get(self, rel: str, mtime_ns: int) -> Optional[Tuple[bool, List[str]]]:
+        entry = self.entries.get(rel)
+        if entry is None or entry[0] != mtime_ns:
+            return None
+        return entry[1], entry[2]
+
+    def save(self, entries: Dict[str, list]):
+        """
+        replace the index with the directories of a scan, unless it found them all unchanged.
+        """
+        if not self.listed and entries.keys() == self.entries.keys():
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wt") as f:
+            f.write(json.dumps(entries, separators=(",", ":")))
+        os.replace(tmp, self.path)
+        self.entries = entries
+
+
+def walk(local_git_repo: str,
+         emit: Callable[[str], None],
+         index: ScanIndex = None,
+         stop: threading.Event = None,
+         ):
+    """
+    call `emit(git_sub_path)` for every directory holding a Dockerfile, blocking.
+    :param index: skip listing the directories it has unchanged, and update it.
+    :param stop: abandon the walk once it is set.
+    """
+    racy_after = time.time_ns() - int(RACY_SECONDS * 1e9)
+    seen = {}
+    stack = [""]
+    while stack:
+        if stop is not None and stop.is_set():
+            return
+        rel = stack.pop()
+        path = os.path.join(local_git_repo, rel) if rel else local_git_repo
+        cached = None
+        mtime_ns = None
+        if index is not None:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            cached = index.get(rel, mtime_ns)
+        if cached is not None:
+            has_dockerfile, subdirs = cached
+            index.reused += 1
+        else:
+            has_dockerfile, subdirs = False, []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not prune(entry.name):
+                                subdirs.append(entry.name)
+                        elif entry.name == "Dockerfile":
+                            has_dockerfile = True
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if index is not None:
+                index.listed += 1
+        if index is not None and mtime_ns < racy_after:
+            seen[rel] = [mtime_ns, has_dockerfile, subdirs]
+        # a Dockerfile at the top is no image.
+        if has_dockerfile and rel:
+            emit(rel)
+        stack.extend(f"{rel}/{d}" if rel else d for d in reversed(subdirs))
+    if index is not None:
+        index.save(seen)
+
+
+async def scan_local_repo(local_git_repo: str,
+                          index_path: str = None,
+                          batch_size: int = 256,
+                          ) -> AsyncIterator[str]:
+    """
+    the git_sub_path of every Dockerfile of the local repo, streamed as the walk on a worker
+    thread finds them, the event loop keeps serving the API calls in flight meanwhile.
+    :param index_path: keep a ScanIndex in this file.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    index = ScanIndex(index_path) if index_path is not None else None
+    done = object()
+    batch = []
+
+    def emit(git_sub_path: str):
+        batch.append(git_sub_path)
+        if len(batch) >= batch_size:
+            flush()
+
+    def flush():
+        if batch:
+            loop.call_soon_threadsafe(queue.put_nowait, batch[:])
+            batch.clear()
+
+    def run():
+        try:
+            walk(local_git_repo, emit, index=index, stop=stop)
+            flush()
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    worker = loop.run_in_executor(None, run)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            for git_sub_path in item:
+                yield git_sub_path
+    finally:
+        stop.set()
+        await worker
+    if index is not None:
+        logger.debug(f"scan index: {index.reused} director(ies) unchanged, {index.listed} listed.")
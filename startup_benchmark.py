@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+startup benchmark of the offline mirror-op.py commands, `name` and `copy`, which scripts like
+batch_copy.sh run once per image.
+
+every command runs `--runs` times in its own process, its median wall time is reported next to
+the one of a bare interpreter. fails if a command imports one of the modules of the registry
+API, or if its median is more than `--budget-ms` above the bare interpreter's.
+
+    python startup_benchmark.py --runs 20 --budget-ms 150
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Set
+
+import click
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+mirror_op = os.path.join(my_dir, "mirror-op.py")
+
+# modules only the commands talking to the registries may import.
+API_MODULES = (
+    "asyncio",
+    "async_git",
+    "ssl",
+    "sqlite3",
+    "aliyunsdkcore",
+    "aliyunsdkcr",
+    "aliyun_cr",
+    "cr_transport",
+    "cr_state",
+    "http_client",
+    "registry",
+    "state_cache",
+)
+
+
+def wall_times(args: List[str], runs: int) -> List[float]:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def imported_modules(args: List[str]) -> Set[str]:
+    """
+    the modules a command imports, from the report of `python -X importtime`.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", *args[1:]],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    modules = set()
+    # import time: <self us> | <cumulative us> | <indented module name>
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and not line.endswith("imported package"):
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return modules
+
+
+@click.command()
+@click.option("--runs", type=int, default=20, show_default=True,
+              help="processes started per command.")
+@click.option("--budget-ms", type=float, default=150, show_default=True,
+              help="milliseconds a command may take above the bare interpreter, median.")
+@click.option("--image", default="library/nginx:1.25", show_default=True)
+@click.option("--json-out", type=click.File("wt"), default=None, help="write results as json here.")
+def main(runs: int, budget_ms: float, image: str, json_out=None):
+    results = []
+    failed = False
+    with tempfile.TemporaryDirectory() as local_git_repo:
+        subprocess.run(["git", "init", "-q", local_git_repo], check=True)
+        commands = {
+            "python": [sys.executable, "-c", "pass"],
+            "name": [sys.executable, mirror_op, "name", image],
+            "copy": [sys.executable, mirror_op, "copy", "--no-commit", "--no-push",
+                     "--local-git-repo", local_git_repo, image],
+        }
+        baseline = None
+        for command, args in commands.items():
+            median = statistics.median(wall_times(args, runs))
+            result = {"command": command, "median_wall_time": round(median, 4)}
+            if baseline is None:
+                baseline = median
+            else:
+                result["above_python_ms"] = round((median - baseline) * 1000, 1)
+                result["api_modules"] = sorted(imported_modules(args).intersection(API_MODULES))
+                result["ok"] = result["above_python_ms"] <= budget_ms and not result["api_modules"]
+                failed |= not result["ok"]
+            results.append(result)
+            print(f"{command:<6} {median * 1000:>8.1f}ms"
+                  + (f" +{result['above_python_ms']:.1f}ms"
+                     f" api modules: {','.join(result['api_modules']) or '-'}"
+                     f" {'ok' if result['ok'] else 'FAILED'}" if "ok" in result else ""))
+    if json_out is not None:
+        json.dump(results, json_out, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Optional
+
+
+class StateCache:
+    """
+    sqlite backed cache of registry metadata, read through by AliyunCR.
+
+    entries are json values keyed by (kind, key), kind is one of "repo", "rule" and "tag".
+    an entry older than the ttl of its kind is treated as missing.
+    """
+    DEFAULT_TTL: Dict[str, float] = {
+        "repo": 3600,
+        "rule": 3600,
+        "tag": 300,
+    }
+
+    def __init__(self,
+                 path: str,
+                 ttl: Dict[str, float] = None,
+                 refresh: bool = False,
+                 ):
+        """
+        :param path: sqlite file.
+        :param ttl: seconds an entry stays valid, per kind.
+        :param refresh: if this is true, every read is a miss, writes still go to the cache.
+        """
+        self.path = path
+        self.ttl = {**self.DEFAULT_TTL, **(ttl or {})}
+        self.refresh = refresh
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " kind TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (kind, key))"
+        )
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        if self.refresh:
+            return None
+        row = self.db.execute("SELECT value, updated FROM entries WHERE kind=? AND key=?",
+                              (kind, key)).fetchone()
+        if row is None:
+            return None
+        value, updated = row
+        if time.time() - updated > self.ttl.get(kind, 0):
+            return None
+        return json.loads(value)
+
+    def put(self, kind: str, key: str, value: Any):
+        self.db.execute("INSERT OR REPLACE INTO entries (kind, key, value, updated) VALUES (?,?,?,?)",
+                        (kind, key, json.dumps(value), time.time()))
+
+    def modify(self, kind: str, key: str, fn: Callable[[Any], Any]):
+        """
+        write through: replace the value of a valid entry with fn(value), keeping its timestamp.
+        entries that are missing or expired are left alone.
+        """
+        row = self.db.execute("SELECT value, updated FROM entries WHERE kind=? AND key=?",
+                              (kind, key)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl.get(kind, 0):
+            return
+        self.db.execute("UPDATE entries SET value=? WHERE kind=? AND key=?",
+                        (json.dumps(fn(json.loads(row[0]))), kind, key))
+
+    def delete(self, kind: str, key: str):
+        self.db.execute("DELETE FROM entries WHERE kind=? AND key=?", (kind, key))
+
+    def close(self):
+        self.db.close()
+
+
+class DigestStore:
+    """
+    digests of upstream images as of their last mirror build, per target, see `refresh`.
+
+    kept in their own table of the cache file: they don't expire and --refresh doesn't ignore them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            " target TEXT NOT NULL,"
+            " image TEXT NOT NULL,"
+            " digest TEXT NOT NULL,"
+            " updated REAL NOT NULL,"
+            " PRIMARY KEY (target, image))"
+        )
+
+    def get_all(self, target: str) -> Dict[str, str]:
+        """
+        :return: {image: digest} of a target, "<region>/<namespace>".
+        """
+        return dict(self.db.execute("SELECT image, digest FROM digests WHERE target=?", (target,)))
+
+    def put_many(self, target: str, digests: Dict[str, str]):
+        now = time.time()
+        # one transaction, the connection autocommits otherwise.
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO digests (target, image, digest, updated) VALUES (?,?,?,?)",
+                [(target, image, digest, now) for image, digest in digests.items()])
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+
+def default_cache_path(local_git_repo: str) -> Optional[str]:
+    """
+    the cache lives in the .git dir of the local repo, so it is never committed.
+    :return: None if local_git_repo is not a git repository.
+    """
+    git_dir = os.path.join(local_git_repo, ".git")
+    if not os.path.isdir(git_dir):
+        return None
+    return os.path.join(git_dir, "mirror-op-cache.sqlite")
+
+
+def parse_ttl(items) -> Dict[str, float]:
+    """
+    parse ["repo=600", "tag=60"] into {"repo": 600, "tag": 60}.
+    """
+    ttl = {}
+    for item in items:
+        kind, _, seconds = item.partition("=")
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            seconds = None
+        if kind not in StateCache.DEFAULT_TTL or seconds is None:
+            raise ValueError(f"invalid cache ttl: {item}, expect one of "
+                             f"{'/'.join(StateCache.DEFAULT_TTL)}=<seconds>")
+        ttl[kind] = seconds
+    return ttl
@@ -0,0 +1,2 @@
+# namespace of the AliyunCR clients of the tests, see conftest.open_cr.
+NAMESPACE = "ns"
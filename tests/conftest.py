@@ -0,0 +1,56 @@
+import pytest
+
+from fake_cr import FakeCR
+from tests import NAMESPACE
+
+
+@pytest.fixture()
+def fake_cr():
+    """
+    a FakeCR served on a free port, its endpoint is fake_cr.endpoint.
+    """
+    fake = FakeCR(build_time=0)
+    server = fake.serve()
+    fake.endpoint = f"127.0.0.1:{server.server_port}"
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def open_cr(fake_cr):
+    """
+    create an AliyunCR of the fake, to be called in the event loop of the test.
+    """
+    from aliyun_cr import AliyunCR
+
+    def open_cr(**kwargs) -> AliyunCR:
+        kwargs.setdefault("qps", 1000)
+        return AliyunCR("key", "secret", namespace=NAMESPACE, endpoint=fake_cr.endpoint, **kwargs)
+
+    return open_cr
+
+
+def serve_registry():
+    from fake_registry import FakeRegistry
+    fake = FakeRegistry()
+    server = fake.serve()
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def upstream():
+    """
+    a FakeRegistry served on a free port, to copy images from.
+    """
+    yield from serve_registry()
+
+
+@pytest.fixture()
+def mirror():
+    """
+    a FakeRegistry served on a free port, to copy images into.
+    """
+    yield from serve_registry()
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from cr_state import CRState, ImageStatus
+from cr_transport import CRServerError
+from tests import NAMESPACE
+
+
+def test_concurrent_callers_share_one_request(fake_cr, open_cr):
+    fake_cr.add_repo(NAMESPACE, "nginx", tags=["1.25"])
+
+    async def main():
+        cr = open_cr()
+        state = CRState(cr)
+        results = await asyncio.gather(*[state.tags("nginx") for _ in range(20)])
+        await cr.close()
+        return results
+
+    results = asyncio.run(main())
+    assert all(r == {"1.25"} for r in results)
+    assert fake_cr.calls["GetRepoTags"] == 1
+
+
+def test_failures_are_not_memoized(fake_cr, open_cr):
+    async def main():
+        cr = open_cr(max_attempts=1)
+        state = CRState(cr)
+        with pytest.raises(CRServerError):
+            await state.tags("nginx")
+        fake_cr.add_repo(NAMESPACE, "nginx", tags=["1.25"])
+        tags = await state.tags("nginx")
+        await cr.close()
+        return tags
+
+    assert asyncio.run(main()) == {"1.25"}
+    assert fake_cr.calls["GetRepoTags"] == 2
+
+
+def test_image_status(fake_cr, open_cr):
+    fake_cr.add_repo(NAMESPACE, "nginx", tags=["1.25"])
+
+    async def main():
+        cr = open_cr()
+        state = CRState(cr)
+        statuses = [(await state.image_status(repo, tag))[0]
+                    for repo, tag in [("redis", "7"), ("nginx", "1.25"), ("nginx", "1.26")]]
+        await cr.close()
+        return statuses
+
+    assert asyncio.run(main()) == [ImageStatus.NO_REPO, ImageStatus.READY, ImageStatus.NO_RULE]
+
+
+def test_ensure_repo_creates_once(fake_cr, open_cr):
+    async def main():
+        cr = open_cr()
+        state = CRState(cr)
+        created = await asyncio.gather(*[state.ensure_repo("nginx", None, None) for _ in range(10)])
+        await cr.close()
+        return created
+
+    assert sorted(asyncio.run(main())) == [False] * 9 + [True]
+    assert fake_cr.calls["CreateRepo"] == 1
+    assert (NAMESPACE, "nginx") in fake_cr.repos
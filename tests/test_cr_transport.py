@@ -0,0 +1,56 @@
+import base64
+import hashlib
+import hmac
+
+import pytest
+
+from cr_transport import parse_endpoint, sign_headers
+
+HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "Content-MD5": "1B2M2Y8AsgTpgAmY7PhCfg==",
+    "Date": "Thu, 01 Jan 2026 00:00:00 GMT",
+    "x-acs-version": "2016-06-07",
+    "x-acs-region-id": "cn-shanghai",
+    "x-acs-signature-method": "HMAC-SHA1",
+    "x-acs-signature-version": "1.0",
+}
+
+
+def test_sign_headers():
+    signed = sign_headers("GET", "/repos/ns/nginx/tags", {"RegionId": "cn-shanghai", "Page": "2"},
+                          HEADERS, "key", "secret")
+    string_to_sign = (
+        "GET\napplication/json\n1B2M2Y8AsgTpgAmY7PhCfg==\napplication/json\n"
+        "Thu, 01 Jan 2026 00:00:00 GMT\n"
+        "x-acs-region-id:cn-shanghai\nx-acs-signature-method:HMAC-SHA1\n"
+        "x-acs-signature-version:1.0\nx-acs-version:2016-06-07\n"
+        "/repos/ns/nginx/tags?Page=2&RegionId=cn-shanghai"
+    )
+    signature = base64.b64encode(hmac.new(b"secret", string_to_sign.encode(), hashlib.sha1).digest())
+    assert signed["Authorization"] == f"acs key:{signature.decode()}"
+    assert {k: v for k, v in signed.items() if k != "Authorization"} == HEADERS
+
+
+def test_sign_headers_like_aliyunsdkcore():
+    composer = pytest.importorskip("aliyunsdkcore.auth.composer.roa_signature_composer")
+    from aliyunsdkcore.auth.algorithm import sha_hmac1
+    queries = {"RegionId": "cn-shanghai", "PageSize": "100", "Page": "1"}
+    paths = {"RepoNamespace": "ns", "RepoName": "quay.io_443_coreos_etcd"}
+    string_to_sign = composer.compose_string_to_sign(
+        method="PUT", queries=dict(queries), uri_pattern="/repos/[RepoNamespace]/[RepoName]/rules",
+        headers=HEADERS, paths=paths)
+    expected = sha_hmac1.get_sign_string(string_to_sign, secret="secret")
+    signed = sign_headers("PUT", "/repos/ns/quay.io_443_coreos_etcd/rules", queries, HEADERS,
+                          "key", "secret")
+    assert signed["Authorization"] == f"acs key:{expected}"
+
+
+@pytest.mark.parametrize("endpoint, expected", [
+    ("cr.cn-shanghai.aliyuncs.com", ("http", "cr.cn-shanghai.aliyuncs.com", 80)),
+    ("127.0.0.1:8080", ("http", "127.0.0.1", 8080)),
+    ("https://cr.cn-shanghai.aliyuncs.com", ("https", "cr.cn-shanghai.aliyuncs.com", 443)),
+])
+def test_parse_endpoint(endpoint, expected):
+    assert parse_endpoint(endpoint) == expected
@@ -0,0 +1,63 @@
+import asyncio
+
+from fake_registry import digest_of
+from http_client import HttpClient
+
+BLOB = b"x" * 10000
+
+
+def idle(client: HttpClient):
+    return [conn for conns in client._idle.values() for conn in conns]
+
+
+def test_a_stream_read_to_its_end_is_pooled(upstream):
+    upstream.push("a", "1", layers=[BLOB])
+
+    async def main():
+        client = HttpClient()
+        url = f"{upstream.url}/v2/a/blobs/{digest_of(BLOB)}"
+        async with client.stream("GET", url, chunk_size=1000) as res:
+            body = b"".join([chunk async for chunk in res.chunks])
+        pooled = idle(client)
+        # the pooled connection takes the next request.
+        res = await client.request("GET", url)
+        reused = idle(client) == pooled
+        await client.close()
+        return body, len(pooled), res.body, reused
+
+    assert asyncio.run(main()) == (BLOB, 1, BLOB, True)
+
+
+def test_a_stream_left_half_read_is_closed(upstream):
+    upstream.push("a", "1", layers=[BLOB])
+
+    async def main():
+        client = HttpClient()
+        url = f"{upstream.url}/v2/a/blobs/{digest_of(BLOB)}"
+        async with client.stream("GET", url, chunk_size=1000) as res:
+            async for _ in res.chunks:
+                break
+        pooled = idle(client)
+        # a new connection, not the one with the rest of the body pending.
+        res = await client.request("GET", url)
+        await client.close()
+        return pooled, res.body
+
+    assert asyncio.run(main()) == ([], BLOB)
+
+
+def test_a_streamed_body_without_length_is_chunked(mirror):
+    async def main():
+        client = HttpClient()
+        res = await client.request("POST", f"{mirror.url}/v2/a/blobs/uploads/")
+
+        async def chunks():
+            for _ in range(10):
+                yield BLOB[:1000]
+
+        put = await client.request("PUT", f"{mirror.url}{res.headers['location']}&digest={digest_of(BLOB)}",
+                                   body=chunks())
+        await client.close()
+        return put.status
+
+    assert asyncio.run(main()) == 201
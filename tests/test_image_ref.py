@@ -0,0 +1,54 @@
+import pytest
+
+from image_ref import ImageRef, image_sub_path, mirror_name, parse_image, split_image
+
+DIGEST = "sha256:" + "ab" * 32
+
+
+@pytest.mark.parametrize("image, expected", [
+    ("nginx", ("nginx", "latest")),
+    ("library/nginx:1.25", ("library_nginx", "1.25")),
+    ("quay.io/coreos/etcd:v3.5.0", ("quay.io_coreos_etcd", "v3.5.0")),
+    # a registry port is not a tag.
+    ("quay.io:443/coreos/etcd", ("quay.io_443_coreos_etcd", "latest")),
+    ("quay.io:443/coreos/etcd:v3.5.0", ("quay.io_443_coreos_etcd", "v3.5.0")),
+    # tags can't contain ':'.
+    (f"nginx@{DIGEST}", ("nginx", "sha256-" + "ab" * 32)),
+    (f"nginx:1.25@{DIGEST}", ("nginx", "sha256-" + "ab" * 32)),
+])
+def test_mirror_name(image, expected):
+    assert mirror_name(image) == expected
+
+
+def test_mirror_names_of_distinct_tags_differ():
+    assert mirror_name("a/b:c") != mirror_name("a/b:d")
+    assert mirror_name("a/b@" + DIGEST) != mirror_name("a/b:latest")
+
+
+@pytest.mark.parametrize("image, expected", [
+    ("library/nginx:1.25", "library/nginx/1.25"),
+    ("quay.io:443/coreos/etcd", "quay.io_443/coreos/etcd/latest"),
+    (f"nginx@{DIGEST}", "nginx/sha256-" + "ab" * 32),
+])
+def test_image_sub_path(image, expected):
+    assert image_sub_path(image) == expected
+
+
+def test_split_image():
+    assert split_image("quay.io:443/coreos/etcd") == ImageRef("quay.io:443/coreos/etcd")
+    assert split_image(f"quay.io:443/etcd:v1@{DIGEST}") == ImageRef("quay.io:443/etcd", "v1", DIGEST)
+    assert str(split_image(f"quay.io:443/etcd:v1@{DIGEST}")) == f"quay.io:443/etcd:v1@{DIGEST}"
+
+
+@pytest.mark.parametrize("image, expected", [
+    ("nginx", ImageRef("nginx")),
+    ("'library/nginx:1.25'", ImageRef("library/nginx", "1.25")),
+    ("quay.io:443/coreos/etcd:v3", ImageRef("quay.io:443/coreos/etcd", "v3")),
+    (f"nginx@{DIGEST}", ImageRef("nginx", digest=DIGEST)),
+    ("${BASE_IMAGE}", None),
+    ("nginx:{{ version }}", None),
+    ("Nginx", None),
+    ("nginx@sha256:short", None),
+])
+def test_parse_image(image, expected):
+    assert parse_image(image) == expected
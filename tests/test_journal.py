@@ -0,0 +1,125 @@
+import json
+import os
+
+import pytest
+
+from journal import BUILD, REPO, RULE, Journal
+from mirror_op import group_by_repo, pending_images
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "journal.jsonl")
+
+
+def lines(path: str):
+    with open(path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_record_and_state(path):
+    journal = Journal(path, head="a")
+    journal.record("nginx/1", REPO)
+    journal.record("nginx/1", BUILD, RuntimeError("quota"))
+    journal.record("nginx/2", BUILD)
+    assert journal.done("nginx/1", REPO) and not journal.done("nginx/1", BUILD)
+    assert not journal.done("nginx/3", REPO)
+    assert journal.failed() == {"nginx/1": "quota"}
+    # a step that succeeds after failing isn't failed anymore.
+    journal.record("nginx/1", BUILD)
+    assert journal.failed() == {}
+    journal.close()
+
+
+def test_unchanged_steps_are_not_written_again(path):
+    journal = Journal(path, head="a")
+    for _ in range(3):
+        journal.record("nginx/1", REPO)
+    journal.close()
+    assert len(lines(path)) == 2
+
+
+def test_resume_keeps_the_state_and_head(path):
+    journal = Journal(path, head="a")
+    journal.record("nginx/1", BUILD)
+    journal.record("nginx/2", RULE, ValueError("limit"))
+    journal.close()
+
+    journal = Journal(path, resume=True, head="b")
+    assert journal.head == "a"
+    assert journal.done("nginx/1", BUILD)
+    assert journal.failed() == {"nginx/2": "limit"}
+    journal.record("nginx/2", RULE)
+    journal.close()
+
+    journal = Journal(path, resume=True, head="b")
+    assert journal.failed() == {} and journal.done("nginx/2", RULE)
+    journal.close()
+
+
+def test_start_over_truncates(path):
+    journal = Journal(path, head="a")
+    journal.record("nginx/1", BUILD)
+    journal.close()
+
+    Journal(path, head="b").close()
+    assert [r["run"] for r in lines(path)] == ["start"]
+    journal = Journal(path, resume=True, head="b")
+    assert journal.head == "b" and not journal.done("nginx/1", BUILD)
+    journal.close()
+
+
+def test_resumed_runs_stay_bounded(path):
+    Journal(path, head="a").close()
+    for i in range(10):
+        journal = Journal(path, resume=True, head="a")
+        journal.record("nginx/1", BUILD, None if i % 2 else RuntimeError(str(i)))
+        journal.close()
+    # the start of the compacted state, its step, the start of the last run and its step.
+    assert len(lines(path)) == 4
+    assert not os.path.exists(f"{path}.tmp")
+    journal = Journal(path, resume=True, head="a")
+    assert journal.done("nginx/1", BUILD)
+    journal.close()
+
+
+def test_a_torn_last_line_is_ignored(path):
+    journal = Journal(path, head="a")
+    journal.record("nginx/1", BUILD)
+    journal.close()
+    with open(path, "at") as f:
+        f.write('{"image": "nginx/2", "st')
+
+    journal = Journal(path, resume=True, head="a")
+    assert journal.done("nginx/1", BUILD) and "nginx/2" not in journal.steps
+    journal.close()
+
+
+def test_missing_journal_resumes_from_nothing(path):
+    journal = Journal(path, resume=True, head="a")
+    assert journal.steps == {} and journal.head is None
+    journal.close()
+
+
+def test_pending_images(tmp_path, path):
+    local_git_repo = str(tmp_path / "repo")
+    for git_sub_path in ("library/nginx/1", "library/nginx/2", "library/redis/7"):
+        os.makedirs(os.path.join(local_git_repo, git_sub_path))
+        open(os.path.join(local_git_repo, git_sub_path, "Dockerfile"), "wt").close()
+    groups = group_by_repo(["library/nginx/1", "library/nginx/2", "library/redis/7"])
+
+    journal = Journal(path, head="a")
+    journal.record("library/nginx/1", BUILD)
+    journal.record("library/redis/7", BUILD, RuntimeError("timeout"))
+    # removed from the repo since.
+    journal.record("library/gone/1", BUILD, RuntimeError("timeout"))
+
+    assert pending_images(local_git_repo, groups, None) is groups
+    assert dict(pending_images(local_git_repo, groups, journal, head="a")) == {
+        "library_nginx": ["library/nginx/2"],
+        "library_redis": ["library/redis/7"],
+    }
+    assert dict(pending_images(local_git_repo, groups, journal, head="a", retry_failed=True)) == {
+        "library_redis": ["library/redis/7"],
+    }
+    journal.close()
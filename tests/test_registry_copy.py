@@ -0,0 +1,109 @@
+import asyncio
+import json
+
+import pytest
+
+from fake_registry import digest_of
+from registry import RegistryClient
+from registry_copy import ImageCopier
+
+BASE = b"base layer" * 1000
+CONFIG = b"{}"
+
+
+def open_copier(upstream, mirror, **kwargs) -> ImageCopier:
+    """
+    to be called in the event loop of the test.
+    """
+    kwargs.setdefault("max_attempts", 3)
+    return ImageCopier(RegistryClient(endpoints={"upstream.test": upstream.url, "mirror.test": mirror.url},
+                                      **kwargs))
+
+
+def copy(upstream, mirror, images, **kwargs):
+    """
+    copy every "<repository>:<tag>" of `images` from upstream.test into mirror.test/ns/.
+    :return: (results, copier stats)
+    """
+    async def main():
+        copier = open_copier(upstream, mirror, **kwargs)
+        try:
+            results = await asyncio.gather(*[
+                copier.copy(f"upstream.test/{image}", "mirror.test", f"ns/{image.split(':')[0]}",
+                            image.split(":")[1]) for image in images])
+            return results, copier.stats
+        finally:
+            await copier.client.close()
+
+    return asyncio.run(main())
+
+
+def assert_mirrored(upstream, mirror, name: str, tag: str):
+    digest = mirror.refs[f"ns/{name}"][tag]
+    assert digest == upstream.refs[name][tag]
+    manifest = json.loads(mirror.manifests[digest])
+    for blob in [manifest["config"], *manifest["layers"]]:
+        assert blob["digest"] in mirror.links[f"ns/{name}"]
+        assert digest_of(mirror.blobs[blob["digest"]]) == blob["digest"]
+
+
+@pytest.mark.parametrize("token_auth", [False, True])
+def test_shared_blobs_are_uploaded_once(upstream, mirror, token_auth):
+    upstream.token_auth = mirror.token_auth = token_auth
+    upstream.push("a", "1", layers=[BASE, b"a"], config=CONFIG)
+    upstream.push("b", "1", layers=[BASE, b"b"], config=CONFIG)
+
+    results, stats = copy(upstream, mirror, ["a:1", "b:1"])
+    assert results == ["copied", "copied"]
+    assert_mirrored(upstream, mirror, "a", "1")
+    assert_mirrored(upstream, mirror, "b", "1")
+    # the base layer and the config are uploaded into one repo and mounted into the other.
+    assert stats["blob uploaded"] == 4 and stats["blob mounted"] == 2
+    assert mirror.calls["mounted"] == 2
+    assert mirror.uploaded_bytes == len(BASE) + len(CONFIG) + len(b"a") + len(b"b")
+    assert (upstream.calls["token"] > 0 and mirror.calls["token"] > 0) == token_auth
+
+
+def test_redirected_blob_downloads(upstream, mirror):
+    upstream.redirect_blobs = True
+    upstream.push("a", "1", layers=[BASE, b"a"], config=CONFIG)
+
+    results, stats = copy(upstream, mirror, ["a:1"])
+    assert results == ["copied"]
+    assert_mirrored(upstream, mirror, "a", "1")
+    assert upstream.calls["GET storage"] == 3
+
+
+def test_a_second_copy_exists(upstream, mirror):
+    upstream.push("a", "1", layers=[BASE], config=CONFIG)
+    copy(upstream, mirror, ["a:1"])
+    mirror.reset_stats()
+
+    results, stats = copy(upstream, mirror, ["a:1"])
+    assert results == ["exists"]
+    assert mirror.uploaded_bytes == 0
+    assert "POST uploads" not in mirror.calls and "PUT manifests" not in mirror.calls
+
+
+def test_a_broken_upload_is_retried_on_a_fresh_location(upstream, mirror):
+    upstream.push("a", "1", layers=[BASE], config=CONFIG)
+    mirror.broken_uploads = 1
+
+    async def main():
+        copier = open_copier(upstream, mirror, concurrency=1)
+        try:
+            # one blob at a time, the broken upload is the one of the base layer.
+            await copier.ensure_blob("upstream.test", "a", "mirror.test", "ns/a", digest_of(BASE), len(BASE))
+            idle = [conn for conns in copier.client.client._idle.values() for conn in conns]
+            assert idle and not any(conn.writer.is_closing() for conn in idle)
+            assert await copier.copy("upstream.test/a:1", "mirror.test", "ns/a", "1") == "copied"
+            return copier.stats
+        finally:
+            await copier.client.close()
+
+    stats = asyncio.run(main())
+    assert_mirrored(upstream, mirror, "a", "1")
+    assert mirror.calls["broken uploads"] == 1
+    # a location per attempt, the one of the broken upload is left behind.
+    assert mirror.calls["POST uploads"] == 3 and len(mirror.uploads) == 1
+    assert stats["blob uploaded"] == 2
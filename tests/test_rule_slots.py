@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+from cr_state import CRState
+from fake_cr import FakeBuild
+from tests import NAMESPACE
+
+
+def add_rule(repo, tag: str, rule_id: int):
+    repo.rules[rule_id] = {"buildRuleId": rule_id, "imageTag": tag, "dockerfileLocation": f"/nginx/{tag}"}
+
+
+def rule_tags(repo):
+    return sorted(r["imageTag"] for r in repo.rules.values())
+
+
+def run(open_cr, main, rule_limit: int = 2):
+    async def wrapper():
+        cr = open_cr()
+        try:
+            return await main(CRState(cr, rule_limit=rule_limit))
+        finally:
+            await cr.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_busy_rules_queue_tags_until_released(fake_cr, open_cr):
+    repo = fake_cr.add_repo(NAMESPACE, "nginx")
+
+    async def main(state: CRState):
+        slots = await state.rule_slots("nginx")
+        acquired = [await slots.acquire(tag, f"/nginx/{tag}") for tag in ("1", "2", "3")]
+        queued = dict(slots.queue)
+        released = await slots.release("1")
+        return acquired, queued, released, slots.queue
+
+    acquired, queued, released, queue = run(open_cr, main)
+    assert acquired[0] is not None and acquired[1] is not None and acquired[2] is None
+    assert queued == {"3": "/nginx/3"}
+    assert released == "3" and not queue
+    assert rule_tags(repo) == ["2", "3"]
+    assert fake_cr.calls["CreateRepoBuildRule"] == 2
+    assert fake_cr.calls["UpdateRepoBuildRule"] == 1
+    assert fake_cr.calls["StartRepoBuildByRule"] == 3
+
+
+def test_recycles_the_least_recently_built_rule(fake_cr, open_cr):
+    repo = fake_cr.add_repo(NAMESPACE, "nginx")
+    add_rule(repo, "old", 101)
+    add_rule(repo, "recent", 102)
+    add_rule(repo, "never", 103)
+    # most recent first, both finished long ago.
+    repo.builds = [FakeBuild(id="2", tag="recent", started=0), FakeBuild(id="1", tag="old", started=0)]
+
+    async def main(state: CRState):
+        slots = await state.rule_slots("nginx")
+        recycled = []
+        for tag in ("a", "b", "c", "d"):
+            rule_id = await slots.acquire(tag, f"/nginx/{tag}")
+            await slots.release(tag)
+            recycled.append(rule_id)
+        return recycled
+
+    # never built first, then by the age of their last build, then the rules of this run.
+    assert run(open_cr, main, rule_limit=3) == [103, 101, 102, 103]
+
+
+def test_pending_builds_keep_their_rules_busy(fake_cr, open_cr):
+    fake_cr.build_time = 3600
+    repo = fake_cr.add_repo(NAMESPACE, "nginx")
+    add_rule(repo, "1", 101)
+    add_rule(repo, "2", 102)
+    repo.builds = [FakeBuild(id="1", tag="1", started=time.time())]
+
+    async def main(state: CRState):
+        slots = await state.rule_slots("nginx")
+        return [await slots.acquire(tag, f"/nginx/{tag}") for tag in ("3", "4")]
+
+    assert run(open_cr, main) == [102, None]
+    assert rule_tags(repo) == ["1", "3"]
+
+
+def test_rebuild_of_a_building_tag_is_queued(fake_cr, open_cr):
+    fake_cr.build_time = 3600
+    repo = fake_cr.add_repo(NAMESPACE, "nginx")
+    add_rule(repo, "1", 101)
+    repo.builds = [FakeBuild(id="1", tag="1", started=time.time())]
+
+    async def main(state: CRState):
+        slots = await state.rule_slots("nginx")
+        return await slots.acquire("1", "/nginx/1", rebuild=True), dict(slots.queue)
+
+    assert run(open_cr, main) == (None, {"1": "/nginx/1"})
+    assert fake_cr.calls["StartRepoBuildByRule"] == 0
+
+
+def test_a_lower_server_limit_is_adopted(fake_cr, open_cr):
+    fake_cr.rule_limit = 1
+    repo = fake_cr.add_repo(NAMESPACE, "nginx")
+    add_rule(repo, "1", 101)
+
+    async def main(state: CRState):
+        slots = await state.rule_slots("nginx")
+        rule_id = await slots.acquire("2", "/nginx/2")
+        return rule_id, slots.limit
+
+    assert run(open_cr, main, rule_limit=5) == (101, 1)
+    assert rule_tags(repo) == ["2"]
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import time
+
+from scanner import RACY_SECONDS, ScanIndex, scan_local_repo, walk
+
+# an mtime old enough for the index to trust it.
+OLD = time.time() - 10 * RACY_SECONDS
+
+
+def make_repo(root, *git_sub_paths: str):
+    for git_sub_path in git_sub_paths:
+        os.makedirs(root / git_sub_path, exist_ok=True)
+        (root / git_sub_path / "Dockerfile").write_text(f"FROM {git_sub_path}")
+    age(*[path for path, _, _ in os.walk(root)])
+
+
+def age(*paths, seconds: float = 0):
+    """
+    move the mtime of directories out of the racy window, `seconds` after OLD.
+    """
+    for path in paths:
+        os.utime(path, (OLD + seconds, OLD + seconds))
+
+
+def scan(root, index_path: str):
+    found = []
+    index = ScanIndex(index_path)
+    walk(str(root), found.append, index=index)
+    return sorted(found), index
+
+
+def test_unchanged_directories_are_not_listed_again(tmp_path):
+    repo, index_path = tmp_path / "repo", str(tmp_path / "index.json")
+    make_repo(repo, "library/nginx/1.25", "library/nginx/1.26", "quay.io/etcd/v3")
+
+    found, index = scan(repo, index_path)
+    assert found == ["library/nginx/1.25", "library/nginx/1.26", "quay.io/etcd/v3"]
+    assert index.listed == 8 and index.reused == 0
+
+    found, index = scan(repo, index_path)
+    assert found == ["library/nginx/1.25", "library/nginx/1.26", "quay.io/etcd/v3"]
+    assert index.listed == 0 and index.reused == 8
+
+
+def test_added_and_removed_dockerfiles_are_found(tmp_path):
+    repo, index_path = tmp_path / "repo", str(tmp_path / "index.json")
+    make_repo(repo, "library/nginx/1.25", "library/redis/7")
+    scan(repo, index_path)
+
+    # a new tag directory changes the mtime of its repo directory.
+    os.mkdir(repo / "library/nginx/1.26")
+    (repo / "library/nginx/1.26/Dockerfile").write_text("FROM nginx:1.26")
+    (repo / "library/redis/7/Dockerfile").unlink()
+    age(repo / "library/nginx", repo / "library/nginx/1.26", repo / "library/redis/7", seconds=1)
+    found, index = scan(repo, index_path)
+    assert found == ["library/nginx/1.25", "library/nginx/1.26"]
+    # library/nginx, its new tag and library/redis/7.
+    assert index.listed == 3
+
+
+def test_directories_changed_within_the_racy_window_are_listed_again(tmp_path):
+    repo, index_path = tmp_path / "repo", str(tmp_path / "index.json")
+    make_repo(repo, "library/nginx/1.25")
+    scan(repo, index_path)
+
+    # changed right after the scan, maybe within the mtime tick the index recorded.
+    (repo / "library/nginx/1.25/Dockerfile").unlink()
+    os.utime(repo / "library/nginx/1.25")
+    found, index = scan(repo, index_path)
+    assert found == []
+    assert "library/nginx/1.25" not in index.entries
+
+    # and until its mtime leaves the window: a Dockerfile written back in the same tick is found.
+    (repo / "library/nginx/1.25/Dockerfile").write_text("FROM nginx:1.25")
+    found, index = scan(repo, index_path)
+    assert found == ["library/nginx/1.25"] and index.listed == 1
+
+
+def test_scan_local_repo(tmp_path):
+    make_repo(tmp_path, *[f"library/app{i}/1" for i in range(10)])
+
+    async def main():
+        return [git_sub_path async for git_sub_path in scan_local_repo(str(tmp_path), batch_size=3)]
+
+    assert sorted(asyncio.run(main())) == [f"library/app{i}/1" for i in range(10)]
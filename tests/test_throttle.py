@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+import throttle
+from cr_transport import CRServerError
+from http_client import ConnectError, HttpError
+from throttle import RateLimiter, RetryPolicy, TokenBucket, call_with_retry, parse_qps
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    """
+    the monotonic clock of throttle, advanced by hand.
+    """
+    now = [1000.0]
+    monkeypatch.setattr(throttle, "monotonic", lambda: now[0])
+    return now
+
+
+def throttling() -> CRServerError:
+    return CRServerError(http_status=503, code="Throttling.User", message="flow control")
+
+
+def test_throttled_halves_the_rate_once_a_second(clock):
+    bucket = TokenBucket(rate=16, min_rate=1)
+    bucket.throttled()
+    assert bucket.rate == 8
+    # in-flight calls throttled at the same time count once.
+    bucket.throttled()
+    assert bucket.rate == 8
+    for _ in range(5):
+        clock[0] += 1
+        bucket.throttled()
+    assert bucket.rate == 1
+
+
+def test_succeeded_raises_the_rate_back_to_max(clock):
+    bucket = TokenBucket(rate=20)
+    bucket.throttled()
+    bucket.succeeded()
+    assert bucket.rate == 11
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == 20
+
+
+def test_acquire_waits_for_tokens():
+    bucket = TokenBucket(rate=50, burst=5)
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        for _ in range(10):
+            await bucket.acquire()
+        return loop.time() - start
+
+    # a burst of 5, then 5 tokens at 50/s.
+    assert 0.08 <= asyncio.run(main()) < 0.5
+
+
+def failing(*errors):
+    """
+    a call raising `errors` one per attempt, then returning "ok".
+    """
+    errors = list(errors)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    return call, attempts
+
+
+@pytest.mark.parametrize("error", [throttling(), HttpError("reset"), asyncio.TimeoutError(),
+                                   CRServerError(http_status=500, code="InternalError", message="")])
+def test_retries_idempotent_calls(error):
+    call, attempts = failing(error, error)
+    assert asyncio.run(call_with_retry("GetRepoTags", call, retry=RetryPolicy(base_delay=0.001))) == "ok"
+    assert len(attempts) == 3
+
+
+def test_does_not_retry_client_errors():
+    call, attempts = failing(CRServerError(http_status=400, code="REPO_IS_EXIST", message=""))
+    with pytest.raises(CRServerError):
+        asyncio.run(call_with_retry("CreateRepo", call, retry=RetryPolicy(base_delay=0.001)))
+    assert len(attempts) == 1
+
+
+@pytest.mark.parametrize("error, retried", [
+    (throttling(), True),
+    (ConnectError("refused"), True),
+    (HttpError("reset after the request was sent"), False),
+    (asyncio.TimeoutError(), False),
+    (CRServerError(http_status=500, code="InternalError", message=""), False),
+])
+def test_retries_non_idempotent_calls_only_if_never_applied(error, retried):
+    call, attempts = failing(error)
+    coro = call_with_retry("CreateRepoBuildRule", call, retry=RetryPolicy(base_delay=0.001),
+                           idempotent=False)
+    if retried:
+        assert asyncio.run(coro) == "ok"
+    else:
+        with pytest.raises(type(error)):
+            asyncio.run(coro)
+    assert len(attempts) == (2 if retried else 1)
+
+
+def test_gives_up_after_max_attempts():
+    call, attempts = failing(*[HttpError("reset")] * 10)
+    with pytest.raises(HttpError):
+        asyncio.run(call_with_retry("GetRepoTags", call,
+                                    retry=RetryPolicy(max_attempts=3, base_delay=0.001)))
+    assert len(attempts) == 3
+
+
+def test_throttling_lowers_the_rate_of_the_action():
+    limiter = RateLimiter(qps=100, action_qps={"GetRepoTags": 10})
+    call, _ = failing(throttling())
+    asyncio.run(call_with_retry("GetRepoTags", call, limiter=limiter,
+                                retry=RetryPolicy(base_delay=0.001)))
+    assert limiter.action_buckets["GetRepoTags"].rate < 10
+    assert limiter.bucket.rate < 100
+
+
+@pytest.mark.parametrize("items", [["GetRepoTags"], ["=5"], ["GetRepoTags=0"], ["GetRepoTags=-1"],
+                                   ["GetRepoTags=x"]])
+def test_parse_qps_rejects(items):
+    with pytest.raises(ValueError):
+        parse_qps(items)
+
+
+def test_parse_qps():
+    assert parse_qps(["GetRepoTags=5", "CreateRepo=0.5"]) == {"GetRepoTags": 5, "CreateRepo": 0.5}
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+from typing import Dict, Optional
+
+from cr_transport import CRServerError
+from http_client import ConnectError, HttpError
+from metrics import metrics
+
+logger = logging.getLogger(__file__)
+
+
+class TokenBucket:
+    """
+    token bucket with an adaptive rate: halved on throttling responses, raised back
+    towards `max_rate` a little on every success (AIMD).
+    the rate is halved at most once a second, a burst of throttled in-flight calls
+    counts as one.
+    """
+
+    def __init__(self, rate: float, burst: float = None, min_rate: float = 0.2):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.decreased = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # the lock keeps waiters in FIFO order.
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttled(self):
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+        if self.updated - self.decreased < 1:
+            return
+        self.decreased = self.updated
+        rate = max(self.min_rate, self.rate / 2)
+        if rate < self.rate:
+            logger.debug(f"throttled, rate {self.rate:.2f}/s -> {rate:.2f}/s")
+        self.rate = rate
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter:
+    """
+    client side rate limit shared by all calls of an AliyunCR: a global bucket plus optional
+    buckets per API action.
+    """
+
+    def __init__(self, qps: float = 20, action_qps: Dict[str, float] = None):
+        self.bucket = TokenBucket(qps)
+        self.action_buckets = {action: TokenBucket(q) for action, q in (action_qps or {}).items()}
+
+    def _buckets(self, action: str):
+        action_bucket = self.action_buckets.get(action)
+        if action_bucket is None:
+            return self.bucket,
+        return action_bucket, self.bucket
+
+    async def acquire(self, action: str):
+        for bucket in self._buckets(action):
+            await bucket.acquire()
+
+    def throttled(self, action: str):
+        for bucket in self._buckets(action):
+            bucket.throttled()
+
+    def succeeded(self, action: str):
+        for bucket in self._buckets(action):
+            bucket.succeeded()
+
+
+@dataclass()
+class RetryPolicy:
+    max_attempts: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 30
+
+    def delay(self, attempt: int) -> float:
+        """
+        exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def is_throttling(e: Exception) -> bool:
+    return isinstance(e, CRServerError) and (
+        e.http_status == 429 or "throttling" in str(e.code).lower()
+    )
+
+
+def is_retryable(e: Exception, idempotent: bool = True) -> bool:
+    """
+    :param idempotent: the call can be repeated, else it is retried only if the server can't
+                       have applied it: throttled, or never sent.
+    """
+    if is_throttling(e):
+        return True
+    if not idempotent:
+        # a call that timed out or failed once sent may have been applied already.
+        return isinstance(e, ConnectError)
+    if isinstance(e, CRServerError):
+        return e.http_status >= 500
+    return isinstance(e, (HttpError, ConnectionError, asyncio.TimeoutError))
+
+
+def parse_qps(items) -> Dict[str, float]:
+    """
+    parse ["GetRepoTags=5", ...] into {"GetRepoTags": 5, ...}.
+    """
+    qps = {}
+    for item in items:
+        action, _, value = item.partition("=")
+        if not action or not value:
+            raise ValueError(f"invalid action qps: {item}, expect <Action>=<qps>")
+        qps[action] = float(value)
+        # the token bucket waits 1/qps seconds per token.
+        if not qps[action] > 0:
+            raise ValueError(f"invalid action qps: {item}, expect a qps above 0")
+    return qps
+
+
+async def call_with_retry(action: str,
+                          call,
+                          limiter: Optional[RateLimiter] = None,
+                          retry: Optional[RetryPolicy] = None,
+                          idempotent: bool = True,
+                          ):
+    """
+    await call() under the rate limit, retrying throttled, timed out and 5xx calls.
+    :param idempotent: see is_retryable.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            start = perf_counter()
+            await limiter.acquire(action)
+            metrics.observe("ratelimit_wait", action, perf_counter() - start)
+        try:
+            with metrics.track("api", action):
+                res = await call()
+        except Exception as e:
+            if limiter is not None and is_throttling(e):
+                limiter.throttled(action)
+            attempt += 1
+            if retry is None or attempt >= retry.max_attempts or not is_retryable(e, idempotent):
+                raise
+            delay = retry.delay(attempt)
+            metrics.retry("api", action)
+            logger.debug(f"{action} failed ({e!r}), retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        if limiter is not None:
+            limiter.succeeded(action)
+        return res
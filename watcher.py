@@ -0,0 +1,140 @@
+import logging
+from asyncio import Semaphore, gather, sleep
+from collections import defaultdict
+from inspect import isawaitable
+from statistics import median
+from time import monotonic
+from typing import Callable, Dict, List
+
+from aliyun_cr import AliyunCR, BuildStatus
+
+logger = logging.getLogger(__file__)
+
+TIMEOUT_REASON = "timeout, build not finished!"
+
+
+class BuildWatcher:
+    """
+    polls the builds of repos that have outstanding tags, until every tag is ready or failed.
+
+    every round costs one list_builds call per repo, whatever the number of its outstanding tags.
+    the interval between rounds follows the observed build durations, backs off while nothing
+    finishes, and never goes below what the rate limit allows for a round.
+
+    on_ready and on_failed may be coroutine functions, a round waits for them, so tags they
+    `add` are polled from the next round on.
+    """
+
+    def __init__(self,
+                 cr: AliyunCR,
+                 on_ready: Callable[[str], None],
+                 on_failed: Callable[[str, str], None],
+                 min_interval: float = 5,
+                 max_interval: float = 120,
+                 concurrency: int = 16,
+                 ):
+        self.cr = cr
+        self.on_ready = on_ready
+        self.on_failed = on_failed
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        # {repo_name: {tag: image}}
+        self.outstanding: Dict[str, Dict[str, str]] = defaultdict(dict)
+        self.since: Dict[str, float] = {}
+        self.durations: List[float] = []
+        self.idle_rounds = 0
+
+    def add(self, repo_name: str, tag: str, image: str):
+        self.outstanding[repo_name][tag] = image
+        self.since[image] = monotonic()
+
+    def discard(self, repo_name: str):
+        """
+        stop polling a repo, without reporting its outstanding tags.
+        """
+        for image in self.outstanding.pop(repo_name, {}).values():
+            self.since.pop(image, None)
+
+    def _done(self, repo_name: str, tag: str, succeeded: bool = False):
+        image = self.outstanding[repo_name].pop(tag)
+        if not self.outstanding[repo_name]:
+            del self.outstanding[repo_name]
+        duration = monotonic() - self.since.pop(image)
+        if succeeded:
+            self.durations.append(duration)
+        return image
+
+    def interval(self) -> float:
+        interval = self.min_interval
+        if self.durations:
+            interval = max(interval, median(self.durations) / 8)
+        interval *= 1.5 ** self.idle_rounds
+        # a round is one call per repo, keep it within the rate limit.
+        interval = max(interval, len(self.outstanding) / self.cr.limiter.bucket.rate)
+        return min(interval, self.max_interval)
+
+    @staticmethod
+    async def _notify(callback, *args):
+        res = callback(*args)
+        if isawaitable(res):
+            await res
+
+    def _outstanding(self, repo_name: str, tag: str) -> bool:
+        return tag in self.outstanding.get(repo_name, ())
+
+    async def _poll(self, repo_name: str):
+        # callbacks may add tags to the repo, only the ones known now are polled this round.
+        tags = set(self.outstanding.get(repo_name, ()))
+        # builds come newest first, the first one of a tag is its latest build.
+        latest = {}
+        async for b in self.cr.list_builds(repo_name=repo_name, limit=self.cr.page_size):
+            if b.tag in tags:
+                latest.setdefault(b.tag, b)
+        finished = 0
+        succeeded = [tag for tag, b in latest.items() if b.status == BuildStatus.SUCCESS]
+        if succeeded:
+            existing = {t async for t in self.cr.list_tags(repo_name=repo_name, use_cache=False)}
+            for tag in succeeded:
+                if tag in existing and self._outstanding(repo_name, tag):
+                    tags.discard(tag)
+                    await self._notify(self.on_ready, self._done(repo_name, tag, succeeded=True))
+                    finished += 1
+        for tag in tags:
+            if not self._outstanding(repo_name, tag):
+                continue
+            b = latest.get(tag)
+            if b is None:
+                await self._notify(self.on_failed, self._done(repo_name, tag),
+                                   "Tag not exist, no pending build!")
+                finished += 1
+            elif b.status == BuildStatus.FAILED:
+                await self._notify(self.on_failed, self._done(repo_name, tag), f"build {b.id} failed!")
+                finished += 1
+        return finished
+
+    async def run(self, timeout: float = None):
+        deadline = None if timeout is None else monotonic() + timeout
+        semaphore = Semaphore(self.concurrency)
+
+        async def poll(repo_name: str):
+            async with semaphore:
+                try:
+                    return await self._poll(repo_name)
+                except Exception as e:
+                    logger.warning(f"Failed to poll {repo_name}: {e}")
+                    return 0
+
+        while self.outstanding:
+            interval = self.interval()
+            if deadline is not None and monotonic() + interval > deadline:
+                break
+            logger.info(f"{sum(map(len, self.outstanding.values()))} image(s) in "
+                        f"{len(self.outstanding)} repo(s) not finished, next poll in {interval:.0f}s")
+            await sleep(interval)
+            finished = sum(await gather(*[poll(repo_name) for repo_name in list(self.outstanding)]))
+            self.idle_rounds = 0 if finished else self.idle_rounds + 1
+        for repo_name, tags in list(self.outstanding.items()):
+            for tag in list(tags):
+                if self._outstanding(repo_name, tag):
+                    await self._notify(self.on_failed, self._done(repo_name, tag), TIMEOUT_REASON)